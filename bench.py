@@ -0,0 +1,409 @@
+'''Headless physics benchmarks and diagnostics.
+
+Usage: python bench.py [options] broadphase|pile|signals|pipeline|characters|perception|navigation|particles|projectiles|memory|leaks
+'''
+
+import sys
+import math
+import time
+import random
+import shutil
+import tempfile
+import optparse
+
+import game.headless
+import pyglet
+from game import actors
+from game import broadphase
+from game import simulation
+from game import navigation
+from game import particles
+from game import projectiles
+from game import memory
+from game import physics as game_physics
+from game.components import PerceptionComponent
+from game.actor import component
+
+def bench_broadphase(options):
+    '''Reports the broadphase the physics picks for the level with a pile
+    of blocks, and the measured step time of it and the alternatives.
+    '''
+    def build(config=None):
+        sim = simulation.load_level(options.map)
+        # Before the blocks, or auto-tuning switches to a hash while they
+        # spawn and there's no going back to the tree on Chipmunk 6
+        if config != None:
+            sim.physics.set_broadphase(config)
+        simulation.spawn_blocks(sim, options.blocks)
+        return sim
+
+    sim = build()
+    physics = sim.physics
+    static, dynamic = physics.shape_sizes()
+    chosen = physics.broadphase
+    print '%d static shapes, %d dynamic shapes' % (len(static), len(dynamic))
+    if not broadphase.configurable(physics.space):
+        # Every candidate would time the same default
+        print 'this pymunk can\'t change the broadphase, it stays %s' % chosen
+        configs = [chosen]
+    else:
+        print 'chosen: %s' % chosen
+        configs = broadphase.candidates(chosen, static, dynamic,
+                broadphase.has_tree(physics.space))
+    print '%-50s %10s' % ('candidate', 'step ms')
+    for config, seconds in broadphase.measure(build, configs, options.ticks):
+        print '%-50s %10.3f%s' % (config, seconds * 1000,
+                ' *' if config == chosen else '')
+
+def bench_pile(options):
+    '''Drops the blocks, lets the pile settle and times steps of the settled
+    pile with and without sleeping bodies.
+    '''
+    # Settled once every block is asleep, chipmunk only puts a pile to sleep
+    # once all of it came to rest, or after a minute. The run without
+    # sleeping gets as many ticks to settle.
+    limit = 3600
+    for sleeping in (True, False):
+        sim = simulation.load_level(options.map)
+        sim.physics.set_sleeping(sleeping)
+        simulation.spawn_blocks(sim, options.blocks)
+
+        settle = 0
+        while settle < limit and (not sim.physics.sleeping or
+                len(sim.physics.sleeping_bodies) < options.blocks):
+            sim.step()
+            settle += 1
+        if sim.physics.sleeping and settle == limit:
+            print 'Still settling after %d ticks, %d blocks asleep' % (limit,
+                    len(sim.physics.sleeping_bodies))
+        limit = settle
+
+        start = time.time()
+        for i in range(options.ticks):
+            sim.step()
+        seconds = (time.time() - start) / options.ticks
+
+        print '%-13s settled after %4d ticks, %5d awake, %5d asleep, %8.3f step ms' % (
+                'sleeping:' if sleeping else 'no sleeping:', settle,
+                len(sim.actors.awake), len(sim.actors.actors) - len(sim.actors.awake),
+                seconds * 1000)
+        if sleeping and not sim.physics.sleeping:
+            print 'This pymunk has no sleeping bodies (needs Chipmunk 6)'
+            break
+
+def bench_signals(options):
+    '''Events per second from a component to one handler, like a sprite
+    following its body, through pyglet's dispatcher and through signals.
+    '''
+    class Handler(object):
+        def on_move(self, x, y, rel_x, rel_y):
+            pass
+
+    class Dispatcher(pyglet.event.EventDispatcher):
+        pass
+    Dispatcher.register_event_type('on_move')
+
+    class Emitter(component.Component):
+        signal_types = ('on_move',)
+
+    dispatcher = Dispatcher()
+    dispatcher.push_handlers(Handler())
+    emitter = Emitter()
+    emitter.push_handlers(Handler())
+    signal = emitter.signals['on_move']
+
+    def run(fire, *args):
+        start = time.time()
+        for i in xrange(options.events):
+            fire(*args)
+        return options.events / (time.time() - start)
+
+    move = (1.0, 2.0, 0, 0)
+    baseline = run(dispatcher.dispatch_event, 'on_move', *move)
+    print '%-30s %12s %8s' % ('', 'events/s', 'speedup')
+    for name, rate in (('pyglet dispatch_event', baseline),
+            ('Component.dispatch_event', run(emitter.dispatch_event, 'on_move', *move)),
+            ('Signal.emit', run(signal.emit, *move))):
+        print '%-30s %12.0f %7.1fx' % (name, rate, rate / baseline)
+
+def bench_pipeline(options):
+    '''Frame time with the blocks falling, with physics stepped in line and
+    on the worker thread. Drawing is stood in for by sleeping -r ms a frame.
+    '''
+    render = options.render / 1000.0
+    for pipelined in (False, True):
+        sim = simulation.load_level(options.map)
+        simulation.spawn_blocks(sim, options.blocks)
+        sim.physics.set_sleeping(False)
+        sim.set_pipelined(pipelined)
+
+        physics = 0.0
+        start = time.time()
+        for i in range(options.ticks):
+            step = time.time()
+            sim.step()
+            physics += time.time() - step
+            time.sleep(render)
+        sim.sync()
+        frame = (time.time() - start) / options.ticks
+
+        if not pipelined:
+            serial = physics / options.ticks
+        print '%-10s %8.3f frame ms (step %.3f ms, draw %.3f ms)' % (
+                'pipelined:' if pipelined else 'in line:', frame * 1000,
+                serial * 1000, options.render)
+        sim.set_pipelined(False)
+
+def bench_characters(options):
+    '''Step time with a crowd of walking characters, as bodies in the space
+    and as kinematic characters.
+    '''
+    for actor_class in (actors.Player, actors.KinematicCharacter):
+        sim = simulation.load_level(options.map)
+        for i in range(options.characters):
+            character = simulation.spawn(sim, actor_class, 'Character %d' % i,
+                    (100 + 1400.0 * i / options.characters, 200 + 80 * (i % 4)))
+            character.get_component('physics').move(i % 2)
+
+        for i in range(60):
+            sim.step()
+        start = time.time()
+        for i in range(options.ticks):
+            sim.step()
+        seconds = (time.time() - start) / options.ticks
+        print '%-20s %5d characters %8.3f step ms' % (actor_class.__name__,
+                options.characters, seconds * 1000)
+
+def bench_perception(options):
+    '''Perception time with a crowd of characters that look for the player
+    and the nearest enemy target every tick.
+    '''
+    sim = simulation.load_level(options.map)
+    player = simulation.spawn(sim, actors.Player, 'Player', (800, 300))
+    watchers = []
+    for i in range(options.characters):
+        character = actors.KinematicCharacter()
+        character.add_component(PerceptionComponent(game_physics.LAYER_ENEMY))
+        character.refresh_components()
+        character.name = 'Character %d' % i
+        character.get_component('physics').body.position = \
+                (100 + 1400.0 * i / options.characters, 200 + 80 * (i % 4))
+        sim.actors.add_actor(character)
+        watchers.append(character.get_component('perception'))
+
+    answered = cached = waiting = 0
+    seconds = 0.0
+    for i in range(options.ticks):
+        target = player.get_component('physics').transform()[:2]
+        for watcher in watchers:
+            watcher.look_at(target)
+            watcher.find_nearest()
+        sim.apply_input()
+        sim.physics.update(sim.dt)
+        sim.actors._step(sim.dt)
+        start = time.time()
+        sim.perception.run()
+        seconds += time.time() - start
+        sim.end_tick()
+        answered += sim.perception.answered
+        cached += sim.perception.cached
+        waiting += sim.perception.waiting
+
+    ticks = float(options.ticks)
+    print '%5d characters, budget %d: %6.1f answered (%.1f cached), %6.1f waiting, %8.3f ms per tick' % (
+            options.characters, sim.perception.budget, answered / ticks,
+            cached / ticks, waiting / ticks, seconds / ticks * 1000)
+
+def bench_navigation(options):
+    '''Navigation graph build and cached load time, and repaths per second
+    for a crowd of characters walking towards a goal that moves along the
+    level.
+    '''
+    sim = simulation.load_level(options.map)
+    profile = navigation.profile_of(
+            actors.KinematicCharacter().get_component('physics'))
+    grid = sim.physics.collision_grid()
+    cache = navigation.GraphCache(tempfile.mkdtemp())
+    try:
+        start = time.time()
+        graph = cache.load(grid, profile, options.map)
+        built = time.time() - start
+        start = time.time()
+        cache.load(grid, profile, options.map)
+        loaded = time.time() - start
+    finally:
+        shutil.rmtree(cache.directory)
+    print '%d nodes, %d links, built in %.1f ms, loaded from the cache in %.1f ms' % (
+            len(graph.positions), sum(len(links) for links in graph.links.itervalues()),
+            built * 1000, loaded * 1000)
+
+    nodes = sorted(graph.positions)
+    # Same crowd every run
+    agents = [random.Random(i).choice(nodes) for i in range(options.characters)]
+    goals = nodes[::max(1, len(nodes) / 10)]
+    start = time.time()
+    for tick in range(options.ticks):
+        goal = goals[tick * len(goals) / options.ticks]
+        for n, agent in enumerate(agents):
+            path = graph.path(agent, goal)
+            if path:
+                agents[n] = path[0].target
+    seconds = time.time() - start
+    repaths = options.ticks * len(agents)
+    print '%d repaths in %.1f ms, %.0f repaths/s, %d searched, %d from the cache' % (
+            repaths, seconds * 1000, repaths / seconds, graph.searches, graph.hits)
+
+def bench_particles(options):
+    '''Time of the particle update with -p particles bouncing around the
+    level, and of the bursts that replace the ones that die.
+    '''
+    if not particles.AVAILABLE:
+        print 'NumPy not found, no particles'
+        return
+    sim = simulation.load_level(options.map)
+    system = particles.ParticleSystem(options.particles)
+    system.set_collision(sim.physics.collision_grid())
+    bursts = 100
+    size = max(1, options.particles / bursts)
+
+    emitted = [0]
+
+    def refill():
+        while system.count - system.dead + size <= system.capacity:
+            n = emitted[0] % bursts
+            emitted[0] += 1
+            system.emit(100 + 1400.0 * n / bursts, 300, size, speed=300.0,
+                    life=2.0, size=2.0)
+
+    refill()
+    updating = emitting = 0.0
+    live = 0
+    for i in range(options.ticks):
+        start = time.time()
+        system.update(sim.dt)
+        updating += time.time() - start
+        live += system.count - system.dead
+        start = time.time()
+        refill()
+        emitting += time.time() - start
+    print '%8.0f live particles, %8.3f update ms, %8.3f emit ms per tick' % (
+            live / float(options.ticks), updating / options.ticks * 1000,
+            emitting / options.ticks * 1000)
+
+def bench_projectiles(options):
+    '''Time of the projectile step with the pool kept full of bullets fired
+    across the pile of blocks and a crowd of kinematic characters.
+    '''
+    sim = simulation.load_level(options.map)
+    simulation.spawn_blocks(sim, options.blocks)
+    for i in range(options.characters):
+        character = simulation.spawn(sim, actors.KinematicCharacter,
+                'Character %d' % i,
+                (100 + 1400.0 * i / options.characters, 200 + 80 * (i % 4)))
+        character.get_component('physics').layers = game_physics.LAYER_ENEMYBULLET
+    for i in range(60):
+        sim.step()
+
+    pool = sim.projectiles
+    hits = [0]
+
+    def on_projectile_hits(batch):
+        hits[0] += len(batch)
+    pool.push_handlers(on_projectile_hits=on_projectile_hits)
+
+    # Same volleys every run
+    rand = random.Random(0)
+    def refill():
+        while pool.count < pool.capacity:
+            angle = rand.uniform(0, 2 * math.pi)
+            pool.fire(rand.uniform(100, 1500), rand.uniform(100, 500),
+                    math.cos(angle) * 600, math.sin(angle) * 600,
+                    projectiles.ENEMY_BULLET)
+
+    live = 0
+    seconds = 0.0
+    for i in range(options.ticks):
+        refill()
+        live += pool.count
+        start = time.time()
+        pool.step(sim.dt)
+        seconds += time.time() - start
+    print '%6.0f live bullets, %6.1f hits, %8.3f step ms per tick' % (
+            live / float(options.ticks), hits[0] / float(options.ticks),
+            seconds / options.ticks * 1000)
+
+def load_test_level(options):
+    sim = simulation.load_level(options.map)
+    simulation.spawn_test_actors(sim)
+    simulation.spawn_blocks(sim, options.blocks)
+    for i in range(60):
+        sim.step()
+    return sim
+
+def bench_memory(options):
+    '''Memory of a level with the test actors and the blocks, per
+    subsystem. Headless, so there are no textures.
+    '''
+    sim = load_test_level(options)
+    counts = memory.live_counts()
+    for name, cpu, gpu in memory.report(sim):
+        print '%-14s %10.1f KB CPU %10.1f KB GPU' % (name, cpu / 1024.0,
+                gpu / 1024.0)
+    print 'live: %s' % ', '.join('%d %s' % (counts[name], name)
+            for name in sorted(counts))
+
+def bench_leaks(options):
+    '''Loads, steps and unloads the level -n times and fails if live
+    objects grow with every load.
+    '''
+    before, after, grown = memory.leak_check(
+            lambda: load_test_level(options), simulation.unload_level,
+            options.runs)
+    for name in sorted(after):
+        print '%-12s %8d -> %8d%s' % (name, before[name], after[name],
+                ' grew' if name in grown else '')
+    if grown:
+        print 'Leaking: %s' % ', '.join(grown)
+        return 1
+
+BENCHMARKS = {
+    'broadphase': bench_broadphase,
+    'pile': bench_pile,
+    'signals': bench_signals,
+    'pipeline': bench_pipeline,
+    'characters': bench_characters,
+    'perception': bench_perception,
+    'navigation': bench_navigation,
+    'particles': bench_particles,
+    'projectiles': bench_projectiles,
+    'memory': bench_memory,
+    'leaks': bench_leaks,
+}
+
+def main():
+    parser = optparse.OptionParser(usage='%%prog [options] %s' %
+            '|'.join(sorted(BENCHMARKS)))
+    parser.add_option('-m', '--map', default='maps/test.tmx',
+            help='level to load [default: %default]')
+    parser.add_option('-b', '--blocks', type='int', default=1000,
+            help='blocks to spawn [default: %default]')
+    parser.add_option('-t', '--ticks', type='int', default=120,
+            help='ticks to time [default: %default]')
+    parser.add_option('-c', '--characters', type='int', default=200,
+            help='characters to spawn [default: %default]')
+    parser.add_option('-p', '--particles', type='int', default=100000,
+            help='particles to keep alive [default: %default]')
+    parser.add_option('-n', '--runs', type='int', default=10,
+            help='level loads for the leak check [default: %default]')
+    parser.add_option('-e', '--events', type='int', default=200000,
+            help='events to dispatch [default: %default]')
+    parser.add_option('-r', '--render', type='float', default=8.0,
+            help='stand-in draw time in ms [default: %default]')
+    options, args = parser.parse_args()
+
+    if len(args) != 1 or args[0] not in BENCHMARKS:
+        parser.error('expected one of %s' % ', '.join(sorted(BENCHMARKS)))
+    return BENCHMARKS[args[0]](options)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,54 @@
+'''Builds the assets under data/ into their runtime form, only rebuilding
+what changed since the last build.
+
+Usage: python build.py [options]
+'''
+
+import os
+import sys
+import optparse
+
+import game.headless
+from game import assets
+from game.util import archive
+from game.util import resource
+
+def main():
+    home = os.path.dirname(os.path.abspath(__file__))
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--source', default=os.path.join(home, 'data'),
+            help='asset directory [default: %default]')
+    parser.add_option('-o', '--output', default=os.path.join(home, 'build', 'data'),
+            help='build directory [default: %default]')
+    parser.add_option('-j', '--jobs', type='int', default=None,
+            help='worker processes [default: one per core]')
+    parser.add_option('-f', '--force', action='store_true', default=False,
+            help='rebuild everything')
+    parser.add_option('-g', '--graph', action='store_true', default=False,
+            help='print the dependency graph')
+    parser.add_option('-p', '--pack', action='store_true', default=False,
+            help='pack the build into %s' % resource.ARCHIVE)
+    options, args = parser.parse_args()
+
+    report = assets.build(options.source, options.output, options.jobs,
+            options.force)
+    print report
+
+    if options.graph:
+        for name in sorted(report.graph):
+            if report.graph[name]:
+                print '%s -> %s' % (name, ', '.join(report.graph[name]))
+
+    if report.errors:
+        return 1
+
+    if options.pack:
+        # Members are named like the loose files they replace
+        members = [('data/' + name, os.path.join(options.output, *name.split('/')))
+                for name in assets.walk(options.output)]
+        filename = os.path.join(home, resource.ARCHIVE)
+        count = archive.pack(filename, members)
+        print 'Packed %d files into %s' % (count, filename)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -74,7 +74,10 @@ class Actor(pyglet.event.EventDispatcher):
         clean-up routines. A KeyError will be raised if a component of given
         type is not attached.
         '''
-        del self.components[component_type]
+        component = self.components.pop(component_type)
+        for other in self.components.values():
+            other.disconnect(component)
+            component.disconnect(other)
         component.detach()
 
     def clear_components(self):
@@ -116,7 +119,9 @@ class Actor(pyglet.event.EventDispatcher):
         into the events of other components that belong to the Actor.
         You should call this once during the initial creation of the Actor,
         after all of the components have been added.
-        If you add/remove components later, make sure to refresh.
+        If you add/remove components later, make sure to refresh. Signals
+        ignore handlers that are already connected, so refreshing again
+        doesn't call anything twice.
         '''
         for component in self.components.values():
             component.on_refresh()
@@ -131,6 +136,19 @@ class Actor(pyglet.event.EventDispatcher):
         '''
         pass
 
+    def on_sleep(self):
+        '''Callback function when the actor stops getting updates because it
+        has nothing to do, e.g. it's a block resting on a pile.
+        '''
+        for component in self.components.values():
+            component.on_sleep()
+
+    def on_wake(self):
+        '''Callback function when the actor gets updates again.
+        '''
+        for component in self.components.values():
+            component.on_wake()
+
 # Event handlers for Actor
 Actor.register_event_type('on_actor_enter')
 Actor.register_event_type('on_actor_exit')
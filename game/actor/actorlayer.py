@@ -4,26 +4,33 @@ should create a subclass and override the add_actor and remove_actor methods to
 do component checking.
 For example, a user may want to check for a 'graphics' component and add/remove
 a sprite to/from a batch node.
+ActorSet holds the actors without being a layer. Headless simulations use it,
+a cocos layer needs the director's window to be created.
+Only awake actors are updated every step. Whatever decides that an actor has
+nothing to do, like the physics putting a settled body to sleep, calls
+sleep_actor, and wake_actor once it has.
 '''
 
 import pyglet
 import cocos
 
-class ActorLayer(cocos.layer.ScrollableLayer, pyglet.event.EventDispatcher):
+class ActorSet(pyglet.event.EventDispatcher):
     def __init__(self):
-        super(ActorLayer, self).__init__()
         self.actors = {}
+        self.awake = {}
 
     def add_actor(self, actor):
         if actor.name in self.actors:
             raise Exception('Duplicate actor name: %s' % actor.name)
 
         self.actors[actor.name] = actor
+        self.awake[actor.name] = actor
         actor.on_enter()
         self.dispatch_event('on_actor_add', actor)
     
     def remove_actor(self, actor):
         del self.actors[actor.name]
+        self.awake.pop(actor.name, None)
         actor.on_exit()
         self.dispatch_event('on_actor_remove', actor)
 
@@ -44,10 +51,31 @@ class ActorLayer(cocos.layer.ScrollableLayer, pyglet.event.EventDispatcher):
                 actors.add(a)
         return actors
 
+    def sleep_actor(self, actor):
+        '''Stops updating the actor until wake_actor is called.
+        '''
+        if self.awake.pop(actor.name, None) != None:
+            actor.on_sleep()
+            self.dispatch_event('on_actor_sleep', actor)
+
+    def wake_actor(self, actor):
+        if actor.name in self.actors and actor.name not in self.awake:
+            self.awake[actor.name] = actor
+            actor.on_wake()
+            self.dispatch_event('on_actor_wake', actor)
+
     def _step(self, dt):
-        for actor in self.actors.values():
+        for actor in self.awake.values():
             actor.update(dt)
 
-ActorLayer.register_event_type('on_actor_add')
-ActorLayer.register_event_type('on_actor_remove')
+ActorSet.register_event_type('on_actor_add')
+ActorSet.register_event_type('on_actor_remove')
+ActorSet.register_event_type('on_actor_sleep')
+ActorSet.register_event_type('on_actor_wake')
+
+class ActorLayer(cocos.layer.ScrollableLayer, ActorSet):
+    def __init__(self):
+        super(ActorLayer, self).__init__()
+        # CocosNode doesn't pass __init__ on
+        ActorSet.__init__(self)
 
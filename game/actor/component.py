@@ -4,19 +4,66 @@ import weakref
 class ComponentException(Exception):
     pass
 
+class Signal(list):
+    '''The handlers of one event of one component, called in the order they
+    were connected. Unlike pyglet handlers, return values are ignored and a
+    handler can't stop the others from being called.
+    '''
+    def __init__(self, name):
+        super(Signal, self).__init__()
+        self.name = name
+
+    def connect(self, handler):
+        # Refreshing twice mustn't call handlers twice
+        if handler not in self:
+            self.append(handler)
+
+    def disconnect(self, handler):
+        if handler in self:
+            self.remove(handler)
+
+    def emit(self, *args):
+        for handler in self:
+            handler(*args)
+
+# Component class -> names of all its signals, see signal_names
+_signal_names = {}
+
+def signal_names(cls):
+    '''Names in signal_types of a component class and its bases.
+    '''
+    names = _signal_names.get(cls)
+    if names == None:
+        names = set()
+        for base in cls.__mro__:
+            names.update(base.__dict__.get('signal_types', ()))
+        names = _signal_names[cls] = tuple(sorted(names))
+    return names
+
 class Component(pyglet.event.EventDispatcher):
     '''Components provide functionality to Actors. Components avoid the deep
     hierarchy inheritance problem with game objects that share functionality.
     Components should do one thing only and do it well. Components talk to each
-    other by using the pyglet event framework. Alternatively, components can
-    obtain direct references to other components if needed.
+    other through signals, which are connected in on_refresh. Alternatively,
+    components can obtain direct references to other components if needed.
+
+    A component lists the events it fires in its signal_types attribute and
+    fires them with self.signals[name].emit(...), or better through a Signal
+    it looked up once. push_handlers, remove_handlers and dispatch_event work
+    like pyglet's for signals, so code written for the pyglet dispatcher keeps
+    working. Other events still go through pyglet.
     '''
     # Class level variable containing a string with the Component's type
     # string. Child classes must set this variable.
     #component_type = None
 
+    # Names of the events this component fires
+    signal_types = ()
+
     def __init__(self):
         self._owner = None
+        self.signals = dict((name, Signal(name)) for name in
+                signal_names(type(self)))
 
     @property
     def owner(self):
@@ -55,6 +102,77 @@ class Component(pyglet.event.EventDispatcher):
         self.owner = None
         self.on_detach()
 
+    def connect(self, handler=None, **handlers):
+        '''Connects the methods of handler named after signals of this
+        component, and signal=function keywords.
+        '''
+        if handler != None:
+            for name, signal in self.signals.iteritems():
+                method = getattr(handler, name, None)
+                if method != None:
+                    signal.connect(method)
+        for name, function in handlers.iteritems():
+            self.signals[name].connect(function)
+
+    def disconnect(self, handler):
+        '''Disconnects every method of handler, or the function handler.
+        '''
+        for signal in self.signals.itervalues():
+            for method in signal[:]:
+                if method == handler or getattr(method, 'im_self', None) is handler:
+                    signal.remove(method)
+
+    def split_handlers(self, args, kwargs):
+        '''Separates push_handlers style arguments for signals from the ones
+        for pyglet events. Returns the signal (name, handler) pairs and the
+        leftover args and kwargs, if this component has pyglet events.
+        '''
+        found = []
+        rest = []
+        events = hasattr(self, 'event_types')
+        for handler in args:
+            if hasattr(handler, '__call__'):
+                name = getattr(handler, '__name__', None)
+                if name in self.signals:
+                    found.append((name, handler))
+                else:
+                    rest.append(handler)
+                continue
+            for name in self.signals:
+                method = getattr(handler, name, None)
+                if method != None:
+                    found.append((name, method))
+            if events:
+                rest.append(handler)
+
+        rest_kwargs = {}
+        for name, handler in kwargs.iteritems():
+            if name in self.signals:
+                found.append((name, handler))
+            else:
+                rest_kwargs[name] = handler
+        return found, rest, rest_kwargs
+
+    def push_handlers(self, *args, **kwargs):
+        found, rest, rest_kwargs = self.split_handlers(args, kwargs)
+        for name, handler in found:
+            self.signals[name].connect(handler)
+        if rest or rest_kwargs:
+            super(Component, self).push_handlers(*rest, **rest_kwargs)
+
+    def remove_handlers(self, *args, **kwargs):
+        found, rest, rest_kwargs = self.split_handlers(args, kwargs)
+        for name, handler in found:
+            self.signals[name].disconnect(handler)
+        if rest or rest_kwargs:
+            super(Component, self).remove_handlers(*rest, **rest_kwargs)
+
+    def dispatch_event(self, event_type, *args):
+        signal = self.signals.get(event_type)
+        if signal == None:
+            return super(Component, self).dispatch_event(event_type, *args)
+        signal.emit(*args)
+
     def update(self, dt):
         '''Override this method to do time-based updates.
         '''
@@ -67,6 +185,15 @@ class Component(pyglet.event.EventDispatcher):
         '''
         pass
 
+    def on_sleep(self):
+        '''Called when the owner goes to sleep. update won't be called
+        until on_wake.
+        '''
+        pass
+
+    def on_wake(self):
+        pass
+
     def on_detach(self):
         '''When detached (removed by the owner), a well-behaved component will
         unregister all events that it was previously registered to and do
@@ -1,22 +1,45 @@
 import cocos
 
 import actor.actorlayer
+import util.anim
+import util.atlas
+from components import AnimComponent
 
 class ActorLayer(actor.actorlayer.ActorLayer):
     def __init__(self):
         super(ActorLayer, self).__init__()
         self.batch = cocos.batch.BatchNode()
         self.add(self.batch)
+        # One clock advances every animated sprite in the layer
+        self.animations = util.anim.AnimationClock()
 
     def add_actor(self, actor):
         super(ActorLayer, self).add_actor(actor)
 
         if actor.has_component('sprite'):
-            self.batch.add(actor.get_component('sprite').sprite)
+            sprite = actor.get_component('sprite')
+            self.batch.add(sprite.sprite)
+
+            if isinstance(sprite, AnimComponent):
+                sprite.clock = self.animations
+                self.animations.add(sprite.sprite, sprite.anims[sprite.animation])
 
     def remove_actor(self, actor):
         super(ActorLayer, self).remove_actor(actor)
 
         if actor.has_component('sprite'):
-            self.batch.remove(actor.get_component('sprite').sprite)
+            sprite = actor.get_component('sprite')
+            self.batch.remove(sprite.sprite)
+
+            if isinstance(sprite, AnimComponent):
+                self.animations.remove(sprite.sprite)
+                sprite.clock = None
+
+    def draw_calls(self):
+        '''Estimated number of draw calls the actor batch takes.
+        '''
+        return util.atlas.draw_calls(child for z, child in self.batch.children)
 
+    def _step(self, dt):
+        super(ActorLayer, self)._step(dt)
+        self.animations.tick(dt)
@@ -4,11 +4,28 @@ import cocos
 import pymunk
 
 import util.anim
+import util.atlas
 import util.resource
 from actor.actor import Actor
 from components import *
 from physics import *
 
+# Headless runs (replays, servers, benchmarks) turn this off so actors are
+# built without sprites and no GL context is needed
+GRAPHICS = True
+
+# Images and animsets used by actors, packed into the texture atlas on load
+IMAGES = ['images/block_grass.png', 'images/platform.png']
+ANIMSETS = ['anims/test.xml']
+
+def atlas_images():
+    '''Resource names of every image that actors draw from.
+    '''
+    names = list(IMAGES)
+    for animset in ANIMSETS:
+        names.append(util.anim.animset_image(util.resource.path(animset)))
+    return names
+
 def make_rect(body, width, height, x=0, y=0, friction=0.5):
     w = width / 2.0
     h = height / 2.0
@@ -20,10 +37,10 @@ def make_rect(body, width, height, x=0, y=0, friction=0.5):
 class Player(Actor):
     def __init__(self):
         super(Player, self).__init__()
-        # Load animations
-        anims = util.anim.load_animset(util.resource.path('anims/test.xml'))
-
-        self.add_component(AnimComponent(anims))
+        if GRAPHICS:
+            # Load animations
+            anims = util.anim.load_animset(util.resource.path('anims/test.xml'))
+            self.add_component(AnimComponent(anims))
 
         width = 48 
         height = 64
@@ -39,16 +56,41 @@ class Player(Actor):
 
         self.refresh_components()
 
+class KinematicCharacter(Actor):
+    '''A character moved by kinematic.move instead of a body in the space.
+    Cheap enough to have hundreds of them.
+    '''
+    def __init__(self):
+        super(KinematicCharacter, self).__init__()
+        if GRAPHICS:
+            anims = util.anim.load_animset(util.resource.path('anims/test.xml'))
+            self.add_component(AnimComponent(anims))
+
+        # Never added to the space, only holds the position and velocity
+        body = pymunk.Body()
+        self.add_component(KinematicCharacterComponent(body, 48, 64, offset_y=-13))
+        self.refresh_components()
+
+class KinematicPlayer(KinematicCharacter):
+    def __init__(self):
+        super(KinematicPlayer, self).__init__()
+        self.add_component(PlayerInputComponent())
+        # Found by the same queries as Player
+        self.get_component('physics').layers = LAYER_ENEMY | LAYER_ITEM | \
+                LAYER_PLAYEROBJECT | LAYER_ENEMYBULLET
+        self.refresh_components()
+
 class Block(Actor):
     def __init__(self):
         super(Block, self).__init__()
 
-        self.add_component(SpriteComponent(cocos.sprite.Sprite('images/block_grass.png')))
+        if GRAPHICS:
+            self.add_component(SpriteComponent(cocos.sprite.Sprite(util.atlas.image('images/block_grass.png'))))
         width = 44
         height = 44
         body = pymunk.Body(10, pymunk.moment_for_box(10, width, height))
         rect = make_rect(body, width, height, friction=0.5)
-        rect.layers = LAYER_PLAYEROBJECT | LAYER_ENEMYOBJECT | LAYER_OBJECTPLAYERBULLET | LAYER_OBJECTENEMYBULLET
+        rect.layers = LAYER_PLAYEROBJECT | LAYER_ENEMYOBJECT | LAYER_OBJECTPLAYERBULLET | LAYER_OBJECTENEMYBULLET | LAYER_SIGHT
         rect.collision_type = COLLTYPE_OBJECT
         self.add_component(PhysicsComponent(body, (rect,)))
         self.refresh_components()
@@ -57,7 +99,8 @@ class MovingPlatform(Actor):
     def __init__(self):
         super(MovingPlatform, self).__init__()
 
-        self.add_component(SpriteComponent(cocos.sprite.Sprite('images/platform.png')))
+        if GRAPHICS:
+            self.add_component(SpriteComponent(cocos.sprite.Sprite(util.atlas.image('images/platform.png'))))
 
         width = 128
         height = 32 
@@ -0,0 +1,356 @@
+'''Offline asset build.
+Walks a source tree (normally data/), checks every asset and writes it to
+an output tree in the form that is fastest to load at runtime:
+    physics XML     validated, made convex, sorted and compiled to the binary
+                    form of geometry.polygons_to_binary
+    animset XML     frames checked against the sprite sheet, compiled to
+                    AnimSetDef.to_string
+    maps            tilesets, layer data and gids checked. Tile layers need
+                    the tileset textures anyway, so maps stay XML.
+    game.conf       controls compiled to catch unknown actions and keys
+    images          signature checked and copied
+Loaders tell the compiled forms apart by their magic bytes, so built assets
+keep their names and the output tree can be packed as is (see pack.py).
+
+Builds are incremental. The state file in the output tree records the sha1
+of every source and of everything it depended on when it was built, e.g.
+that maps/test.tmx used maps/physics/test.xml and two tilesets. Only assets
+whose source or dependencies changed are rebuilt, on a process pool. Files
+are only hashed again if their size or mtime changed.
+'''
+
+try:
+    from xml.etree import ElementTree
+except ImportError:
+    import elementtree.ElementTree as ElementTree
+
+import os
+import time
+import zlib
+import array
+import base64
+import struct
+import marshal
+import hashlib
+import posixpath
+import cStringIO
+import ConfigParser
+import multiprocessing
+
+import geometry
+import controls
+import util.anim
+import util.savefile
+
+# Bump when any builder changes, everything is rebuilt
+BUILD_VERSION = 1
+STATE_FILE = '.buildstate'
+
+_png_size = struct.Struct('>II')
+
+class BuildException(Exception):
+    pass
+
+def resolve(name, reference):
+    '''Resource name of a file referenced from another, relative to the
+    referencing file's directory.
+    '''
+    return posixpath.normpath(posixpath.join(posixpath.dirname(name), reference))
+
+def image_size(data):
+    '''Width and height of a PNG, or None for other formats.
+    '''
+    if data[:8] != '\x89PNG\r\n\x1a\n':
+        return None
+    return _png_size.unpack_from(data, 16)
+
+class Context(object):
+    '''What a builder gets to see: the asset and a way to read the files it
+    depends on, which are recorded as it goes.
+    '''
+    def __init__(self, source_dir, name):
+        self.source_dir = source_dir
+        self.name = name
+        self.deps = []
+
+    def read(self, name):
+        if name not in self.deps:
+            self.deps.append(name)
+        filename = os.path.join(self.source_dir, *name.split('/'))
+        if not os.path.exists(filename):
+            raise BuildException('%s references missing file %s' %
+                    (self.name, name))
+        f = open(filename, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+def build_map(context, data):
+    root = ElementTree.fromstring(data)
+    if root.tag != 'map':
+        raise BuildException('root level tag is %s rather than <map>' % root.tag)
+    if root.get('orientation') != 'orthogonal':
+        raise BuildException('map orientation %s not supported' %
+                root.get('orientation'))
+
+    properties = root.find('properties')
+    if properties != None:
+        for p in properties.findall('property'):
+            if p.get('name') == 'physics':
+                context.read(resolve(context.name, p.get('value')))
+
+    # Same tile count as tiled.load_tileset comes up with
+    tiles = 0
+    for tag in root.findall('tileset'):
+        tile_width = int(tag.get('tilewidth'))
+        tile_height = int(tag.get('tileheight'))
+        spacing = int(tag.get('spacing', 0))
+        margin = int(tag.get('margin', 0))
+        image = tag.find('image')
+        if image == None:
+            raise BuildException('tileset %s has no image' % tag.get('name'))
+        size = image_size(context.read(resolve(context.name, image.get('source'))))
+        if size != None and size != (int(image.get('width')), int(image.get('height'))):
+            raise BuildException('tileset %s image is %dx%d, the map says %sx%s' %
+                    ((tag.get('name'),) + size + (image.get('width'), image.get('height'))))
+        image_width = int(image.get('width'))
+        image_height = int(image.get('height'))
+        rows = len(range(margin, image_height - tile_height - spacing,
+            tile_height + spacing))
+        columns = len(range(margin, image_width - spacing, tile_width + spacing))
+        tiles += rows * columns
+
+    for tag in root.findall('layer'):
+        child = tag.find('data')
+        if child == None or child.get('encoding') != 'base64' or \
+                child.get('compression') != 'zlib':
+            raise BuildException('layer %s must be base64 and zlib encoded' %
+                    tag.get('name'))
+        gids = array.array('I', zlib.decompress(base64.b64decode(child.text)))
+        if len(gids) != int(tag.get('width')) * int(tag.get('height')):
+            raise BuildException('layer %s has %d tiles, expected %sx%s' %
+                    (tag.get('name'), len(gids), tag.get('width'), tag.get('height')))
+        if gids and max(gids) > tiles:
+            raise BuildException('layer %s uses tile %d, the tilesets have %d' %
+                    (tag.get('name'), max(gids), tiles))
+
+    return data
+
+def build_geometry(context, data):
+    polygons = []
+    for n, vertices in enumerate(geometry.parse_polygons(data, context.name)):
+        hull = geometry.convex_hull(vertices)
+        if len(hull) < 3 or geometry.is_degenerate(hull):
+            raise BuildException('polygon %d is degenerate' % n)
+        # Chipmunk only collides convex polygons. Building the hull of a
+        # concave one would fill in its dents without a word.
+        if not geometry.is_convex(vertices):
+            raise BuildException('polygon %d is not convex' % n)
+        polygons.append(hull)
+    polygons.sort(key=geometry.polygon_key)
+    return geometry.polygons_to_binary(polygons)
+
+def build_animset(context, data):
+    definition = util.anim.parse_animset_data(data)
+    size = image_size(context.read(definition.image))
+
+    for name, (duration, frames) in definition.anims.iteritems():
+        if duration <= 0:
+            raise BuildException('animation %s has duration %g' % (name, duration))
+        if not frames:
+            raise BuildException('animation %s has no frames' % name)
+        if size != None:
+            count = (size[0] / definition.tile_width) * \
+                    (size[1] / definition.tile_height)
+            if max(frames) >= count:
+                raise BuildException('animation %s uses frame %d, %s has %d' %
+                        (name, max(frames), definition.image, count))
+
+    return definition.to_string()
+
+def build_config(context, data):
+    config = ConfigParser.RawConfigParser()
+    config.readfp(cStringIO.StringIO(data), context.name)
+    try:
+        controls.compile_controls(config)
+    except (controls.ControlsException, ConfigParser.Error), e:
+        raise BuildException(str(e))
+    return data
+
+def build_image(context, data):
+    if data[:8] != '\x89PNG\r\n\x1a\n' and data[:2] != '\xff\xd8':
+        raise BuildException('not a PNG or JPEG image')
+    return data
+
+def build_xml(context, data):
+    root = ElementTree.fromstring(data).tag
+    if root == 'physics':
+        return build_geometry(context, data)
+    elif root == 'animset':
+        return build_animset(context, data)
+    raise BuildException('unknown XML asset <%s>' % root)
+
+def copy(context, data):
+    return data
+
+BUILDERS = {
+    '.tmx': build_map,
+    '.xml': build_xml,
+    '.conf': build_config,
+    '.png': build_image,
+    '.jpg': build_image,
+}
+
+def build_asset(job):
+    '''Builds one asset. Runs in a pool worker, so it returns errors instead
+    of raising them.
+    '''
+    source_dir, name = job
+    context = Context(source_dir, name)
+    builder = BUILDERS.get(posixpath.splitext(name)[1].lower(), copy)
+    try:
+        f = open(os.path.join(source_dir, *name.split('/')), 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        return name, builder(context, data), context.deps, None
+    except Exception, e:
+        return name, None, context.deps, '%s: %s' % (e.__class__.__name__, e)
+
+class BuildReport(object):
+    def __init__(self):
+        self.built = []
+        self.skipped = 0
+        self.removed = []
+        # (name, message)
+        self.errors = []
+        # name -> names it depends on
+        self.graph = {}
+        self.elapsed = 0.0
+
+    def __str__(self):
+        lines = ['%d built, %d up to date, %d removed, %d failed in %.2f s' %
+                (len(self.built), self.skipped, len(self.removed),
+                 len(self.errors), self.elapsed)]
+        for name, message in self.errors:
+            lines.append('  %s: %s' % (name, message))
+        return '\n'.join(lines)
+
+def walk(source_dir):
+    names = []
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        prefix = os.path.relpath(dirpath, source_dir).replace(os.sep, '/')
+        for filename in filenames:
+            if filename.startswith('.') or filename.endswith('.journal'):
+                continue
+            names.append(filename if prefix == '.' else prefix + '/' + filename)
+    return names
+
+def load_state(filename):
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return None
+    try:
+        state = marshal.loads(f.read())
+    except (EOFError, ValueError, TypeError):
+        return None
+    finally:
+        f.close()
+    if state.get('version') != BUILD_VERSION:
+        return None
+    return state
+
+def digest_files(source_dir, names, stats):
+    '''sha1 of every file, reusing the last one for files whose size and
+    mtime didn't change. stats maps name to (mtime, size, digest) and is
+    updated in place.
+    '''
+    digests = {}
+    for name in names:
+        filename = os.path.join(source_dir, *name.split('/'))
+        st = os.stat(filename)
+        known = stats.get(name)
+        if known != None and known[0] == st.st_mtime and known[1] == st.st_size:
+            digests[name] = known[2]
+            continue
+
+        f = open(filename, 'rb')
+        try:
+            digest = hashlib.sha1(f.read()).digest()
+        finally:
+            f.close()
+        stats[name] = (st.st_mtime, st.st_size, digest)
+        digests[name] = digest
+    return digests
+
+def build(source_dir, output_dir, processes=None, force=False):
+    '''Builds every asset in source_dir that is out of date in output_dir.
+    '''
+    start = time.time()
+    report = BuildReport()
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    state_file = os.path.join(output_dir, STATE_FILE)
+    state = None if force else load_state(state_file)
+    if state == None:
+        state = {'version': BUILD_VERSION, 'stats': {}, 'assets': {}}
+    assets = state['assets']
+
+    names = walk(source_dir)
+    digests = digest_files(source_dir, names, state['stats'])
+
+    # Out of date if the source, anything it read or the output changed
+    jobs = []
+    for name in names:
+        record = assets.get(name)
+        if record != None and record['digest'] == digests[name] and \
+                os.path.exists(os.path.join(output_dir, *name.split('/'))) and \
+                all(digests.get(dep) == d for dep, d in record['deps'].iteritems()):
+            report.skipped += 1
+            report.graph[name] = sorted(record['deps'])
+            continue
+        jobs.append((source_dir, name))
+
+    if len(jobs) > 1 and processes != 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(build_asset, jobs, max(1, len(jobs) / 32))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(build_asset, jobs)
+
+    for name, output, deps, error in results:
+        report.graph[name] = sorted(deps)
+        if error != None:
+            report.errors.append((name, error))
+            assets.pop(name, None)
+            continue
+
+        filename = os.path.join(output_dir, *name.split('/'))
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        util.savefile.atomic_write(filename, output)
+        assets[name] = {'digest': digests[name],
+                'deps': dict((dep, digests.get(dep)) for dep in deps)}
+        report.built.append(name)
+
+    for name in set(assets) - set(names):
+        del assets[name]
+        filename = os.path.join(output_dir, *name.split('/'))
+        if os.path.exists(filename):
+            os.remove(filename)
+        report.removed.append(name)
+    for name in set(state['stats']) - set(names):
+        del state['stats'][name]
+
+    util.savefile.atomic_write(state_file, marshal.dumps(state))
+    report.built.sort()
+    report.errors.sort()
+    report.elapsed = time.time() - start
+    return report
@@ -0,0 +1,168 @@
+'''Broadphase tuning for the physics space.
+Chipmunk finds candidate collision pairs through a spatial index. Chipmunk 6
+defaults to a bounding box tree and can switch to a spatial hash; Chipmunk 5
+only has spatial hashes, with a default cell size of 100 pixels. Not every
+pymunk lets the index be changed: 3.x and 4.x wrap Chipmunk 6 without
+use_spatial_hash, so their spaces always use the tree. A hash is
+fastest when its cells are about the size of the shapes in it and there are
+around ten buckets per shape, a tree does better when shape sizes vary a
+lot or there are few of them.
+choose looks at the static geometry and at the size distribution of the
+dynamic shapes and picks a configuration. It only looks at the shapes, never
+at timings, so the same level and actors always get the same broadphase and
+replays stay deterministic. measure times a set of candidates for the
+diagnostic in bench.py.
+'''
+
+import time
+
+# Use a hash with at least this many dynamic shapes...
+HASH_MIN_SHAPES = 200
+# ...whose sizes are within this factor of each other (90th / 10th percentile)
+HASH_MAX_SPREAD = 4.0
+# Buckets per shape
+BUCKETS_PER_SHAPE = 10
+MIN_BUCKETS = 1000
+
+class Broadphase(object):
+    '''One broadphase configuration. kind is 'tree' or 'hash'. Chipmunk 5
+    hashes have separate static and dynamic cell sizes.
+    '''
+    def __init__(self, kind, dim=None, count=None, static_dim=None,
+            static_count=None):
+        self.kind = kind
+        self.dim = dim
+        self.count = count
+        self.static_dim = static_dim
+        self.static_count = static_count
+
+    def __eq__(self, other):
+        return isinstance(other, Broadphase) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        if self.kind == 'tree':
+            return 'tree'
+        text = 'hash dim %.0f count %d' % (self.dim, self.count)
+        if self.static_dim != None:
+            text += ', static hash dim %.0f count %d' % (self.static_dim,
+                    self.static_count)
+        return text
+
+    def apply(self, space):
+        '''Configures the space. Returns False if this pymunk has no call for
+        it, the space keeps its default then.
+        '''
+        if hasattr(space, 'use_spatial_hash'):
+            # Chipmunk 6. The tree is only the default, there's no call to
+            # go back to it, so switching back needs a new space.
+            if self.kind == 'hash':
+                space.use_spatial_hash(self.dim, self.count)
+            return True
+        if self.kind == 'tree':
+            # Chipmunk 6 without the call still has the tree by default
+            return has_tree(space)
+        if not hasattr(space, 'resize_active_hash'):
+            return False
+        space.resize_active_hash(self.dim, self.count)
+        if hasattr(space, 'resize_static_hash'):
+            space.resize_static_hash(self.static_dim, self.static_count)
+        if hasattr(space, 'rehash_static'):
+            space.rehash_static()
+        return True
+
+def has_tree(space):
+    '''Whether the space is Chipmunk 6, which has the tree. Chipmunk 5
+    spaces have resize_active_hash instead.
+    '''
+    return not hasattr(space, 'resize_active_hash')
+
+def configurable(space):
+    '''Whether this pymunk can change the broadphase at all.
+    '''
+    return hasattr(space, 'use_spatial_hash') or \
+            hasattr(space, 'resize_active_hash')
+
+def default(space):
+    '''The broadphase a space starts with.
+    '''
+    if has_tree(space):
+        return Broadphase('tree')
+    return Broadphase('hash', 100.0, 1000, 100.0, 1000)
+
+def shape_sizes(shapes):
+    '''Largest bounding box side of every shape.
+    '''
+    sizes = []
+    for shape in shapes:
+        bb = shape.cache_bb()
+        sizes.append(max(bb.right - bb.left, bb.top - bb.bottom))
+    return sizes
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def hash_dim(sizes, default=100.0):
+    '''Cell size for a set of shapes: the median shape size.
+    '''
+    if not sizes:
+        return default
+    return max(1.0, percentile(sizes, 0.5))
+
+def hash_count(shape_count):
+    return max(MIN_BUCKETS, shape_count * BUCKETS_PER_SHAPE)
+
+def choose(static_sizes, dynamic_sizes, tree=True):
+    '''Picks a broadphase for the given static and dynamic shape sizes.
+    '''
+    if tree:
+        if len(dynamic_sizes) >= HASH_MIN_SHAPES and \
+                percentile(dynamic_sizes, 0.9) <= \
+                percentile(dynamic_sizes, 0.1) * HASH_MAX_SPREAD:
+            # Static shapes share the hash, count them too
+            return Broadphase('hash', hash_dim(dynamic_sizes),
+                    hash_count(len(dynamic_sizes) + len(static_sizes)))
+        return Broadphase('tree')
+
+    return Broadphase('hash', hash_dim(dynamic_sizes),
+            hash_count(len(dynamic_sizes)), hash_dim(static_sizes),
+            hash_count(len(static_sizes)))
+
+def candidates(chosen, static_sizes, dynamic_sizes, tree=True):
+    '''Configurations worth comparing against the chosen one: the tree if
+    there is one, and hashes with half and double the cell size.
+    '''
+    dim = hash_dim(dynamic_sizes)
+    count = hash_count(len(dynamic_sizes) + len(static_sizes))
+    found = [chosen]
+    options = [Broadphase('hash', dim * 0.5, count), Broadphase('hash', dim, count),
+            Broadphase('hash', dim * 2.0, count)]
+    if tree:
+        options.insert(0, Broadphase('tree'))
+    else:
+        for option in options:
+            option.static_dim = hash_dim(static_sizes)
+            option.static_count = hash_count(len(static_sizes))
+    for option in options:
+        if option not in found:
+            found.append(option)
+    return found
+
+def measure(build, configs, ticks=120, warmup=30):
+    '''Times ticks steps for each configuration. build is called with a
+    configuration and returns a fresh simulation using it. Returns a list of
+    (config, mean seconds per step).
+    '''
+    results = []
+    for config in configs:
+        sim = build(config)
+        for i in range(warmup):
+            sim.step()
+        start = time.time()
+        for i in range(ticks):
+            sim.step()
+        results.append((config, (time.time() - start) / ticks))
+    return results
@@ -4,7 +4,8 @@ import weakref
 import math
 
 import debug
-import game
+import kinematic
+import perception
 from actor.component import Component
 
 class SpriteComponent(Component):
@@ -15,7 +16,7 @@ class SpriteComponent(Component):
 
     def on_refresh(self):
         self.physics = self.owner.require('physics')
-        self.physics.push_handlers(self)
+        self.physics.connect(self)
 
     def on_move(self, x, y, rel_x, rel_y):
         # Avoid not-a-number errors
@@ -34,17 +35,41 @@ class SpriteComponent(Component):
 
 class AnimComponent(SpriteComponent):
     '''Graphics component that displays an animated sprite.
+    Frames are advanced by an AnimationClock when one is assigned to the
+    clock attribute (ActorLayer does that), otherwise by pyglet itself.
     '''
     def __init__(self, anims):
-        super(AnimComponent, self).__init__(cocos.sprite.Sprite(anims['stand_south']))
+        first_frame = anims['stand_south'].frames[0].image
+        super(AnimComponent, self).__init__(cocos.sprite.Sprite(first_frame))
         # Offset the sprite from the actor's hitbox
         self.anims = anims
         self.walking = False
         self.direction = 'south'
+        self.animation = 'stand_south'
+        self.clock = None
 
     def update_animation(self):
         prefix = 'walk_' if self.walking else 'stand_'
-        self.sprite.image = self.anims[prefix + self.direction]
+        animation = prefix + self.direction
+        if animation == self.animation:
+            return
+
+        self.animation = animation
+        if self.clock != None:
+            self.clock.play(self.sprite, self.anims[animation])
+        else:
+            self.sprite.image = self.anims[animation]
+
+    def reload_animation(self):
+        '''Starts the current animation over after the animset was rebuilt.
+        '''
+        animation = self.anims.get(self.animation)
+        if animation == None:
+            return
+        if self.clock != None:
+            self.clock.play(self.sprite, animation)
+        else:
+            self.sprite.image = animation
 
     def on_direction_changed(self, dx, dy):
         if dx == 0 and dy == 0:
@@ -64,6 +89,11 @@ class AnimComponent(SpriteComponent):
 
 class PhysicsComponent(Component):
     component_type = 'physics'
+    signal_types = ('on_move', 'on_rotate')
+    # Whether the physics may put the body to sleep when it comes to rest
+    can_sleep = True
+    # Moves itself instead of being stepped by the space, see kinematic
+    kinematic = False
 
     def __init__(self, body, objs):
         super(PhysicsComponent, self).__init__()
@@ -72,27 +102,47 @@ class PhysicsComponent(Component):
         self.old_x = 0
         self.old_y = 0
         self.old_angle = 0
+        self.moved = self.signals['on_move']
+        self.rotated = self.signals['on_rotate']
+        # pipeline.TransformBuffer and offset in it, while pipelined
+        self.transforms = None
+        self.slot = None
+        # When it went in the space, see Physics.on_actor_add
+        self.added = 0
 
     def on_refresh(self):
         for shape in self.objs:
             shape.actor = weakref.ref(self.owner)
 
-    def update(self, dt):
+    def transform(self):
+        '''Position and angle of the body. While physics steps on another
+        thread they are the ones from the last finished step.
+        '''
+        if self.transforms != None:
+            transforms = self.transforms
+            front = transforms.front
+            i = self.slot
+            return front[i], front[i + 1], front[i + transforms.angle]
         x, y = self.body.position
+        return x, y, self.body.angle
+
+    def update(self, dt):
+        x, y, angle = self.transform()
 
         if self.old_x != x or self.old_y != y:
-            self.dispatch_event('on_move', x, y, 0, 0)
+            self.moved.emit(x, y, 0, 0)
 
         self.old_x = x
         self.old_y = y
 
-        if self.old_angle != self.body.angle:
-            self.dispatch_event('on_rotate', self.body.angle)
+        if self.old_angle != angle:
+            self.rotated.emit(angle)
 
-        self.old_angle = self.body.angle
+        self.old_angle = angle
 
-PhysicsComponent.register_event_type('on_move')
-PhysicsComponent.register_event_type('on_rotate')
+    def on_sleep(self):
+        # The body may have moved on the step it fell asleep
+        self.update(0)
 
 class CharacterPhysicsComponent(PhysicsComponent):
     '''A physics component for all controllable (via AI or human input) game
@@ -100,6 +150,8 @@ class CharacterPhysicsComponent(PhysicsComponent):
     '''
     DIR_LEFT = 0
     DIR_RIGHT = 1
+    can_sleep = False
+    signal_types = ('on_direction_changed', 'on_land')
 
     def __init__(self, body, objs):
         super(CharacterPhysicsComponent, self).__init__(body, objs)
@@ -109,6 +161,8 @@ class CharacterPhysicsComponent(PhysicsComponent):
         self.air_speed = 1000
         self.jump_force = 3000
         self.jumping = False
+        self.direction_changed = self.signals['on_direction_changed']
+        self.landed = self.signals['on_land']
 
     def move(self, direction):
         self.move_flags[direction] = True
@@ -132,6 +186,13 @@ class CharacterPhysicsComponent(PhysicsComponent):
         self.body.reset_forces()
         self.body.velocity = ((vx, 0)) 
         self.update_forces()
+        self.landed.emit()
+
+    def feet(self):
+        '''Middle of the bottom of the shapes.
+        '''
+        x, y, angle = self.transform()
+        return x, min(shape.cache_bb().bottom for shape in self.objs)
 
     def update_forces(self):
         fx = self.move_flags[self.DIR_RIGHT] - self.move_flags[self.DIR_LEFT]
@@ -140,16 +201,166 @@ class CharacterPhysicsComponent(PhysicsComponent):
             self.body.apply_force((fx * self.air_speed, 0))
         else:
             self.movement_obj.surface_velocity = (fx * self.speed, 0)
-        self.dispatch_event('on_direction_changed', fx, 0)
+        self.direction_changed.emit(fx, 0)
+
+class KinematicCharacterComponent(CharacterPhysicsComponent):
+    '''Character physics that moves a box through the level's collision grid
+    instead of simulating a body, see kinematic. The body is never added to
+    the space, it only holds the position and velocity so snapshots and
+    everything reading positions keep working. Physics hands over the grid
+    when the actor is added.
+    '''
+    kinematic = True
+
+    def __init__(self, body, width, height, offset_y=0):
+        super(KinematicCharacterComponent, self).__init__(body, ())
+        # Box relative to the body position
+        self.width = width
+        self.height = height
+        self.offset_y = offset_y
+        self.grid = None
+        self.grounded = False
+        self.gravity = -900.0
+        self.jump_speed = 300.0
+        # Sideways acceleration in the air
+        self.air_speed = 1000.0
+        self.step_height = 8.0
+        # Layers perception and bullets find it in, it has no shapes to take them from
+        self.layers = 0
+        # What the last step moved from, if it went nowhere, see step
+        self.stuck = None
+
+    def jump(self):
+        if self.grounded:
+            self.jumping = True
+            self.grounded = False
+            self.body.velocity = (self.body.velocity[0], self.jump_speed)
+            self.update_forces()
+
+    def on_jump_land(self):
+        self.jumping = False
+        self.landed.emit()
+
+    def update_forces(self):
+        fx = self.move_flags[self.DIR_RIGHT] - self.move_flags[self.DIR_LEFT]
+        self.direction_changed.emit(fx, 0)
+
+    def transform(self):
+        # Moved on the main thread, never through a pipeline buffer
+        x, y = self.body.position
+        return x, y, 0.0
+
+    def feet(self):
+        x, y = self.body.position
+        return x, y + self.offset_y - self.height / 2.0
+
+    def update(self, dt):
+        if self.grid != None and dt > 0:
+            self.step(dt)
+        super(KinematicCharacterComponent, self).update(dt)
+
+    def step(self, dt):
+        fx = self.move_flags[self.DIR_RIGHT] - self.move_flags[self.DIR_LEFT]
+        vx, vy = self.body.velocity
+        if self.grounded:
+            vx = fx * self.speed
+        else:
+            # Steer towards walking speed
+            change = fx * self.speed - vx
+            limit = self.air_speed * dt
+            vx += max(-limit, min(limit, change))
+        vy += self.gravity * dt
 
-CharacterPhysicsComponent.register_event_type('on_direction_changed')
+        x, y = self.body.position
+        # The move only depends on these. Standing still or walking into a
+        # wall, it goes nowhere again.
+        start = (x, y, vx * dt, vy * dt, self.grounded, self.grid.version)
+        if start == self.stuck:
+            moved_x = moved_y = 0.0
+            grounded = self.grounded
+        else:
+            bottom = y + self.offset_y - self.height / 2.0
+            box = [x - self.width / 2.0, bottom, x + self.width / 2.0,
+                    bottom + self.height]
+            moved_x, moved_y, grounded = kinematic.move(self.grid, box,
+                    vx * dt, vy * dt, self.grounded, self.step_height)
+            if moved_x == 0 and moved_y == 0 and grounded == self.grounded:
+                self.stuck = start
+            else:
+                self.stuck = None
+
+        if abs(moved_x - vx * dt) > kinematic.EPSILON:
+            vx = 0.0
+        if grounded or (vy > 0 and moved_y < vy * dt - kinematic.EPSILON):
+            # Landed, or hit the ceiling
+            vy = 0.0
+        if grounded and not self.grounded:
+            self.on_jump_land()
+        self.grounded = grounded
+        self.body.position = (x + moved_x, y + moved_y)
+        self.body.velocity = (vx, vy)
+
+class PerceptionComponent(Component):
+    '''Asks the simulation's perception.Perception what the actor can see and
+    keeps the latest answers. Answers arrive a tick or more after asking,
+    and fire on_perceived(query). Asking every tick is fine, a question
+    that wasn't answered yet is only updated.
+    '''
+    component_type = 'perception'
+    signal_types = ('on_perceived',)
+
+    def __init__(self, layers, radius=400.0):
+        super(PerceptionComponent, self).__init__()
+        # What to look for and how far
+        self.layers = layers
+        self.radius = radius
+        # perception.Perception, set when the actor is added
+        self.service = None
+        self.physics = None
+        # Latest answers
+        self.visible = {}
+        self.nearest = None
+        self.nearby = []
+        self.perceived = self.signals['on_perceived']
+
+    def on_refresh(self):
+        self.physics = self.owner.require('physics')
+
+    def origin(self):
+        x, y, angle = self.physics.transform()
+        return x, y
+
+    def look_at(self, position, tag=None):
+        '''Checks the line of sight to a point, the answer ends up in
+        visible[tag].
+        '''
+        if self.service != None:
+            self.service.line_of_sight(self, self.origin(), position, tag=tag)
+
+    def find_nearest(self):
+        if self.service != None:
+            self.service.nearest(self, self.origin(), self.radius, self.layers)
+
+    def find_nearby(self):
+        if self.service != None:
+            self.service.in_radius(self, self.origin(), self.radius, self.layers)
+
+    def on_perception(self, query):
+        if query.kind == perception.LINE_OF_SIGHT:
+            self.visible[query.tag] = query.result
+        elif query.kind == perception.NEAREST:
+            self.nearest = query.result
+        else:
+            self.nearby = query.result
+        self.perceived.emit(query)
 
 class InputComponent(Component):
     component_type = 'input'
 
 class PlayerInputComponent(InputComponent):
     '''Allows an actor to be controlled by keyboard/mouse.
-    Input events must be injected from other code.
+    Input events must be injected from other code, preferably as actions
+    drained from a controls.ActionQueue.
     '''
     DIR_LEFT = 0
     DIR_RIGHT = 1
@@ -160,17 +371,28 @@ class PlayerInputComponent(InputComponent):
     def on_refresh(self):
         self.physics = self.owner.require('physics', CharacterPhysicsComponent)
 
+    def on_action(self, action, pressed):
+        if action == 'move_up':
+            if pressed:
+                self.physics.jump()
+        elif action == 'move_left':
+            if pressed:
+                self.physics.move(CharacterPhysicsComponent.DIR_LEFT)
+            else:
+                self.physics.stop_move(CharacterPhysicsComponent.DIR_LEFT)
+        elif action == 'move_right':
+            if pressed:
+                self.physics.move(CharacterPhysicsComponent.DIR_RIGHT)
+            else:
+                self.physics.stop_move(CharacterPhysicsComponent.DIR_RIGHT)
+
     def on_key_press(self, key, modifiers):
-        if key == game.game.config.get_keycode('move_up'):
-            self.physics.jump()
-        if key == game.game.config.get_keycode('move_left'):
-            self.physics.move(CharacterPhysicsComponent.DIR_LEFT)
-        if key == game.game.config.get_keycode('move_right'):
-            self.physics.move(CharacterPhysicsComponent.DIR_RIGHT)
+        # Not imported at the top, headless tools don't need the whole game
+        import game
+        for action in game.game.config.get_controls().get(key, ()):
+            self.on_action(action, True)
 
     def on_key_release(self, key, modifiers):
-        if key == game.game.config.get_keycode('move_left'):
-            self.physics.stop_move(CharacterPhysicsComponent.DIR_LEFT)
-        if key == game.game.config.get_keycode('move_right'):
-            self.physics.stop_move(CharacterPhysicsComponent.DIR_RIGHT)
-
+        import game
+        for action in game.game.config.get_controls().get(key, ()):
+            self.on_action(action, False)
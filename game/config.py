@@ -1,10 +1,21 @@
 import ConfigParser
-import pyglet
+
+import controls
+import util.archive
 
 class GameConfig(ConfigParser.RawConfigParser):
     def __init__(self, filename):
         ConfigParser.RawConfigParser.__init__(self)
-        self.read(filename)
+        self.readfp(util.archive.open_file(filename), filename)
+        self._controls = None
 
     def get_keycode(self, name):
-        return eval("pyglet.window.key." + self.get('Controls', name))
+        return controls.keycode(self.get('Controls', name))
+
+    def get_controls(self):
+        '''Keycode to actions table for the [Controls] section, compiled on
+        first use.
+        '''
+        if self._controls == None:
+            self._controls = controls.compile_controls(self)
+        return self._controls
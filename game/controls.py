@@ -0,0 +1,90 @@
+'''Keyboard input is translated into named actions through a table compiled
+once from the [Controls] section of the config. Actions are buffered in an
+ActionQueue and only applied when the simulation drains the queue at a fixed
+point of its step, so input never lands in the middle of a tick.
+Drained actions can be packed into a compact binary form, which is what
+input recordings are made of.
+'''
+
+import struct
+import pyglet
+
+# Every action that can be bound in [Controls]. The position in this tuple is
+# the action's id in packed form, so only ever append to it.
+ACTIONS = ('move_up', 'move_down', 'move_left', 'move_right', 'use')
+ACTION_IDS = dict((name, i) for i, name in enumerate(ACTIONS))
+
+_header = struct.Struct('<IH')
+_event = struct.Struct('<BB')
+
+class ControlsException(Exception):
+    pass
+
+def keycode(name):
+    '''Looks up a pyglet key symbol by name, such as 'W' or 'SPACE'.
+    '''
+    code = getattr(pyglet.window.key, name.strip().upper(), None)
+    if not isinstance(code, int):
+        raise ControlsException('Unknown key: %s' % name)
+    return code
+
+def compile_controls(config):
+    '''Builds a dict mapping keycodes to the list of actions bound to them.
+    '''
+    table = {}
+    for action, name in config.items('Controls'):
+        if action not in ACTION_IDS:
+            raise ControlsException('Unknown action: %s' % action)
+        table.setdefault(keycode(name), []).append(action)
+    return table
+
+class ActionQueue(object):
+    '''Buffers (action, pressed) events between simulation ticks.
+    '''
+    def __init__(self, controls):
+        self.controls = controls
+        self.pending = []
+
+    def key_press(self, key, modifiers):
+        for action in self.controls.get(key, ()):
+            self.pending.append((action, True))
+        return key in self.controls
+
+    def key_release(self, key, modifiers):
+        for action in self.controls.get(key, ()):
+            self.pending.append((action, False))
+        return key in self.controls
+
+    def push(self, action, pressed):
+        self.pending.append((action, pressed))
+
+    def drain(self):
+        '''Returns the buffered events and empties the queue.
+        '''
+        events = self.pending
+        self.pending = []
+        return events
+
+def pack_actions(tick, events):
+    '''Packs the events drained on one tick into a byte string.
+    '''
+    data = [_header.pack(tick, len(events))]
+    for action, pressed in events:
+        data.append(_event.pack(ACTION_IDS[action], pressed))
+    return ''.join(data)
+
+def unpack_actions(data, offset=0):
+    '''Reverse of pack_actions. Returns the tick, the events and the offset
+    just past them, so packed ticks can be read back to back. Raises
+    ValueError for an action id that isn't one of ACTIONS.
+    '''
+    tick, count = _header.unpack_from(data, offset)
+    offset += _header.size
+    events = []
+    for i in range(count):
+        action, pressed = _event.unpack_from(data, offset)
+        if action >= len(ACTIONS):
+            raise ValueError('Unknown action id %d' % action)
+        events.append((ACTIONS[action], bool(pressed)))
+        offset += _event.size
+    return tick, events, offset
@@ -1,8 +1,34 @@
 '''Really simple debug message printing.
+Also keeps a timeline of startup, printed once the first frame is up.
 '''
 
+import time
+
 DEBUG = True
 
+# Close enough to process start, this is one of the first modules imported
+started = time.time()
+# (label, time) for every mark
+timeline = []
+
 def msg(text):
     if DEBUG:
         print 'DEBUG: ', text
+
+def mark(label):
+    '''Records the end of a startup step.
+    '''
+    timeline.append((label, time.time()))
+
+def print_timeline():
+    '''Prints how long each startup step took since the previous one, and
+    forgets them.
+    '''
+    if DEBUG and timeline:
+        print 'DEBUG:  Startup timeline'
+        last = started
+        for label, t in timeline:
+            print '    %8.1f ms %+8.1f ms  %s' % ((t - started) * 1000,
+                    (t - last) * 1000, label)
+            last = t
+    del timeline[:]
@@ -2,10 +2,7 @@
 interactive editing of collision data.
 '''
 
-try:
-    from xml.etree import ElementTree
-except ImportError:
-    import elementtree.ElementTree as ElementTree
+import os
 
 import pyglet
 from pyglet.gl import *
@@ -14,6 +11,8 @@ import pymunk
 
 import debug
 import util.resource
+import util.savefile
+import geometry
 import physics
 
 class Polygon(cocos.cocosnode.CocosNode):
@@ -22,6 +21,8 @@ class Polygon(cocos.cocosnode.CocosNode):
         self.vertices = list(vertices)
         self.make_convex()
         self.color = (1.0, 1.0, 1.0, 1.0)
+        # Key of this polygon as it was last written to disk, if ever
+        self.saved = None
 
     def add_vertex(self, point):
         self.vertices.append(point)
@@ -42,8 +43,79 @@ class Polygon(cocos.cocosnode.CocosNode):
         glEnd()
         glPopMatrix()
 
+def line_loop_vertices(vertices):
+    '''Converts a closed polygon outline into flat GL_LINES vertex data.
+    GL_LINE_LOOP primitives can't share a vertex list, so every edge becomes
+    its own pair of points.
+    '''
+    data = []
+    count = len(vertices)
+    if count < 2:
+        return data
+
+    for i in range(count):
+        x1, y1 = vertices[i]
+        x2, y2 = vertices[(i + 1) % count]
+        data.extend((x1, y1, x2, y2))
+    return data
+
+class PolygonBatch(cocos.cocosnode.CocosNode):
+    '''Draws every committed polygon from a single pyglet batch. Vertex lists
+    are only touched when a polygon is added, changed or removed, so a frame
+    costs one batch draw no matter how many polygons there are.
+    '''
+    def __init__(self, color=(1.0, 1.0, 1.0, 1.0)):
+        super(PolygonBatch, self).__init__()
+        self.color = color
+        self.batch = pyglet.graphics.Batch()
+        self.vertex_lists = {}
+
+    def __contains__(self, polygon):
+        return polygon in self.vertex_lists
+
+    def __len__(self):
+        return len(self.vertex_lists)
+
+    def add(self, polygon):
+        '''Adds a polygon to the batch, or refreshes its vertex data if it is
+        already there.
+        '''
+        data = line_loop_vertices(polygon.vertices)
+        count = len(data) / 2
+        vertex_list = self.vertex_lists.get(polygon)
+
+        if vertex_list != None and vertex_list.get_size() != count:
+            vertex_list.delete()
+            vertex_list = None
+
+        if vertex_list == None:
+            vertex_list = self.batch.add(count, GL_LINES, None, 'v2f', 'c4f')
+            vertex_list.colors[:] = self.color * count
+            self.vertex_lists[polygon] = vertex_list
+
+        vertex_list.vertices[:] = data
+
+    def remove(self, polygon):
+        vertex_list = self.vertex_lists.pop(polygon, None)
+        if vertex_list != None:
+            vertex_list.delete()
+
+    def get_vertices(self, polygon):
+        '''Returns the flat vertex data currently stored for a polygon.
+        '''
+        return list(self.vertex_lists[polygon].vertices)
+
+    def draw(self):
+        glPushMatrix()
+        self.transform()
+        glLineWidth(3.0)
+        self.batch.draw()
+        glPopMatrix()
+
 class EditorLayer(cocos.layer.Layer):
     is_event_handler = True
+    # Seconds between journal appends of unsaved changes
+    autosave_interval = 30.0
 
     def __init__(self):
         debug.msg('Initializing editor')
@@ -56,6 +128,11 @@ class EditorLayer(cocos.layer.Layer):
         self.shape2poly = {}
         self.active_color = (1.0, 0.0, 0.0, 1.0)
         self.inactive_color = (1.0, 1.0, 1.0, 1.0)
+        # Polygons changed since the last save or autosave, mapped to the key
+        # they had on disk at that point
+        self.dirty = {}
+        # Level files are written on a background thread
+        self.writer = util.savefile.BackgroundWriter()
     
     def on_enter(self):
         super(EditorLayer, self).on_enter()
@@ -65,16 +142,27 @@ class EditorLayer(cocos.layer.Layer):
         self.polygon_layer = cocos.layer.ScrollableLayer()
         self.parent.scroller.add(self.polygon_layer, z=5)
 
+        # Committed polygons are drawn in one batch, only the polygon being
+        # edited is a node of its own
+        self.polygon_batch = PolygonBatch(self.inactive_color)
+        self.polygon_layer.add(self.polygon_batch)
+
         # Capture key state for easy movement handling
         self.keys = pyglet.window.key.KeyStateHandler()
         cocos.director.director.window.push_handlers(self.keys)
 
+        self.schedule_interval(self.autosave, self.autosave_interval)
+
     def on_exit(self):
         super(EditorLayer, self).on_exit()
 
+        self.unschedule(self.autosave)
         self.parent.remove_handlers(self)
         cocos.director.director.window.remove_handlers(self.keys)
 
+        # Don't leave with a save still in flight
+        self.writer.flush()
+
     def on_map_load(self):
         self.physics = self.parent.physics
         self.populate()
@@ -83,10 +171,12 @@ class EditorLayer(cocos.layer.Layer):
         if key == pyglet.window.key.S and modifiers & pyglet.window.key.MOD_CTRL:
             self.save()
             return True
+        elif key == pyglet.window.key.O and modifiers & pyglet.window.key.MOD_CTRL:
+            self.optimize()
+            return True
         elif key == pyglet.window.key.DELETE:
             # Delete selected polygon
             self.delete_polygon(self.polygon)
-            self.polygon = None
 
     def on_mouse_release(self, x, y, button, modifiers):
         x, y = self.parent.scroller.pixel_from_screen(x, y)
@@ -95,9 +185,7 @@ class EditorLayer(cocos.layer.Layer):
             if modifiers & pyglet.window.key.MOD_CTRL:
                 # Make a new polygon if need be
                 if self.polygon == None:
-                    self.polygon = Polygon()
-                    self.polygon.color = self.active_color
-                    self.polygon_layer.add(self.polygon)
+                    self.activate_polygon(Polygon())
 
                 # Add vertex to polygon
                 self.polygon.add_vertex((x, y))
@@ -110,8 +198,7 @@ class EditorLayer(cocos.layer.Layer):
                         self.commit_polygon()
 
                     if shape in self.shape2poly:
-                        self.polygon = self.shape2poly[shape]
-                        self.polygon.color = self.active_color
+                        self.activate_polygon(self.shape2poly[shape])
                 else:
                     if self.polygon != None:
                         self.commit_polygon()
@@ -127,8 +214,8 @@ class EditorLayer(cocos.layer.Layer):
         elif button == pyglet.window.mouse.MIDDLE:
             # Select and delete polygon
             shape = self.physics.space.point_query_first((x, y))
-            if shape != None:
-                self.delete_polygon(shape)
+            if shape in self.shape2poly:
+                self.delete_polygon(self.shape2poly[shape])
 
     def _step(self, dt):
         # Scroll map with WASD
@@ -138,72 +225,205 @@ class EditorLayer(cocos.layer.Layer):
         scroller = self.parent.scroller
         scroller.set_focus(scroller.fx + dx, scroller.fy + dy)
 
-    def delete_polygon(self, polygon):
+    def activate_polygon(self, polygon):
+        '''Makes the given polygon the one being edited. It is pulled out of
+        the batch and drawn on its own until it is committed.
+        '''
+        self.polygon_batch.remove(polygon)
+        polygon.color = self.active_color
+        self.polygon_layer.add(polygon)
+        self.polygon = polygon
+
+    def mark_dirty(self, polygon):
+        if polygon not in self.dirty:
+            self.dirty[polygon] = polygon.saved
+
+    def geometry_changed(self, shapes):
+        '''Keeps the collision grid and the navigation graphs up to date.
+        '''
+        self.parent.simulation.static_geometry_changed(shapes)
+
+    def delete_polygon(self, polygon, notify=True):
+        if polygon == None:
+            return
+
+        self.mark_dirty(polygon)
+
+        if polygon is self.polygon:
+            self.polygon_layer.remove(polygon)
+            self.polygon = None
+
+        self.polygon_batch.remove(polygon)
+
         if polygon in self.poly2shape:
             debug.msg('Deleting polygon')
             shape = self.poly2shape[polygon]
             del self.poly2shape[polygon]
             del self.shape2poly[shape]
-            self.polygon_layer.remove(polygon)
             self.physics.space.remove(shape)
+            if notify:
+                self.geometry_changed([shape])
 
     def commit_polygon(self):
         debug.msg('Committing polygon')
+        self.mark_dirty(self.polygon)
+        changed = []
 
         if self.polygon in self.poly2shape:
             shape = self.poly2shape[self.polygon]
             del self.poly2shape[self.polygon]
             del self.shape2poly[shape]
             self.physics.space.remove(shape)
+            changed.append(shape)
          
         self.polygon.color = self.inactive_color
+        self.polygon_layer.remove(self.polygon)
+        self.polygon_batch.add(self.polygon)
         # Add to physics space
         shape = physics.make_static_polygon(self.polygon.vertices)
         self.poly2shape[self.polygon] = shape
         self.shape2poly[shape] = self.polygon
         self.physics.space.add(shape)
+        changed.append(shape)
+        self.geometry_changed(changed)
         # Polygon committed. Let user make a new one.
         self.polygon = None
 
+    def polygon_from_shape(self, shape):
+        polygon = Polygon()
+        for p in physics.polygon_points(shape):
+            polygon.add_vertex((p.x, p.y))
+        polygon.saved = geometry.polygon_key(polygon.vertices)
+        return polygon
+
     def populate(self):
         debug.msg('Populating physics editor')
         for shape in self.physics.space.shapes:
-            if shape.collision_type != physics.COLLTYPE_STATIC:
-                continue
-
-            if isinstance(shape, pymunk.Poly):
-                polygon = Polygon()
-                for p in shape.get_points():
-                    polygon.add_vertex((p.x, p.y))
-                self.polygon_layer.add(polygon)
+            if physics.is_level_geometry(shape):
+                polygon = self.polygon_from_shape(shape)
+                self.polygon_batch.add(polygon)
                 self.poly2shape[polygon] = shape
                 self.shape2poly[shape] = polygon
 
-    def save(self):
-        debug.msg('Saving level geometry')
-
-        builder = ElementTree.TreeBuilder()
-
-        builder.start('physics', {'name': 'physics'})
+    def on_geometry_changed(self, removed, added):
+        '''Follows a hot reload of the level geometry. Unsaved edits win over
+        the file: a reload never takes away a dirty polygon or brings back
+        one that was deleted since the last save.
+        '''
+        deleted = set(key for polygon, key in self.dirty.iteritems()
+                if polygon not in self.poly2shape)
+        # Shapes put back or taken out again, the grid was built without them
+        restored = []
+
+        for shape in removed:
+            polygon = self.shape2poly.get(shape)
+            if polygon == None:
+                continue
+            if polygon in self.dirty:
+                self.physics.space.add(shape)
+                restored.append(shape)
+                continue
+            if polygon is self.polygon:
+                self.polygon_layer.remove(polygon)
+                self.polygon = None
+            self.polygon_batch.remove(polygon)
+            del self.poly2shape[polygon]
+            del self.shape2poly[shape]
 
-        for shape in self.physics.space.shapes:
-            if shape.collision_type != physics.COLLTYPE_STATIC:
+        for shape in added:
+            polygon = self.polygon_from_shape(shape)
+            if polygon.saved in deleted:
+                self.physics.space.remove(shape)
+                restored.append(shape)
                 continue
+            self.polygon_batch.add(polygon)
+            self.poly2shape[polygon] = shape
+            self.shape2poly[shape] = polygon
+
+        if restored:
+            self.geometry_changed(restored)
+
+    def optimize(self):
+        '''Runs the geometry optimizer over all committed polygons and replaces
+        them with the result. The level file is not touched until the next
+        save.
+        '''
+        if self.polygon != None:
+            self.commit_polygon()
+
+        polygons = self.poly2shape.keys()
+        optimized, report = geometry.optimize([p.vertices for p in polygons])
+        debug.msg('Optimized level geometry: %s' % report)
+
+        # The grid and graphs are only updated once, at the end
+        changed = self.poly2shape.values()
+        for polygon in polygons:
+            self.delete_polygon(polygon, notify=False)
+
+        for vertices in optimized:
+            polygon = Polygon(vertices)
+            self.mark_dirty(polygon)
+            shape = physics.make_static_polygon(polygon.vertices)
+            self.poly2shape[polygon] = shape
+            self.shape2poly[shape] = polygon
+            self.physics.space.add(shape)
+            self.polygon_batch.add(polygon)
+            changed.append(shape)
+        self.geometry_changed(changed)
+
+    def filename(self):
+        return util.resource.file_path(self.parent.tiledmap.properties['physics'])
+
+    def committed_vertices(self, polygon):
+        '''Vertices of the polygon as last committed to the physics space.
+        The polygon itself may be mid-edit.
+        '''
+        shape = self.poly2shape[polygon]
+        return [(int(v.x), int(v.y)) for v in physics.polygon_points(shape)]
 
-            if isinstance(shape, pymunk.Poly):
-                builder.start('polygon', {})
+    def save(self):
+        '''Snapshots all committed polygons and writes the whole level file
+        on the writer thread.
+        '''
+        debug.msg('Saving level geometry')
 
-                for v in shape.get_points():
-                    x = str(int(v.x))
-                    y = str(int(v.y))
-                    builder.start('vertex', {'x': x, 'y': y})
-                    builder.end('vertex')
+        polygons = []
+        for polygon in self.poly2shape:
+            vertices = self.committed_vertices(polygon)
+            polygon.saved = geometry.polygon_key(vertices)
+            polygons.append(vertices)
+        # Keep the file stable between saves
+        polygons.sort(key=geometry.polygon_key)
+        self.dirty.clear()
+
+        self.writer.submit(geometry.save_polygons, self.filename(), polygons)
+
+    def autosave(self, dt=0):
+        '''Appends the polygons changed since the last save to the level's
+        journal instead of rewriting the whole file.
+        '''
+        if not self.dirty:
+            return
+        if not os.path.exists(self.filename()):
+            # Still only in the archive, the journal needs a loose file to
+            # go with
+            self.save()
+            return
 
-                builder.end('polygon')
+        debug.msg('Autosaving %d changed polygons' % len(self.dirty))
 
-        builder.end('physics')
+        removed = []
+        added = []
+        for polygon, key in self.dirty.items():
+            if key != None:
+                removed.append(key)
 
-        tree = ElementTree.ElementTree(builder.close())
-        filename = util.resource.path(self.parent.tiledmap.properties['physics'])
-        tree.write(filename)
+            polygon.saved = None
+            if polygon in self.poly2shape:
+                vertices = self.committed_vertices(polygon)
+                polygon.saved = geometry.polygon_key(vertices)
+                added.append(vertices)
+        self.dirty.clear()
 
+        self.writer.submit(geometry.append_journal, self.filename(), removed,
+                added)
@@ -7,8 +7,11 @@ import debug
 import config
 import util.resource
 import gamescene
-import editor
 import gameplay
+import actors
+# The editor is imported when it's enabled, see Game.run
+
+debug.mark('Imports')
 
 class Game(object):
     '''Wraps up all of the game content into one class.
@@ -18,10 +21,10 @@ class Game(object):
 
         self.config = None
 
-        # Add paths for pyglet to use for resources
-        pyglet.resource.path.append('data/')
-        pyglet.resource.path.append('data/maps/')
-        pyglet.resource.reindex()
+        # Add paths for pyglet to use for resources. The index comes from a
+        # manifest instead of walking data/ every time.
+        util.resource.init(loose=debug.DEBUG)
+        debug.mark('Resource index')
 
     def load_config(self, filename):
         debug.msg('Loading configuration')
@@ -32,6 +35,7 @@ class Game(object):
 
         # Load configuration file
         self.load_config(util.resource.path('game.conf'))
+        debug.mark('Configuration')
 
         # Create window
         debug.msg('Creating window')
@@ -40,13 +44,27 @@ class Game(object):
                 do_not_scale=True, resizable=True, 
                 fullscreen=self.config.getboolean('Graphics', 'fullscreen'))
         director.show_FPS = True
+        debug.mark('Window')
 
         debug.msg('Chipmunk version ' + pymunk.chipmunk_version)
         debug.msg('Pymunk version ' + pymunk.version)
         # Run game scene
         scene = gamescene.GameScene()
-        #scene.add(editor.EditorLayer(), z=1)
-        scene.add(gameplay.GameplayLayer(), z=1)
+        if self.config.has_option('Debug', 'editor') and \
+                self.config.getboolean('Debug', 'editor'):
+            # The editor changes the space whenever it likes, so no
+            # pipelined physics
+            import editor
+            scene.editor = editor.EditorLayer()
+            scene.add(scene.editor, z=1)
+        else:
+            scene.add(gameplay.GameplayLayer(), z=1)
+            scene.pipelined = self.config.has_option('Physics', 'pipelined') and \
+                    self.config.getboolean('Physics', 'pipelined')
+
+        if self.config.has_option('Physics', 'character') and \
+                self.config.get('Physics', 'character') == 'kinematic':
+            scene.player_class = actors.KinematicPlayer
 
         debug.msg('Starting game director')
         director.run(scene)
@@ -2,19 +2,28 @@
 all the necessary things for controlling the player in GameScene.
 '''
 
+import pyglet
 import cocos
 import math
 
 import debug
+import recording
+import snapshot
 
 class GameplayLayer(cocos.layer.Layer):
     is_event_handler = True
+    # F5 starts and stops recording input to this file
+    recording_filename = 'recording.rpl'
 
     def __init__(self):
         debug.msg('Initializing gameplay layer')
 
         super(GameplayLayer, self).__init__()
 
+        # F6 quick-saves into memory, F7 restores
+        self.snapshotter = None
+        self.quicksave = None
+
     def on_enter(self):
         super(GameplayLayer, self).on_enter()
 
@@ -26,15 +35,40 @@ class GameplayLayer(cocos.layer.Layer):
         self.parent.remove_handlers(self)
 
     def on_key_press(self, key, modifiers):
-        player_input = self.parent.player.get_component('input')
-        player_input.on_key_press(key, modifiers)
+        if key == pyglet.window.key.F5:
+            self.toggle_recording()
+            return True
+        elif key == pyglet.window.key.F6:
+            self.parent.simulation.sync()
+            self.snapshotter = snapshot.Snapshotter(self.parent.simulation)
+            self.quicksave = self.snapshotter.take()
+            debug.msg('Quick-saved tick %d' % self.quicksave.tick)
+            return True
+        elif key == pyglet.window.key.F7:
+            if self.quicksave != None:
+                self.parent.simulation.sync()
+                self.snapshotter.restore(self.quicksave)
+                debug.msg('Restored tick %d' % self.quicksave.tick)
+            return True
+
+        # Buffered until the scene's next step
+        return self.parent.input.key_press(key, modifiers)
 
     def on_key_release(self, key, modifiers):
-        player_input = self.parent.player.get_component('input')
-        player_input.on_key_release(key, modifiers)
+        return self.parent.input.key_release(key, modifiers)
+
+    def toggle_recording(self):
+        simulation = self.parent.simulation
+        simulation.sync()
+        if simulation.recorder == None:
+            debug.msg('Recording input')
+            simulation.recorder = recording.Recorder(simulation)
+        else:
+            simulation.recorder.save(self.recording_filename)
+            simulation.recorder = None
 
     def _step(self, dt):
-        x, y = self.parent.player.get_component('physics').body.position
+        x, y, angle = self.parent.player.get_component('physics').transform()
 
         # Avoid not-a-number exception
         if math.isnan(x) or math.isnan(y):
@@ -3,11 +3,20 @@ import cocos
 import pymunk
 
 import debug
+import game
+import controls
 import tiled.tiled
+import util.archive
+import util.atlas
 import util.resource
+import util.texcache
 import actorlayer
 import actors
 import physics
+import particles
+import memory
+import simulation
+import hotreload
 
 class GameScene(cocos.scene.Scene, pyglet.event.EventDispatcher):
     def __init__(self):
@@ -18,62 +27,123 @@ class GameScene(cocos.scene.Scene, pyglet.event.EventDispatcher):
         self.scroller = cocos.layer.ScrollingManager()
         self.add(self.scroller)
 
+        # Player input waits here until the next step
+        self.input = controls.ActionQueue(game.game.config.get_controls())
+        # Step physics on a worker thread, see pipeline. Game turns it on
+        # from the config.
+        self.pipelined = False
+        # actors.Player or actors.KinematicPlayer
+        self.player_class = actors.Player
+        # editor.EditorLayer when editing, set by Game
+        self.editor = None
+
     def on_enter(self):
         super(GameScene, self).on_enter()
         self.load_map()
 
+        # The first frame is drawn right after this, the clock fires after it
+        pyglet.clock.schedule_once(self.on_first_frame, 0)
+
+    def on_exit(self):
+        super(GameScene, self).on_exit()
+        # Stops the physics worker
+        self.simulation.set_pipelined(False)
+
+    def on_first_frame(self, dt):
+        debug.mark('First frame')
+        debug.print_timeline()
+
     def load_map(self):
         debug.msg('Loading map')
         self.map_filename = 'maps/test.tmx'
-        self.tiledmap = tiled.tiled.load_map(util.resource.path(self.map_filename))
+        tiled.tiled.image_loader = util.texcache.image
+        map_file = util.archive.open_file(util.resource.path(self.map_filename))
+        self.tiledmap = tiled.tiled.load_map(map_file, chunked=True)
         self.scroller.add(self.tiledmap.layers['middleground'], z=1)
         self.scroller.add(self.tiledmap.layers['background'], z=0)
 
         background = cocos.layer.ScrollableLayer()
-        image = cocos.sprite.Sprite('backgrounds/forest.jpg', anchor=(0,0))
+        image = cocos.sprite.Sprite(util.texcache.image('backgrounds/forest.jpg'),
+                anchor=(0,0))
         background.add(image)
         background.parallax = 0.8
         background.px = image.width
         background.py = image.height
         self.scroller.add(background, z=-1)
+        debug.mark('Map')
 
         debug.msg('Loading level geometry')
         physics_file = util.resource.path(self.tiledmap.properties['physics'])
         self.physics = physics.from_xml(physics_file)
+        self.physics.set_map_collision(self.tiledmap.properties,
+                self.tiledmap.tile_data, self.tiledmap.tile_width,
+                self.tiledmap.tile_height)
+        debug.mark('Level geometry')
+
+        debug.msg('Building actor texture atlas')
+        util.atlas.build(actors.atlas_images())
+        debug.mark('Actor atlas')
 
         debug.msg('Creating test actor layer')
         self.actors = actorlayer.ActorLayer()
         self.actors.push_handlers(self)
         self.scroller.add(self.actors, z=1)
 
+        self.simulation = simulation.Simulation(self.physics, self.actors,
+                self.input)
+        self.simulation.map_filename = self.map_filename
+        self.simulation.set_pipelined(self.pipelined)
+
+        self.load_particles()
         self.test_actor()
+        debug.msg('Actor layer draw calls: %d' % self.actors.draw_calls())
+        debug.mark('Actors')
 
         self.dispatch_event('on_map_load')
+        if debug.DEBUG:
+            memory.print_report(self.memory_report(), memory.live_counts())
+
+        # Pick up edits to the level files without restarting
+        if debug.DEBUG:
+            self.reloader = hotreload.HotReloader(self)
+            self.schedule_interval(self.reloader.poll, self.reloader.poll_interval)
+
+    def load_particles(self):
+        self.particles = None
+        if not particles.AVAILABLE:
+            debug.msg('NumPy not found, no particles')
+            return
+        self.particles = particles.ParticleSystem()
+        self.particles.set_collision(self.physics.collision_grid())
+        self.scroller.add(particles.ParticleLayer(self.particles), z=2)
 
     def test_actor(self):
-        self.player = actors.Player()
-        self.player.name = 'Player'
-        self.player.get_component('physics').body.position = (100, 100)
-        self.actors.add_actor(self.player)
-
-        for y in range(350, 600, 50):
-            block = actors.Block()
-            block.name = 'Block %d' % y
-            block.get_component('physics').body.position = (350, y)
-            self.actors.add_actor(block)
-
-        platform = actors.MovingPlatform()
-        platform.name = 'Platform'
-        platform.get_component('physics').body.position = (900, 144)
-        self.actors.add_actor(platform)
+        simulation.spawn_test_actors(self.simulation, self.player_class)
+        self.player = self.simulation.player
+        if self.particles != None:
+            self.player.get_component('physics').connect(
+                    on_land=self.on_player_land)
+
+    def on_player_land(self):
+        x, y = self.player.get_component('physics').feet()
+        self.particles.emit(x, y, 40, speed=120.0, spread=150.0, life=0.6,
+                color=(200, 180, 140, 200), size=3.0, weight=0.2)
+
+    def memory_report(self):
+        return memory.report(self.simulation, self.tiledmap, self.particles,
+                self.editor)
 
     def on_actor_add(self, actor):
         self.physics.on_actor_add(actor)
 
-    def on_actor_exit(self, actor):
+    def on_actor_remove(self, actor):
         self.physics.on_actor_remove(actor)
-    
+
     def _step(self, dt):
-        self.physics.update(dt)
+        self.simulation.step()
+        if self.particles != None:
+            # Beside the physics worker when pipelined
+            self.particles.update(self.simulation.dt)
 GameScene.register_event_type('on_map_load')
+GameScene.register_event_type('on_geometry_changed')
 
@@ -0,0 +1,424 @@
+'''Pure python helpers for the static collision geometry that the editor
+produces. Nothing in here knows about pymunk or OpenGL, polygons are plain
+lists of (x, y) tuples. That keeps the optimizer usable as a standalone tool.
+'''
+
+try:
+    from xml.etree import ElementTree
+except ImportError:
+    import elementtree.ElementTree as ElementTree
+
+import os
+import zlib
+import array
+import struct
+
+import util.archive
+import util.savefile
+
+# Rough relative costs used to estimate how much work a set of static shapes
+# adds to a space step. Every shape pays for a broadphase entry and every
+# vertex adds an axis to the separating axis test in the narrowphase.
+SHAPE_COST = 8
+VERTEX_COST = 1
+
+# Compiled form written by the asset build, see polygons_to_binary
+BINARY_MAGIC = 'PPLY'
+BINARY_VERSION = 1
+_binary_header = struct.Struct('<4sHI')
+
+class GeometryException(Exception):
+    pass
+
+def load_polygons(filename):
+    '''Reads the vertex lists out of a physics XML file, or its compiled
+    binary form. If an autosave journal for the file exists it is replayed
+    on top.
+    '''
+    data = util.archive.read(filename)
+    polygons = parse_polygons(data, filename)
+
+    journal = journal_filename(filename)
+    if os.path.exists(journal):
+        polygons = apply_journal(polygons, journal, checksum(data))
+
+    return polygons
+
+def parse_polygons(data, filename='<string>'):
+    '''Vertex lists out of the contents of a physics file, XML or binary.
+    '''
+    if data[:4] == BINARY_MAGIC:
+        return binary_to_polygons(data)
+    root = ElementTree.fromstring(data)
+
+    # Root level tag is expected to be <physics> so raise an exception if it's not
+    if root.tag != 'physics':
+        raise GeometryException('%s root level tag is %s rather than <physics>' %
+                (filename, root.tag))
+
+    polygons = []
+    for p in root.findall('polygon'):
+        vertices = []
+        for v in p.findall('vertex'):
+            vertices.append((int(v.get('x')), int(v.get('y'))))
+        polygons.append(vertices)
+    return polygons
+
+def polygons_to_xml(polygons):
+    '''Builds the physics XML tree for the given vertex lists.
+    '''
+    builder = ElementTree.TreeBuilder()
+    builder.start('physics', {'name': 'physics'})
+
+    for vertices in polygons:
+        builder.start('polygon', {})
+        for x, y in vertices:
+            builder.start('vertex', {'x': str(int(x)), 'y': str(int(y))})
+            builder.end('vertex')
+        builder.end('polygon')
+
+    builder.end('physics')
+    return ElementTree.ElementTree(builder.close())
+
+def polygons_to_binary(polygons):
+    '''Packs vertex lists into the compiled form: a header with the polygon
+    count, then one array of vertex counts and one of coordinates, all int32.
+    '''
+    counts = array.array('i', [len(vertices) for vertices in polygons])
+    coords = array.array('i')
+    for vertices in polygons:
+        for x, y in vertices:
+            coords.append(int(x))
+            coords.append(int(y))
+    return ''.join((_binary_header.pack(BINARY_MAGIC, BINARY_VERSION,
+        len(polygons)), counts.tostring(), coords.tostring()))
+
+def binary_to_polygons(data):
+    magic, version, count = _binary_header.unpack_from(data, 0)
+    if version != BINARY_VERSION:
+        raise GeometryException('Unsupported geometry version %d' % version)
+
+    offset = _binary_header.size
+    counts = array.array('i')
+    counts.fromstring(data[offset:offset + count * 4])
+    coords = array.array('i')
+    coords.fromstring(data[offset + count * 4:])
+
+    polygons = []
+    i = 0
+    for n in counts:
+        polygons.append(zip(coords[i:i + n * 2:2], coords[i + 1:i + n * 2:2]))
+        i += n * 2
+    return polygons
+
+def save_polygons(filename, polygons):
+    '''Atomically replaces filename with the given polygons. The journal is
+    folded into the new file, so it is removed afterwards.
+    '''
+    data = ElementTree.tostring(polygons_to_xml(polygons).getroot())
+    util.savefile.atomic_write(filename, data)
+
+    journal = journal_filename(filename)
+    if os.path.exists(journal):
+        os.remove(journal)
+
+# Autosave journal
+# ----------------
+# Incremental edits are appended to <file>.journal rather than rewriting the
+# whole level. The first line records the checksum of the file the journal
+# applies to, every other line removes ('-') or adds ('+') one polygon.
+# Polygons are identified by their vertex set, see polygon_key. A journal
+# left over from before a full save won't match the checksum and is ignored.
+
+def checksum(data):
+    return zlib.crc32(data) & 0xffffffff
+
+def journal_filename(filename):
+    return filename + '.journal'
+
+def polygon_key(vertices):
+    '''Order independent identity of a polygon as it is stored on disk.
+    '''
+    return tuple(sorted(set((int(x), int(y)) for x, y in vertices)))
+
+def _format_vertices(vertices):
+    return ' '.join('%d,%d' % (x, y) for x, y in vertices)
+
+def _parse_vertices(text):
+    vertices = []
+    for pair in text.split():
+        x, y = pair.split(',')
+        vertices.append((int(x), int(y)))
+    return vertices
+
+def append_journal(filename, removed, added):
+    '''Appends polygon removals and additions to the journal of filename.
+    removed holds polygon keys, added holds vertex lists.
+    '''
+    journal = journal_filename(filename)
+    lines = []
+
+    if not os.path.exists(journal):
+        f = open(filename, 'rb')
+        try:
+            lines.append('base %08x\n' % checksum(f.read()))
+        finally:
+            f.close()
+
+    for key in removed:
+        lines.append('- %s\n' % _format_vertices(key))
+    for vertices in added:
+        lines.append('+ %s\n' % _format_vertices(
+            [(int(x), int(y)) for x, y in vertices]))
+
+    util.savefile.append_durable(journal, ''.join(lines))
+
+def apply_journal(polygons, journal, base_checksum):
+    f = open(journal, 'rb')
+    try:
+        lines = f.read().split('\n')
+    finally:
+        f.close()
+
+    if not lines or lines[0] != 'base %08x' % base_checksum:
+        # Stale journal from before the last full save
+        return polygons
+
+    polygons = list(polygons)
+    for line in lines[1:]:
+        try:
+            op, text = line.split(' ', 1)
+            vertices = _parse_vertices(text)
+        except ValueError:
+            # A crash while appending can leave a torn last line behind
+            continue
+
+        if op == '+':
+            polygons.append(vertices)
+        elif op == '-':
+            key = polygon_key(vertices)
+            for i, p in enumerate(polygons):
+                if polygon_key(p) == key:
+                    del polygons[i]
+                    break
+    return polygons
+
+def signed_area(vertices):
+    '''Shoelace formula. Positive for counter-clockwise winding.
+    '''
+    area = 0.0
+    count = len(vertices)
+    for i in range(count):
+        x1, y1 = vertices[i]
+        x2, y2 = vertices[(i + 1) % count]
+        area += x1 * y2 - x2 * y1
+    return area / 2.0
+
+def area(vertices):
+    return abs(signed_area(vertices))
+
+def bounds(vertices):
+    xs = [x for x, y in vertices]
+    ys = [y for x, y in vertices]
+    return min(xs), min(ys), max(xs), max(ys)
+
+def _cross(o, a, b):
+    return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+def convex_hull(points):
+    '''Andrew's monotone chain. Returns the hull in counter-clockwise order
+    with duplicate and collinear points removed.
+    '''
+    points = sorted(set(points))
+    if len(points) < 3:
+        return points
+
+    lower = []
+    for p in points:
+        while len(lower) >= 2 and _cross(lower[-2], lower[-1], p) <= 0:
+            lower.pop()
+        lower.append(p)
+
+    upper = []
+    for p in reversed(points):
+        while len(upper) >= 2 and _cross(upper[-2], upper[-1], p) <= 0:
+            upper.pop()
+        upper.append(p)
+
+    return lower[:-1] + upper[:-1]
+
+def clip_polygon(subject, clip):
+    '''Sutherland-Hodgman clipping of subject against the convex,
+    counter-clockwise polygon clip. Returns the intersection polygon, which
+    is empty if they don't overlap.
+    '''
+    output = list(subject)
+    count = len(clip)
+    for i in range(count):
+        if not output:
+            break
+
+        a = clip[i]
+        b = clip[(i + 1) % count]
+        source = output
+        output = []
+        for j in range(len(source)):
+            p = source[j]
+            q = source[(j + 1) % len(source)]
+            p_in = _cross(a, b, p) >= 0
+            q_in = _cross(a, b, q) >= 0
+            if p_in:
+                output.append(p)
+            if p_in != q_in:
+                # Edge crosses the clipping line, add the intersection point
+                dx1, dy1 = q[0] - p[0], q[1] - p[1]
+                dx2, dy2 = b[0] - a[0], b[1] - a[1]
+                denom = dx1 * dy2 - dy1 * dx2
+                if denom != 0:
+                    t = ((a[0] - p[0]) * dy2 - (a[1] - p[1]) * dx2) / float(denom)
+                    output.append((p[0] + t * dx1, p[1] + t * dy1))
+    return output
+
+def is_degenerate(vertices, min_area=1.0):
+    return len(vertices) < 3 or area(vertices) < min_area
+
+def is_convex(vertices, area_tolerance=1.0):
+    '''Whether the polygon covers its convex hull, give or take
+    area_tolerance. Concave and self-intersecting polygons don't.
+    '''
+    return area(convex_hull(vertices)) - area(vertices) <= area_tolerance
+
+def snap_to_grid(vertices, grid):
+    return [(int(round(x / float(grid))) * grid, int(round(y / float(grid))) * grid)
+            for x, y in vertices]
+
+def weld_vertices(polygons, tolerance):
+    '''Moves vertices that lie within tolerance of each other, across all
+    polygons, onto a single shared position. The first vertex seen in a
+    cluster becomes its representative so the result is deterministic.
+    '''
+    cell_size = float(max(tolerance, 1))
+    cells = {}
+    welded = []
+
+    for vertices in polygons:
+        new_vertices = []
+        for x, y in vertices:
+            cx = int(x // cell_size)
+            cy = int(y // cell_size)
+            match = None
+            for i in (cx - 1, cx, cx + 1):
+                for j in (cy - 1, cy, cy + 1):
+                    for px, py in cells.get((i, j), ()):
+                        if abs(px - x) <= tolerance and abs(py - y) <= tolerance:
+                            match = (px, py)
+                            break
+                    if match != None:
+                        break
+                if match != None:
+                    break
+
+            if match == None:
+                match = (x, y)
+                cells.setdefault((cx, cy), []).append(match)
+            new_vertices.append(match)
+        welded.append(new_vertices)
+    return welded
+
+def _bounds_touch(a, b, tolerance):
+    return not (a[2] + tolerance < b[0] or b[2] + tolerance < a[0] or
+                a[3] + tolerance < b[1] or b[3] + tolerance < a[1])
+
+def convex_union(a, b, area_tolerance=1.0):
+    '''Returns the union of convex polygons a and b if that union is itself
+    convex, otherwise None. The union is convex exactly when the hull of both
+    polygons covers no more area than the polygons themselves.
+    '''
+    hull = convex_hull(list(a) + list(b))
+    overlap = clip_polygon(a, b)
+    overlap_area = area(overlap) if len(overlap) > 2 else 0.0
+    union_area = area(a) + area(b) - overlap_area
+
+    if area(hull) - union_area <= area_tolerance:
+        return hull
+    return None
+
+def merge_convex(polygons, area_tolerance=1.0):
+    '''Greedily merges overlapping or touching convex polygons whose union
+    stays convex. Passes are repeated until nothing merges any more, since a
+    grown polygon may now join one that was checked earlier.
+    '''
+    polygons = [convex_hull(p) for p in polygons if p]
+    boxes = [bounds(p) for p in polygons]
+    changed = True
+    while changed:
+        changed = False
+        i = 0
+        while i < len(polygons):
+            merged = False
+            j = i + 1
+            while j < len(polygons):
+                if _bounds_touch(boxes[i], boxes[j], 0):
+                    union = convex_union(polygons[i], polygons[j], area_tolerance)
+                    if union != None:
+                        polygons[i] = union
+                        boxes[i] = bounds(union)
+                        del polygons[j]
+                        del boxes[j]
+                        merged = changed = True
+                        continue
+                j += 1
+            if not merged:
+                i += 1
+    return polygons
+
+def step_cost(polygons):
+    '''Estimated relative cost the given static polygons add to a step.
+    '''
+    return sum(SHAPE_COST + VERTEX_COST * len(p) for p in polygons)
+
+class OptimizeReport(object):
+    def __init__(self, before, after):
+        self.shapes_before = len(before)
+        self.shapes_after = len(after)
+        self.vertices_before = sum(len(p) for p in before)
+        self.vertices_after = sum(len(p) for p in after)
+        self.cost_before = step_cost(before)
+        self.cost_after = step_cost(after)
+
+    @property
+    def cost_reduction(self):
+        '''Estimated step cost reduction as a fraction of the original.
+        '''
+        if self.cost_before == 0:
+            return 0.0
+        return 1.0 - self.cost_after / float(self.cost_before)
+
+    def __str__(self):
+        return ('shapes: %d -> %d, vertices: %d -> %d, '
+                'estimated step cost: %d -> %d (%.1f%% less)' %
+                (self.shapes_before, self.shapes_after,
+                 self.vertices_before, self.vertices_after,
+                 self.cost_before, self.cost_after,
+                 self.cost_reduction * 100.0))
+
+def optimize(polygons, weld_tolerance=3, grid=None, min_area=16.0,
+        area_tolerance=16.0):
+    '''Cleans up a list of static polygons. Vertices are optionally snapped to
+    a grid, near-coincident vertices are welded, degenerate shapes dropped and
+    convex polygons merged where possible. Returns the new polygons and an
+    OptimizeReport.
+    '''
+    before = [list(p) for p in polygons]
+    result = before
+
+    if grid:
+        result = [snap_to_grid(p, grid) for p in result]
+    if weld_tolerance:
+        result = weld_vertices(result, weld_tolerance)
+
+    result = [convex_hull(p) for p in result]
+    result = [p for p in result if not is_degenerate(p, min_area)]
+    result = merge_convex(result, area_tolerance)
+
+    return result, OptimizeReport(before, result)
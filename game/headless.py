@@ -0,0 +1,13 @@
+'''Import this module before any other game module to run simulations
+without a window or GL context, e.g. for replays, servers and benchmarks.
+'''
+
+import pyglet
+# Must be set before pyglet.gl is imported anywhere
+pyglet.options['shadow_window'] = False
+
+import util.resource
+util.resource.init()
+
+import actors
+actors.GRAPHICS = False
@@ -0,0 +1,220 @@
+'''Hot reloading of level files while the game is running.
+A HotReloader polls the modification times of the loaded map, its physics
+geometry (and autosave journal) and the actor animsets. When one changes the
+file is parsed again and diffed against what is loaded, and only the
+difference is applied:
+    map         changed tile cells are swapped and only the chunks they fall
+                in are rebaked. A layer that changed size is rebuilt. If the
+                solid or one-way layer changed the collision grid is rebaked
+                and the navigation graphs are rebuilt over the changed
+                columns.
+    geometry    only the polygons that were added or removed are touched in
+                the physics space. The scene dispatches on_geometry_changed
+                so the editor can follow along.
+    animsets    only the animations whose definition changed are rebuilt and
+                only the sprites playing them are rebound.
+Tilesets, map properties and image pixels are not reloaded, those still need
+a restart.
+'''
+
+import os
+import time
+
+import debug
+import actors
+import geometry
+import physics
+import tiled.tiled
+import tiled.chunks
+import util.anim
+import util.resource
+from components import AnimComponent
+
+class FileWatcher(object):
+    '''Polls the modification times of a set of files. Callbacks take no
+    arguments and are called at most once per poll, even if several of the
+    files they watch changed.
+    '''
+    def __init__(self):
+        # filename -> [mtime, callback]
+        self.files = {}
+
+    def watch(self, filename, callback):
+        self.files[filename] = [self.mtime(filename), callback]
+
+    def unwatch(self, filename):
+        self.files.pop(filename, None)
+
+    def mtime(self, filename):
+        try:
+            return os.stat(filename).st_mtime
+        except OSError:
+            return None
+
+    def poll(self):
+        pending = []
+        for filename, entry in self.files.iteritems():
+            mtime = self.mtime(filename)
+            if mtime != entry[0]:
+                entry[0] = mtime
+                if entry[1] not in pending:
+                    pending.append(entry[1])
+
+        for callback in pending:
+            callback()
+        return len(pending)
+
+class HotReloader(object):
+    # Seconds between polls
+    poll_interval = 0.5
+
+    def __init__(self, scene):
+        self.scene = scene
+        self.watcher = FileWatcher()
+
+        # Watched and reread on disk, even when the level was loaded out of
+        # the archive
+        self.map_filename = util.resource.file_path(scene.map_filename)
+        self.watcher.watch(self.map_filename, self.reload_map)
+
+        self.physics_filename = util.resource.file_path(
+                scene.tiledmap.properties['physics'])
+        self.watcher.watch(self.physics_filename, self.reload_geometry)
+        self.watcher.watch(geometry.journal_filename(self.physics_filename),
+                self.reload_geometry)
+
+        for animset in actors.ANIMSETS:
+            filename = util.resource.file_path(animset)
+            self.watcher.watch(filename,
+                    lambda filename=filename, animset=animset:
+                        self.reload_animset(filename, util.resource.path(animset)))
+
+    def poll(self, dt=0):
+        try:
+            self.watcher.poll()
+        except Exception, e:
+            # Editors save in several steps, the next save will bring us back
+            debug.msg('Hot reload failed: %s' % e)
+
+    def reload_map(self):
+        start = time.time()
+        tiledmap = self.scene.tiledmap
+        changed = 0
+        rebuilt = 0
+        # Tile columns of the collision layers that changed
+        collision = (tiledmap.properties.get('solid_layer'),
+                tiledmap.properties.get('oneway_layer'))
+        columns = set()
+
+        for name, tiledata in tiled.tiled.load_tile_layers(self.map_filename).iteritems():
+            old = tiledmap.tile_data.get(name)
+            layer = tiledmap.layers.get(name)
+            if old == None or layer == None:
+                debug.msg('New layer %s needs a restart' % name)
+                continue
+
+            if (old.width, old.height) != (tiledata.width, tiledata.height) or \
+                    not isinstance(layer, tiled.chunks.ChunkedTileLayer):
+                self.replace_layer(name, tiledata)
+                changed += tiledata.width * tiledata.height
+                if name in collision:
+                    columns.update(xrange(max(old.width, tiledata.width)))
+                continue
+
+            changes = tiled.chunks.diff_tiles(old, tiledata)
+            if changes:
+                rebuilt += layer.set_cells(changes)
+                changed += len(changes)
+                if name in collision:
+                    columns.update(i for i, j, gid in changes)
+
+        if columns:
+            self.collision_changed(sorted(columns))
+
+        debug.msg('Reloaded map: %d cells changed, %d chunks rebuilt in %.1f ms' %
+                (changed, rebuilt, (time.time() - start) * 1000))
+
+    def collision_changed(self, columns):
+        '''Rebakes the collision grid and rebuilds the navigation graphs
+        over the changed tile columns. The layers are handed to the physics
+        again, it still has the old TileData of a replaced layer.
+        '''
+        tiledmap = self.scene.tiledmap
+        simulation = self.scene.simulation
+        simulation.sync()
+        self.scene.physics.set_map_collision(tiledmap.properties,
+                tiledmap.tile_data, tiledmap.tile_width, tiledmap.tile_height)
+
+        # Runs of neighbouring columns
+        ranges = []
+        for i in columns:
+            left = i * tiledmap.tile_width
+            if ranges and ranges[-1][1] == left:
+                ranges[-1][1] = left + tiledmap.tile_width
+            else:
+                ranges.append([left, left + tiledmap.tile_width])
+        simulation.navigation_changed([tuple(r) for r in ranges])
+
+    def replace_layer(self, name, tiledata):
+        '''Rebuilds a whole tile layer and puts it where the old one was.
+        '''
+        tiledmap = self.scene.tiledmap
+        old = tiledmap.layers[name]
+        if isinstance(old, tiled.chunks.ChunkedTileLayer):
+            layer = tiled.chunks.ChunkedTileLayer(tiledata, old.tiles,
+                    tiledmap.tile_width, tiledmap.tile_height, old.chunk_size)
+            old.delete()
+        else:
+            layer = tiled.tiled.make_layer(tiledata, tiledmap)
+
+        scroller = self.scene.scroller
+        z = [z for z, child in scroller.children if child is old][0]
+        scroller.remove(old)
+        scroller.add(layer, z=z)
+        scroller.set_focus(scroller.fx, scroller.fy)
+
+        tiledmap.layers[name] = layer
+        tiledmap.tile_data[name] = tiledata
+
+    def reload_geometry(self):
+        start = time.time()
+        polygons = geometry.load_polygons(self.physics_filename)
+        self.scene.simulation.sync()
+        removed, added = physics.update_static_polygons(
+                self.scene.physics.space, polygons)
+        self.scene.simulation.static_geometry_changed(removed + added)
+        if removed or added:
+            self.scene.dispatch_event('on_geometry_changed', removed, added)
+
+        debug.msg('Reloaded geometry: %d polygons removed, %d added in %.1f ms' %
+                (len(removed), len(added), (time.time() - start) * 1000))
+
+    def reload_animset(self, filename, loaded_as=None):
+        '''Rereads an animset from filename and rebuilds the animsets that
+        were loaded from loaded_as, the same file unless it was in the
+        archive.
+        '''
+        if loaded_as == None:
+            loaded_as = filename
+        start = time.time()
+        definition = util.anim.parse_animset(filename)
+
+        # Actors may share an animset or each have their own copy
+        changed = {}
+        rebound = 0
+        for a in self.scene.actors.get_actors():
+            if not a.has_component('sprite', AnimComponent):
+                continue
+            sprite = a.get_component('sprite')
+            anims = sprite.anims
+            if anims.filename != loaded_as:
+                continue
+
+            if id(anims) not in changed:
+                changed[id(anims)] = util.anim.reload_animset(anims, definition)
+            if sprite.animation in changed[id(anims)]:
+                sprite.reload_animation()
+                rebound += 1
+
+        debug.msg('Reloaded %s: %d sprites rebound in %.1f ms' %
+                (filename, rebound, (time.time() - start) * 1000))
@@ -0,0 +1,367 @@
+'''Kinematic character movement against the level's static geometry.
+Characters moved this way have no dynamic body in the space. Every step
+their box is moved along x and then along y through a CollisionGrid, and
+pushed back out of whatever it ran into. That makes ground detection
+exact, lets characters walk up steps and slopes up to step_height without
+bouncing, and costs a few grid lookups per character instead of a body,
+a shape and contact solving.
+
+The grid is baked from the level polygons and, optionally, two tile layers
+named by map properties:
+    solid_layer     every non-empty tile is a solid block
+    oneway_layer    every non-empty tile is a platform that can be jumped
+                    through from below and stood on from above
+Cells entirely inside a polygon become solid blocks too, the rest keep a
+list of the polygons overlapping them.
+
+Kinematic characters don't push or get pushed by dynamic bodies.
+'''
+
+import array
+
+EMPTY = 0
+SOLID = 1
+ONEWAY = 2
+
+# Touching distance, less than this isn't overlapping
+EPSILON = 1e-6
+# Overlaps shallower than this are rounding, see CollisionGrid.overlaps
+SKIN = 0.01
+INFINITY = float('inf')
+# Cell ranges whose query results a grid keeps
+QUERY_CACHE = 4096
+
+class ConvexShape(object):
+    '''A convex polygon with its separating axes worked out. Every axis is
+    (nx, ny, min, max), the unit normal and the projection of the polygon
+    on it. The first two are the x and y axes, i.e. the bounding box.
+    '''
+    __slots__ = ('vertices', 'axes', 'left', 'bottom', 'right', 'top')
+
+    def __init__(self, vertices):
+        self.vertices = vertices
+        xs = [x for x, y in vertices]
+        ys = [y for x, y in vertices]
+        self.left, self.right = min(xs), max(xs)
+        self.bottom, self.top = min(ys), max(ys)
+
+        self.axes = [(1.0, 0.0, self.left, self.right),
+                (0.0, 1.0, self.bottom, self.top)]
+        normals = set([(1.0, 0.0), (0.0, 1.0)])
+        for n in range(len(vertices)):
+            x1, y1 = vertices[n - 1]
+            x2, y2 = vertices[n]
+            length = ((x2 - x1) ** 2 + (y2 - y1) ** 2) ** 0.5
+            if length < EPSILON:
+                continue
+            nx, ny = (y2 - y1) / length, (x1 - x2) / length
+            # Opposite normals are the same axis
+            if nx < 0 or (nx == 0 and ny < 0):
+                nx, ny = -nx, -ny
+            key = (round(nx, 6), round(ny, 6))
+            if key in normals:
+                continue
+            normals.add(key)
+            projections = [x * nx + y * ny for x, y in vertices]
+            self.axes.append((nx, ny, min(projections), max(projections)))
+
+    def contains_box(self, left, bottom, right, top):
+        for nx, ny, low, high in self.axes:
+            for x, y in ((left, bottom), (right, bottom), (right, top), (left, top)):
+                p = x * nx + y * ny
+                if p < low - EPSILON or p > high + EPSILON:
+                    return False
+        return True
+
+def box_shape(left, bottom, right, top):
+    return ConvexShape([(left, bottom), (right, bottom), (right, top), (left, top)])
+
+def overlap_interval(shape, left, bottom, right, top, ux, uy):
+    '''Displacements s along the unit axis (ux, uy) for which the box moved
+    by s overlaps the shape, as (low, high). None if it never does.
+    Touching doesn't count as overlapping.
+    '''
+    low = -INFINITY
+    high = INFINITY
+    cx = (left + right) * 0.5
+    cy = (bottom + top) * 0.5
+    hw = (right - left) * 0.5
+    hh = (top - bottom) * 0.5
+    for nx, ny, pmin, pmax in shape.axes:
+        c = cx * nx + cy * ny
+        r = hw * abs(nx) + hh * abs(ny)
+        s = ux * nx + uy * ny
+        if -EPSILON < s < EPSILON:
+            # Moving along this axis doesn't change the projection
+            if c + r <= pmin + EPSILON or c - r >= pmax - EPSILON:
+                return None
+            continue
+        a = (pmin - (c + r)) / s
+        b = (pmax - (c - r)) / s
+        if a > b:
+            a, b = b, a
+        if a > low:
+            low = a
+        if b < high:
+            high = b
+        if low >= high - EPSILON:
+            return None
+    return low, high
+
+class CollisionGrid(object):
+    '''Static collision data per cell, usually per map tile.
+    '''
+    def __init__(self, cell_width=16, cell_height=16):
+        self.cell_width = cell_width
+        self.cell_height = cell_height
+        self.width = 0
+        self.height = 0
+        self.cells = array.array('B')
+        # Cell index -> shapes of the polygons partly in it
+        self.cell_shapes = {}
+        # Cell index -> box of a solid or one-way cell, made on first use
+        self.boxes = {}
+        # (i0, j0, i1, j1) cell range -> (solids, platforms) found in it
+        self.found = {}
+        # Goes up every build, for whatever keeps copies of the cells
+        self.version = 0
+
+    def build(self, polygons, solid=None, oneway=None):
+        '''Bakes the grid from the level polygons (vertex lists) and the
+        solid and one-way chunks.TileData, which are optional.
+        '''
+        shapes = [ConvexShape(vertices) for vertices in polygons if len(vertices) >= 3]
+        cw, ch = self.cell_width, self.cell_height
+        width = height = 0
+        for shape in shapes:
+            width = max(width, int(shape.right // cw) + 1)
+            height = max(height, int(shape.top // ch) + 1)
+        for tiledata in (solid, oneway):
+            if tiledata != None:
+                width = max(width, tiledata.width)
+                height = max(height, tiledata.height)
+
+        self.width = width
+        self.height = height
+        self.cells = array.array('B', [EMPTY]) * (width * height)
+        self.cell_shapes = {}
+        self.boxes = {}
+        self.found = {}
+        self.version += 1
+
+        for tiledata, kind in ((oneway, ONEWAY), (solid, SOLID)):
+            if tiledata == None:
+                continue
+            for j in xrange(tiledata.height):
+                for i in xrange(tiledata.width):
+                    if tiledata.get(i, j) != 0:
+                        self.cells[j * width + i] = kind
+
+        for shape in shapes:
+            for j in xrange(max(0, int(shape.bottom // ch)),
+                    min(height, int(shape.top // ch) + 1)):
+                for i in xrange(max(0, int(shape.left // cw)),
+                        min(width, int(shape.right // cw) + 1)):
+                    n = j * width + i
+                    if self.cells[n] == SOLID:
+                        continue
+                    left, bottom = i * cw, j * ch
+                    if shape.contains_box(left, bottom, left + cw, bottom + ch):
+                        self.cells[n] = SOLID
+                        self.cell_shapes.pop(n, None)
+                    elif overlap_interval(shape, left, bottom, left + cw,
+                            bottom + ch, 1.0, 0.0) != None:
+                        self.cell_shapes.setdefault(n, []).append(shape)
+        # Nothing in a solid cell needs the polygons any more
+        for n in self.cell_shapes.keys():
+            if self.cells[n] == SOLID:
+                del self.cell_shapes[n]
+
+    def box(self, n):
+        shape = self.boxes.get(n)
+        if shape == None:
+            left = (n % self.width) * self.cell_width
+            bottom = (n / self.width) * self.cell_height
+            shape = self.boxes[n] = box_shape(left, bottom,
+                    left + self.cell_width, bottom + self.cell_height)
+        return shape
+
+    def query(self, left, bottom, right, top):
+        '''Solid shapes and one-way platform boxes in the cells a box
+        overlaps or touches, as new lists. Characters ask about the same
+        few cells step after step, so the answer for a range of cells is
+        kept until the grid is rebuilt.
+        '''
+        cw, ch = self.cell_width, self.cell_height
+        key = (max(0, int(left // cw)), max(0, int(bottom // ch)),
+                min(self.width, int(right // cw) + 1),
+                min(self.height, int(top // ch) + 1))
+        found = self.found.get(key)
+        if found == None:
+            if len(self.found) >= QUERY_CACHE:
+                self.found.clear()
+            found = self.found[key] = self.query_cells(*key)
+        return list(found[0]), list(found[1])
+
+    def query_cells(self, i0, j0, i1, j1):
+        solids = []
+        platforms = []
+        seen = set()
+        width = self.width
+        cells = self.cells
+        cell_shapes = self.cell_shapes
+        for j in xrange(j0, j1):
+            for i in xrange(i0, i1):
+                n = j * width + i
+                kind = cells[n]
+                if kind == SOLID:
+                    solids.append(self.box(n))
+                    continue
+                if kind == ONEWAY:
+                    platforms.append(self.box(n))
+                shapes = cell_shapes.get(n)
+                if shapes != None:
+                    for shape in shapes:
+                        if id(shape) not in seen:
+                            seen.add(id(shape))
+                            solids.append(shape)
+        return solids, platforms
+
+    def overlaps(self, left, bottom, right, top):
+        '''Whether a box overlaps anything solid. One-way platforms don't
+        count.
+        '''
+        solids, platforms = self.query(left, bottom, right, top)
+        for shape in solids:
+            interval = overlap_interval(shape, left, bottom, right, top, 1.0, 0.0)
+            if interval != None and interval[0] < -SKIN and interval[1] > SKIN:
+                return True
+        return False
+
+def push_out(grid, box, axis, distance, platforms_below=None):
+    '''Moves the box (a [left, bottom, right, top] list, changed in place)
+    along x (axis 0) or y (axis 1) and pushes it back out of solids it
+    ran into. One-way platforms only stop boxes moving down whose bottom
+    was at or above platforms_below. Returns the distance moved.
+    '''
+    ux, uy = (1.0, 0.0) if axis == 0 else (0.0, 1.0)
+    box[axis] += distance
+    box[axis + 2] += distance
+    left, bottom, right, top = box
+    solids, platforms = grid.query(left, bottom, right, top)
+    if platforms_below != None and distance < 0:
+        solids.extend(p for p in platforms if p.top <= platforms_below + EPSILON)
+
+    push = 0.0
+    for shape in solids:
+        interval = overlap_interval(shape, left, bottom, right, top, ux, uy)
+        if interval == None:
+            continue
+        low, high = interval
+        if low >= -EPSILON or high <= EPSILON:
+            # Not where the box is now
+            continue
+        if distance > 0 and low < push:
+            push = low
+        elif distance < 0 and high > push:
+            push = high
+    # Never further back than where it started
+    if distance > 0:
+        push = max(push, -distance)
+    else:
+        push = min(push, -distance)
+    box[axis] += push
+    box[axis + 2] += push
+    return distance + push
+
+def step_up(grid, box, dx, step_height):
+    '''Tries moving the box sideways by dx on top of whatever stops it, up
+    to step_height higher. Returns the height climbed, or None if it's too
+    high or there's no room.
+    '''
+    left, bottom, right, top = box[0] + dx, box[1], box[2] + dx, box[3]
+    solids, platforms = grid.query(left, bottom, right, top)
+    lift = 0.0
+    for shape in solids:
+        interval = overlap_interval(shape, left, bottom, right, top, 0.0, 1.0)
+        if interval != None and interval[0] < -EPSILON and interval[1] > lift:
+            lift = interval[1]
+    if lift > step_height:
+        return None
+    # Room above where it stands and where it's going
+    if grid.overlaps(box[0], box[1] + lift, box[2], box[3] + lift) or \
+            grid.overlaps(left, bottom + lift, right, top + lift):
+        return None
+    box[0] += dx
+    box[2] += dx
+    box[1] += lift
+    box[3] += lift
+    return lift
+
+def ground_distance(grid, box, reach):
+    '''Distance down to the first thing the box would land on, or None if
+    there's nothing within reach.
+    '''
+    left, bottom, right, top = box
+    solids, platforms = grid.query(left, bottom - reach, right, top)
+    solids.extend(p for p in platforms if p.top <= bottom + EPSILON)
+    found = None
+    for shape in solids:
+        interval = overlap_interval(shape, left, bottom, right, top, 0.0, -1.0)
+        if interval == None or interval[0] < -EPSILON:
+            continue
+        if found == None or interval[0] < found:
+            found = interval[0]
+    if found != None and found <= reach:
+        return max(0.0, found)
+    return None
+
+def move(grid, box, dx, dy, grounded, step_height):
+    '''Moves the box by (dx, dy) through the grid. Long moves are split so a
+    box can't pass through anything thinner than half its size. Returns
+    (moved x, moved y, grounded).
+    '''
+    half = min(box[2] - box[0], box[3] - box[1], grid.cell_width,
+            grid.cell_height) * 0.5
+    steps = int(max(abs(dx), abs(dy)) / half) + 1
+    sx = dx / float(steps)
+    sy = dy / float(steps)
+    moved_x = moved_y = 0.0
+    blocked_x = blocked_y = False
+
+    for n in range(steps):
+        if sx != 0 and not blocked_x:
+            start = box[1]
+            done = push_out(grid, box, 0, sx)
+            if abs(done - sx) > EPSILON:
+                lift = None
+                if grounded and step_height > 0:
+                    lift = step_up(grid, box, sx - done, step_height)
+                if lift == None:
+                    blocked_x = True
+                else:
+                    done = sx
+            moved_x += done
+            moved_y += box[1] - start
+
+        if sy != 0 and not blocked_y:
+            done = push_out(grid, box, 1, sy, box[1])
+            moved_y += done
+            if abs(done - sy) > EPSILON:
+                blocked_y = True
+                grounded = sy < 0
+            elif sy > 0:
+                grounded = False
+
+    if dy <= 0 and not blocked_y:
+        # Walked off something or down a slope. Stick to the ground if it's
+        # close, otherwise start falling.
+        drop = ground_distance(grid, box, step_height if grounded else 0.0)
+        if drop != None:
+            box[1] -= drop
+            box[3] -= drop
+            moved_y -= drop
+            grounded = True
+        else:
+            grounded = False
+    return moved_x, moved_y, grounded
@@ -0,0 +1,186 @@
+'''Where the memory of a level goes.
+report() adds up what each subsystem holds, in CPU and GPU bytes:
+    tiles           tile ids of the map layers, cocos cells or chunk vertex
+                    lists
+    tilesets        tileset textures
+    texture cache   the other textures in util.texcache
+    atlas           the actor atlas pages
+    physics         bodies and shapes in the space, the collision grid
+    actors          actors and their components
+    particles       particle arrays
+    projectiles     the projectile pool
+    editor          the editor's polygon <-> shape maps
+CPU bytes are estimates. Python objects are sys.getsizeof of the object and
+its __dict__, not what they point to, and chipmunk's side of bodies and
+shapes is a fixed guess since Python can't see it. A texture is width *
+height * 4 bytes, counted once, for the first subsystem using it.
+
+live_counts() counts the actors, components, bodies and shapes that are
+alive anywhere, level or not, through the garbage collector. leak_check()
+loads and unloads a level a number of times and tells which counts grow
+with every load.
+'''
+
+import gc
+import sys
+
+import pymunk
+
+import debug
+import physics
+import actor.actor
+import actor.component
+import tiled.chunks
+import util.atlas
+import util.texcache
+
+# Guesses at chipmunk's own memory per body, per shape and per polygon
+# vertex (vertices, transformed vertices and planes)
+BODY_BYTES = 192
+SHAPE_BYTES = 160
+VERTEX_BYTES = 64
+# Bytes per vertex of the chunk vertex lists, v2i and t3f
+CHUNK_VERTEX_BYTES = 20
+
+COUNTED = (
+    ('actors', actor.actor.Actor),
+    ('components', actor.component.Component),
+    ('bodies', pymunk.Body),
+    ('shapes', pymunk.Shape),
+)
+
+def object_bytes(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+def texture_bytes(texture, seen):
+    '''Bytes of the texture a texture or region is in, or 0 if it's in
+    seen already. Adds it to seen.
+    '''
+    texture = getattr(texture, 'owner', None) or texture
+    if texture.id in seen:
+        return 0
+    seen.add(texture.id)
+    return texture.width * texture.height * 4
+
+def tile_bytes(tiledmap):
+    '''(CPU bytes, GPU bytes) of the tile layers.
+    '''
+    cpu = gpu = 0
+    for tiledata in tiledmap.tile_data.itervalues():
+        cpu += sys.getsizeof(tiledata.data)
+    for layer in tiledmap.layers.itervalues():
+        if isinstance(layer, tiled.chunks.ChunkedTileLayer):
+            for vertex_lists in layer.chunks.itervalues():
+                for texture, vertex_list in vertex_lists:
+                    gpu += vertex_list.get_size() * CHUNK_VERTEX_BYTES
+        else:
+            for column in layer.cells:
+                cpu += sys.getsizeof(column)
+                for cell in column:
+                    cpu += object_bytes(cell)
+    return cpu, gpu
+
+def physics_bytes(level_physics):
+    space = level_physics.space
+    # Static shapes are apart in older pymunk
+    shapes = list(space.shapes) + list(getattr(space, 'static_shapes', ()))
+    cpu = 0
+    for body in space.bodies:
+        cpu += object_bytes(body) + BODY_BYTES
+    for shape in shapes:
+        cpu += object_bytes(shape) + SHAPE_BYTES
+        if isinstance(shape, pymunk.Poly):
+            cpu += len(physics.polygon_points(shape)) * VERTEX_BYTES
+    grid = level_physics.grid
+    if grid != None:
+        cpu += sys.getsizeof(grid.cells) + sys.getsizeof(grid.cell_shapes) + \
+                sys.getsizeof(grid.boxes)
+    return cpu
+
+def actor_bytes(layer):
+    cpu = 0
+    for a in layer.get_actors():
+        cpu += object_bytes(a) + sys.getsizeof(a.components)
+        for component in a.components.itervalues():
+            cpu += object_bytes(component)
+    return cpu
+
+def report(simulation=None, tiledmap=None, particles=None, editor=None):
+    '''List of (subsystem, CPU bytes, GPU bytes) of whatever is passed in
+    and the shared textures.
+    '''
+    rows = []
+    seen = set()
+    if tiledmap != None:
+        cpu, gpu = tile_bytes(tiledmap)
+        rows.append(('tiles', cpu, gpu))
+        rows.append(('tilesets', 0, sum(texture_bytes(tile.image.texture, seen)
+                for tile in tiledmap.tileset)))
+    rows.append(('texture cache', 0, sum(texture_bytes(texture, seen)
+            for texture in util.texcache.default.textures.itervalues())))
+    rows.append(('atlas', 0, sum(texture_bytes(page, seen)
+            for page in util.atlas.default.pages)))
+
+    if simulation != None:
+        rows.append(('physics', physics_bytes(simulation.physics), 0))
+        rows.append(('actors', actor_bytes(simulation.actors), 0))
+        pool = simulation.projectiles
+        rows.append(('projectiles', sum(sys.getsizeof(a) for a in (pool.x,
+            pool.y, pool.vx, pool.vy, pool.life, pool.damage, pool.layers,
+            pool.owners, pool.live, pool.free)), 0))
+    if particles != None:
+        rows.append(('particles', sum(a.nbytes for a in particles.arrays()), 0))
+    if editor != None:
+        rows.append(('editor', sys.getsizeof(editor.poly2shape) +
+                sys.getsizeof(editor.shape2poly), 0))
+    return rows
+
+def live_counts():
+    '''Live actors, components, bodies and shapes, all objects the garbage
+    collector tracks and the ones in gc.garbage it couldn't free, after a
+    collection.
+    '''
+    gc.collect()
+    objects = gc.get_objects()
+    counts = dict((name, 0) for name, cls in COUNTED)
+    counts['objects'] = len(objects)
+    counts['garbage'] = len(gc.garbage)
+    for obj in objects:
+        for name, cls in COUNTED:
+            if isinstance(obj, cls):
+                counts[name] += 1
+    return counts
+
+def print_report(rows, counts=None):
+    if not debug.DEBUG:
+        return
+    print 'DEBUG:  Memory'
+    for name, cpu, gpu in rows:
+        print '    %-14s %10.1f KB CPU %10.1f KB GPU' % (name, cpu / 1024.0,
+                gpu / 1024.0)
+    print '    %-14s %10.1f KB CPU %10.1f KB GPU' % ('total',
+            sum(row[1] for row in rows) / 1024.0,
+            sum(row[2] for row in rows) / 1024.0)
+    if counts != None:
+        print '    live: %s' % ', '.join('%d %s' % (counts[name], name)
+                for name, cls in COUNTED)
+
+def leak_check(load, unload, runs=10, warmup=2):
+    '''Calls load() and unload(level) runs times. Returns the live counts
+    after the first warmup runs, which fill caches and the like, after the
+    last run, and the names of the counts that went up on every run in
+    between. Counts that only went up once are the collector's noise.
+    '''
+    for i in range(warmup):
+        unload(load())
+    before = last = live_counts()
+    grown = set(before)
+    for i in range(runs - warmup):
+        unload(load())
+        counts = live_counts()
+        grown = set(name for name in grown if counts[name] > last[name])
+        last = counts
+    return before, last, sorted(grown)
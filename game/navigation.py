@@ -0,0 +1,631 @@
+'''Where platformer characters can walk, jump and fall, and paths through it.
+A NavGraph is built for a kind of character (a Profile) from the level's
+kinematic.CollisionGrid, so it covers the polygons from physics.from_xml and
+the solid and one-way tile layers alike:
+    - nodes are the places a character can stand, one per grid column and
+      surface, at the middle of the column
+    - walk links join neighbouring nodes the character can walk between
+    - jump and fall links are found by following the character through the
+      grid the way KinematicCharacterComponent moves it, with its speed,
+      air speed, jump speed and gravity, and seeing where it lands
+Positions in the graph are where the middle of the bottom of the box is,
+find_path takes and returns body positions.
+
+Building follows a few thousand trajectories, so graphs are cached on disk
+under a hash of the collision grid and the profile. When the editor or a
+hot reload changes the geometry, invalidate only rebuilds the columns
+around the change.
+
+find_path runs A* and keeps, for the last PATH_CACHE goals, the next link
+from every node a path to it went through. Every part of a shortest path is
+a shortest path too, so agents chasing the same goal mostly find theirs
+already there, and repathing along the way is a lookup.
+'''
+
+import os
+import array
+import heapq
+import struct
+import hashlib
+import collections
+
+import pyglet
+
+import kinematic
+import util.savefile
+
+MAGIC = 'PNAV'
+VERSION = 1
+# Relative to the script
+CACHE_DIR = 'cache/navigation'
+
+WALK = 0
+FALL = 1
+JUMP = 2
+
+# Hold the direction for the whole jump or fall
+HOLD = -1
+
+# Added to the length of a jump, so walking wins when it isn't much longer
+JUMP_COST = 32.0
+# Trajectories are followed at the simulation's tick
+TICK = 1.0 / 60.0
+# Longest jump or fall, in ticks
+MAX_FLIGHT = 120
+# Goals whose paths are kept
+PATH_CACHE = 64
+INFINITY = float('inf')
+
+_header = struct.Struct('<4sHHII')
+
+class Profile(object):
+    '''What a kind of character can do. air_speed is the acceleration it
+    steers with in the air, gravity is negative.
+    '''
+    def __init__(self, width, height, speed, air_speed, jump_speed, gravity,
+            step_height=8.0, offset_y=0.0):
+        self.width = width
+        self.height = height
+        self.speed = speed
+        self.air_speed = air_speed
+        self.jump_speed = jump_speed
+        self.gravity = gravity
+        self.step_height = step_height
+        # Middle of the box relative to the body
+        self.offset_y = offset_y
+
+    def key(self):
+        return (self.width, self.height, self.speed, self.air_speed,
+                self.jump_speed, self.gravity, self.step_height)
+
+    def feet(self, position):
+        x, y = position
+        return x, y + self.offset_y - self.height / 2.0
+
+    def body(self, x, y):
+        return x, y - self.offset_y + self.height / 2.0
+
+def profile_of(component, gravity=-900.0):
+    '''Profile of a CharacterPhysicsComponent. Dynamic characters are only
+    approximated: the air force and jump impulse become an acceleration and
+    a speed through the body's mass, and gravity is the space's.
+    '''
+    if component.kinematic:
+        return Profile(component.width, component.height, component.speed,
+                component.air_speed, component.jump_speed, component.gravity,
+                component.step_height, component.offset_y)
+
+    mass = component.body.mass
+    y = component.body.position[1]
+    left = bottom = INFINITY
+    right = top = -INFINITY
+    for shape in component.objs:
+        bb = shape.cache_bb()
+        left, bottom = min(left, bb.left), min(bottom, bb.bottom)
+        right, top = max(right, bb.right), max(top, bb.top)
+    return Profile(right - left, top - bottom, component.speed,
+            component.air_speed / mass, component.jump_force / mass, gravity,
+            offset_y=(top + bottom) / 2.0 - y)
+
+class Link(object):
+    '''A move to the target node. Jumps and falls hold direction (-1, 0 or 1)
+    until release ticks after leaving the ground, or all the way if release
+    is HOLD.
+    '''
+    __slots__ = ('target', 'kind', 'direction', 'release', 'cost')
+
+    def __init__(self, target, kind, direction, release, cost):
+        self.target = target
+        self.kind = kind
+        self.direction = direction
+        self.release = release
+        self.cost = cost
+
+def shape_top(shape, x):
+    '''Height of the top of a kinematic.ConvexShape at x, or None.
+    '''
+    if x < shape.left or x > shape.right:
+        return None
+    top = None
+    vertices = shape.vertices
+    for n in range(len(vertices)):
+        x1, y1 = vertices[n - 1]
+        x2, y2 = vertices[n]
+        if x1 == x2 or x < min(x1, x2) or x > max(x1, x2):
+            continue
+        y = y1 + (y2 - y1) * (x - x1) / float(x2 - x1)
+        if top == None or y > top:
+            top = y
+    return top
+
+class NavGraph(object):
+    def __init__(self, grid, profile):
+        self.grid = grid
+        self.profile = profile
+        # Node -> (x, y)
+        self.positions = {}
+        # Grid column -> nodes in it, bottom first
+        self.columns = {}
+        # Node -> outgoing links
+        self.links = {}
+        # Node -> (left, right) of everywhere its links were looked for, so
+        # invalidate knows which ones a change can affect
+        self.sweeps = {}
+        self.next_node = 0
+        # Goal -> {node: next link towards it, None if it can't get there},
+        # least recently used first
+        self.paths = collections.OrderedDict()
+        self.searches = 0
+        self.hits = 0
+
+    def build(self):
+        for column in xrange(self.grid.width):
+            self.sample(column)
+        for column in sorted(self.columns):
+            for node in self.columns[column]:
+                self.link(node)
+
+    def add_node(self, x, y):
+        node = self.next_node
+        self.next_node += 1
+        self.positions[node] = (x, y)
+        column = self.columns.setdefault(int(x // self.grid.cell_width), [])
+        column.append(node)
+        column.sort(key=lambda n: self.positions[n][1])
+        return node
+
+    def box(self, x, y):
+        half = self.profile.width / 2.0
+        return [x - half, y, x + half, y + self.profile.height]
+
+    def surface_heights(self, column):
+        '''Tops of everything in a grid column, at its middle.
+        '''
+        grid = self.grid
+        if not 0 <= column < grid.width:
+            return []
+        x = (column + 0.5) * grid.cell_width
+        heights = set()
+        for j in xrange(grid.height):
+            n = j * grid.width + column
+            if grid.cells[n] != kinematic.EMPTY and (j + 1 == grid.height or
+                    grid.cells[n + grid.width] != kinematic.SOLID):
+                heights.add((j + 1) * grid.cell_height)
+            for shape in grid.cell_shapes.get(n, ()):
+                top = shape_top(shape, x)
+                if top != None:
+                    heights.add(top)
+        return sorted(heights)
+
+    def stand(self, x, y):
+        '''Where a character put down on a surface at height y comes to rest,
+        or None if there's no room for it. It's lifted first so the box
+        clears slopes and steps under its corners.
+        '''
+        step = max(self.profile.step_height, 1.0)
+        for lift in (self.profile.width / 2.0 + step, step):
+            box = self.box(x, y + lift)
+            if self.grid.overlaps(*box):
+                continue
+            drop = kinematic.ground_distance(self.grid, box, lift + step)
+            if drop != None and drop <= lift + kinematic.EPSILON:
+                return y + lift - drop
+        return None
+
+    def sample(self, column):
+        x = (column + 0.5) * self.grid.cell_width
+        for height in self.surface_heights(column):
+            y = self.stand(x, height)
+            if y != None and self.find_node(column, y, 1.0) == None:
+                self.add_node(x, y)
+
+    def find_node(self, column, y, tolerance):
+        '''Node in a column closest to height y, if it's within tolerance.
+        '''
+        found = None
+        best = tolerance
+        for node in self.columns.get(column, ()):
+            distance = abs(self.positions[node][1] - y)
+            if distance <= best:
+                found = node
+                best = distance
+        return found
+
+    def land(self, x, y):
+        return self.find_node(int(x // self.grid.cell_width), y,
+                self.profile.step_height + 1.0)
+
+    def link(self, node):
+        '''Works out the links out of a node.
+        '''
+        profile = self.profile
+        x, y = self.positions[node]
+        found = {}
+        half = profile.width / 2.0
+        extent = [x - half, x + half]
+
+        def add(target, kind, direction, release):
+            if target == None or target == node:
+                return
+            tx, ty = self.positions[target]
+            cost = ((tx - x) ** 2 + (ty - y) ** 2) ** 0.5
+            if kind == JUMP:
+                cost += JUMP_COST
+            old = found.get(target)
+            if old == None or cost < old.cost:
+                found[target] = Link(target, kind, direction, release, cost)
+
+        for direction in (-1, 1):
+            box = self.box(x, y)
+            dx = direction * self.grid.cell_width
+            moved_x, moved_y, grounded = kinematic.move(self.grid, box, dx,
+                    0.0, True, profile.step_height)
+            extent[0] = min(extent[0], box[0])
+            extent[1] = max(extent[1], box[2])
+            if grounded:
+                if abs(moved_x - dx) <= kinematic.EPSILON:
+                    add(self.land(x + moved_x, y + moved_y), WALK, direction, 0)
+            else:
+                # An edge, walk off it
+                for release in (HOLD, 0):
+                    add(self.fly(x, y, 0.0, 0.0, direction, release, True,
+                        extent), FALL, direction, release)
+
+        if profile.jump_speed > 0:
+            apex = int(profile.jump_speed / -profile.gravity / TICK)
+            for direction, release in ((0, HOLD), (-1, HOLD), (1, HOLD),
+                    (-1, apex), (1, apex)):
+                add(self.fly(x, y, direction * profile.speed,
+                    profile.jump_speed, direction, release, False, extent),
+                    JUMP, direction, release)
+
+        self.links[node] = [found[target] for target in sorted(found)]
+        self.sweeps[node] = tuple(extent)
+
+    def fly(self, x, y, vx, vy, direction, release, grounded, extent):
+        '''Follows a character from (x, y) the way KinematicCharacterComponent
+        moves it and returns the node it lands on, if any. extent is widened
+        to cover everywhere it went.
+        '''
+        profile = self.profile
+        grid = self.grid
+        box = self.box(x, y)
+        airborne = 0
+        walked = 0.0
+        for tick in xrange(MAX_FLIGHT):
+            fx = direction if release == HOLD or airborne <= release else 0
+            if grounded:
+                vx = fx * profile.speed
+            else:
+                change = fx * profile.speed - vx
+                limit = profile.air_speed * TICK
+                vx += max(-limit, min(limit, change))
+            vy += profile.gravity * TICK
+
+            moved_x, moved_y, grounded = kinematic.move(grid, box, vx * TICK,
+                    vy * TICK, grounded, profile.step_height)
+            if box[0] < extent[0]:
+                extent[0] = box[0]
+            if box[2] > extent[1]:
+                extent[1] = box[2]
+            if abs(moved_x - vx * TICK) > kinematic.EPSILON:
+                vx = 0.0
+            if grounded or (vy > 0 and moved_y < vy * TICK - kinematic.EPSILON):
+                vy = 0.0
+
+            if not grounded:
+                airborne += 1
+            elif airborne:
+                return self.land((box[0] + box[2]) / 2.0, box[1])
+            else:
+                # Still walking towards the edge
+                walked += abs(moved_x)
+                if walked > grid.cell_width * 2:
+                    return None
+        return None
+
+    def invalidate(self, ranges):
+        '''Rebuilds the graph around static geometry that changed between
+        left and right, for every (left, right) in ranges. The grid must
+        have been rebaked already. Nodes near the change are sampled again,
+        and only nodes whose links went past it are relinked. Paths through
+        the rebuilt part are forgotten, the others stay valid but may not be
+        the shortest any more. Starts known to have no way to a goal are
+        always forgotten.
+        '''
+        cw = self.grid.cell_width
+        half = self.profile.width / 2.0
+        resample = set()
+        spans = []
+        for left, right in ranges:
+            first = int((left - half) // cw) - 1
+            last = int((right + half) // cw) + 1
+            resample.update(xrange(first, last + 1))
+            spans.append((first * cw, (last + 1) * cw))
+
+        touched = set()
+        for column in resample:
+            for node in self.columns.pop(column, ()):
+                del self.positions[node]
+                self.links.pop(node, None)
+                self.sweeps.pop(node, None)
+                touched.add(node)
+        for column in sorted(resample):
+            self.sample(column)
+
+        for node in sorted(self.positions):
+            sweep = self.sweeps.get(node)
+            if sweep == None or [span for span in spans
+                    if sweep[0] < span[1] and span[0] < sweep[1]]:
+                self.link(node)
+                touched.add(node)
+
+        for goal in self.paths.keys():
+            tree = self.paths[goal]
+            if goal in touched or not touched.isdisjoint(tree):
+                del self.paths[goal]
+                continue
+            # The change may have opened a way from anywhere
+            for start in [start for start, link in tree.iteritems()
+                    if link == None]:
+                del tree[start]
+        return len(touched)
+
+    def nearest(self, x, y):
+        '''Node closest to a position.
+        '''
+        if not self.columns:
+            return None
+        cw = self.grid.cell_width
+        column = int(x // cw)
+        low = min(self.columns)
+        high = max(self.columns)
+        found = None
+        best = INFINITY
+        k = 0
+        while (k - 1) * cw <= best and (column - k >= low or column + k <= high):
+            for c in sorted(set((column - k, column + k))):
+                for node in self.columns.get(c, ()):
+                    nx, ny = self.positions[node]
+                    distance = ((nx - x) ** 2 + (ny - y) ** 2) ** 0.5
+                    if distance < best:
+                        found = node
+                        best = distance
+            k += 1
+        return found
+
+    def find_path(self, start, goal):
+        '''Links from the node nearest the body position start to the one
+        nearest goal. Empty if they're the same, None if there's no way.
+        '''
+        a = self.nearest(*self.profile.feet(start))
+        b = self.nearest(*self.profile.feet(goal))
+        if a == None or b == None:
+            return None
+        return self.path(a, b)
+
+    def path(self, start, goal):
+        '''Links from node start to node goal, None if there's no way.
+        '''
+        tree = self.paths.pop(goal, None)
+        if tree == None:
+            tree = {}
+        self.paths[goal] = tree
+        if len(self.paths) > PATH_CACHE:
+            self.paths.popitem(last=False)
+
+        if start != goal and start not in tree:
+            links = self.search(start, goal)
+            if links == None:
+                tree[start] = None
+            else:
+                node = start
+                for link in links:
+                    tree[node] = link
+                    node = link.target
+        else:
+            self.hits += 1
+
+        links = []
+        node = start
+        while node != goal:
+            link = tree[node]
+            if link == None:
+                return None
+            links.append(link)
+            node = link.target
+        return links
+
+    def search(self, start, goal):
+        '''A*. Links are never shorter than the distance between their ends,
+        so the straight line distance is a consistent estimate.
+        '''
+        self.searches += 1
+        positions = self.positions
+        gx, gy = positions[goal]
+
+        def estimate(node):
+            x, y = positions[node]
+            return ((x - gx) ** 2 + (y - gy) ** 2) ** 0.5
+
+        costs = {start: 0.0}
+        came = {}
+        closed = set()
+        # Ties go to the node queued first
+        order = 0
+        queue = [(estimate(start), order, start)]
+        while queue:
+            f, n, node = heapq.heappop(queue)
+            if node == goal:
+                break
+            if node in closed:
+                continue
+            closed.add(node)
+            cost = costs[node]
+            for link in self.links.get(node, ()):
+                g = cost + link.cost
+                if g < costs.get(link.target, INFINITY):
+                    costs[link.target] = g
+                    came[link.target] = (node, link)
+                    order += 1
+                    heapq.heappush(queue, (g + estimate(link.target), order,
+                        link.target))
+        else:
+            return None
+
+        links = []
+        node = goal
+        while node != start:
+            node, link = came[node]
+            links.append(link)
+        links.reverse()
+        return links
+
+def graph_key(grid, profile):
+    '''sha1 of everything a graph is built from.
+    '''
+    digest = hashlib.sha1()
+    digest.update(repr((VERSION, grid.cell_width, grid.cell_height,
+        grid.width, grid.height, profile.key())))
+    digest.update(grid.cells.tostring())
+    shapes = set()
+    for cell in grid.cell_shapes.itervalues():
+        for shape in cell:
+            shapes.add(tuple(shape.vertices))
+    digest.update(repr(sorted(shapes)))
+    return digest.digest()
+
+def graph_to_binary(graph):
+    '''Packs a graph: a header with the node and link counts, the position
+    and sweep of every node as doubles, then the source and target (int32),
+    kind and direction (int8) and release (int16) of every link. Nodes are
+    numbered in order, costs are worked out again on load.
+    '''
+    nodes = sorted(graph.positions)
+    number = dict((node, n) for n, node in enumerate(nodes))
+    positions = array.array('d')
+    sweeps = array.array('d')
+    for node in nodes:
+        positions.extend(graph.positions[node])
+        sweeps.extend(graph.sweeps[node])
+
+    sources = array.array('i')
+    targets = array.array('i')
+    kinds = array.array('b')
+    directions = array.array('b')
+    releases = array.array('h')
+    for node in nodes:
+        for link in graph.links.get(node, ()):
+            sources.append(number[node])
+            targets.append(number[link.target])
+            kinds.append(link.kind)
+            directions.append(link.direction)
+            releases.append(link.release)
+
+    return ''.join([_header.pack(MAGIC, VERSION, 0, len(nodes), len(sources))] +
+            [a.tostring() for a in (positions, sweeps, sources, targets,
+                kinds, directions, releases)])
+
+def binary_to_graph(data, grid, profile):
+    '''The graph packed in data, or None if it isn't a graph of this version.
+    '''
+    try:
+        magic, version, reserved, count, link_count = _header.unpack_from(data, 0)
+    except struct.error:
+        return None
+    if magic != MAGIC or version != VERSION:
+        return None
+
+    arrays = []
+    offset = _header.size
+    for code, size in (('d', count * 2), ('d', count * 2), ('i', link_count),
+            ('i', link_count), ('b', link_count), ('b', link_count),
+            ('h', link_count)):
+        a = array.array(code)
+        end = offset + size * a.itemsize
+        a.fromstring(data[offset:end])
+        if len(a) != size:
+            return None
+        arrays.append(a)
+        offset = end
+    positions, sweeps, sources, targets, kinds, directions, releases = arrays
+
+    graph = NavGraph(grid, profile)
+    for n in xrange(count):
+        graph.add_node(positions[n * 2], positions[n * 2 + 1])
+    for node in xrange(count):
+        graph.links[node] = []
+        graph.sweeps[node] = (sweeps[node * 2], sweeps[node * 2 + 1])
+    for n in xrange(link_count):
+        source = sources[n]
+        target = targets[n]
+        x, y = graph.positions[source]
+        tx, ty = graph.positions[target]
+        cost = ((tx - x) ** 2 + (ty - y) ** 2) ** 0.5
+        if kinds[n] == JUMP:
+            cost += JUMP_COST
+        graph.links[source].append(Link(target, kinds[n], directions[n],
+            releases[n], cost))
+    return graph
+
+class GraphCache(object):
+    '''On-disk cache of navigation graphs, laid out like util.texcache.
+    Entries are named after a hash of the level name and the profile, and
+    the graph_key, so a changed level gets a new entry and the old one is
+    deleted when the new one is written.
+    '''
+    def __init__(self, directory=None):
+        self.directory = directory
+
+    def get_directory(self):
+        if self.directory == None:
+            self.directory = os.path.join(pyglet.resource.get_script_home(),
+                    CACHE_DIR)
+        return self.directory
+
+    def entry_prefix(self, name, profile):
+        return hashlib.sha1(repr((name, profile.key()))).hexdigest()[:16] + '-'
+
+    def entry_filename(self, name, profile, key):
+        return os.path.join(self.get_directory(),
+                self.entry_prefix(name, profile) + key.encode('hex') + '.nav')
+
+    def load(self, grid, profile, name=''):
+        '''The NavGraph of a grid for a profile, from the cache if it was
+        built before. name tells levels apart for cleaning up old entries.
+        '''
+        filename = self.entry_filename(name, profile, graph_key(grid, profile))
+        graph = self.read_entry(filename, grid, profile)
+        if graph == None:
+            graph = NavGraph(grid, profile)
+            graph.build()
+            self.write_entry(name, profile, filename, graph)
+        return graph
+
+    def read_entry(self, filename, grid, profile):
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            return None
+        try:
+            return binary_to_graph(f.read(), grid, profile)
+        finally:
+            f.close()
+
+    def write_entry(self, name, profile, filename, graph):
+        directory = self.get_directory()
+        prefix = self.entry_prefix(name, profile)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            for old in os.listdir(directory):
+                if old.startswith(prefix):
+                    os.remove(os.path.join(directory, old))
+            util.savefile.atomic_write(filename, graph_to_binary(graph))
+        except (IOError, OSError):
+            # Read-only installs build the graph every time
+            pass
+
+# Shared cache
+default = GraphCache()
+load = default.load
@@ -0,0 +1,470 @@
+'''Authoritative simulation server and client for hosting a level over UDP.
+The server runs a headless Simulation at a fixed tick. Clients send their
+input actions and the server sends every client its own snapshot of the
+actor transforms it is interested in, i.e. those near its player.
+Snapshots are delta compressed against the last snapshot the client
+acknowledged. Transforms are quantized (1/8 pixel positions, 16 bit angles)
+and bit-packed, so an actor that didn't move costs nothing and one that
+moved a little costs a couple of bytes.
+Clients buffer snapshots and interpolate between them a few ticks behind
+the newest one.
+
+Packets, all little endian:
+    hello       type
+    welcome     type, client id (H), player net id (H)
+    input       type, client id (H), acked snapshot tick (I), frame count (B),
+                then controls.pack_actions frames. Frames are resent until
+                the server acknowledges them.
+    snapshot    type, tick (I), base tick (I), acked input frame (I),
+                then the bit-packed payload
+    bye         type, client id (H)
+'''
+
+import math
+import socket
+import struct
+import time
+import errno
+
+import debug
+import controls
+
+MSG_HELLO = 1
+MSG_WELCOME = 2
+MSG_INPUT = 3
+MSG_SNAPSHOT = 4
+MSG_BYE = 5
+
+# Quantization
+POSITION_SCALE = 8.0
+ANGLE_STEPS = 65536
+
+MAX_PACKET = 65507
+
+_type = struct.Struct('<B')
+_welcome = struct.Struct('<BHH')
+_input = struct.Struct('<BHIB')
+_snapshot = struct.Struct('<BIII')
+_bye = struct.Struct('<BH')
+
+def quantize(x, y, angle):
+    return (int(round(x * POSITION_SCALE)), int(round(y * POSITION_SCALE)),
+            int(round(angle / (2 * math.pi) * ANGLE_STEPS)) % ANGLE_STEPS)
+
+def dequantize(qx, qy, qa):
+    return (qx / POSITION_SCALE, qy / POSITION_SCALE,
+            qa * 2 * math.pi / ANGLE_STEPS)
+
+class BitWriter(object):
+    def __init__(self):
+        self.bytes = bytearray()
+        self.scratch = 0
+        self.bits = 0
+
+    def write(self, value, bits):
+        self.scratch |= (value & ((1 << bits) - 1)) << self.bits
+        self.bits += bits
+        while self.bits >= 8:
+            self.bytes.append(self.scratch & 0xff)
+            self.scratch >>= 8
+            self.bits -= 8
+
+    def getvalue(self):
+        data = bytearray(self.bytes)
+        if self.bits:
+            data.append(self.scratch & 0xff)
+        return str(data)
+
+class BitReader(object):
+    def __init__(self, data, offset=0):
+        self.data = bytearray(data)
+        self.position = offset * 8
+
+    def read(self, bits):
+        value = 0
+        shift = 0
+        while bits:
+            index, bit = divmod(self.position, 8)
+            take = min(bits, 8 - bit)
+            chunk = (self.data[index] >> bit) & ((1 << take) - 1)
+            value |= chunk << shift
+            shift += take
+            bits -= take
+            self.position += take
+        return value
+
+def _write_delta(writer, old, new):
+    '''Writes one quantized coordinate. Unchanged costs one bit, small
+    changes ten and anything else 34.
+    '''
+    if old == new:
+        writer.write(0, 1)
+        return
+    writer.write(1, 1)
+
+    delta = new - old
+    # Zigzag so small negative deltas are small numbers too
+    zigzag = (delta << 1) ^ (delta >> 63)
+    if zigzag < 256:
+        writer.write(0, 1)
+        writer.write(zigzag, 8)
+    else:
+        writer.write(1, 1)
+        writer.write(new & 0xffffffff, 32)
+
+def _read_delta(reader, old):
+    if not reader.read(1):
+        return old
+    if not reader.read(1):
+        zigzag = reader.read(8)
+        return old + ((zigzag >> 1) ^ -(zigzag & 1))
+    value = reader.read(32)
+    if value & 0x80000000:
+        value -= 1 << 32
+    return value
+
+def encode_snapshot(base, current):
+    '''Bit-packs the entity states in current (net id -> quantized
+    transform) as changes against base.
+    '''
+    writer = BitWriter()
+
+    removed = [net_id for net_id in base if net_id not in current]
+    writer.write(len(removed), 16)
+    for net_id in sorted(removed):
+        writer.write(net_id, 16)
+
+    changed = [net_id for net_id, state in current.iteritems()
+            if base.get(net_id) != state]
+    writer.write(len(changed), 16)
+    for net_id in sorted(changed):
+        old = base.get(net_id, (0, 0, 0))
+        qx, qy, qa = current[net_id]
+        writer.write(net_id, 16)
+        _write_delta(writer, old[0], qx)
+        _write_delta(writer, old[1], qy)
+        if old[2] == qa:
+            writer.write(0, 1)
+        else:
+            writer.write(1, 1)
+            writer.write(qa, 16)
+    return writer.getvalue()
+
+def decode_snapshot(base, data, offset=0):
+    reader = BitReader(data, offset)
+    state = dict(base)
+
+    for i in range(reader.read(16)):
+        state.pop(reader.read(16), None)
+
+    for i in range(reader.read(16)):
+        net_id = reader.read(16)
+        old = base.get(net_id, (0, 0, 0))
+        qx = _read_delta(reader, old[0])
+        qy = _read_delta(reader, old[1])
+        qa = reader.read(16) if reader.read(1) else old[2]
+        state[net_id] = (qx, qy, qa)
+    return state
+
+def _make_socket(address):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(address)
+    sock.setblocking(False)
+    return sock
+
+def _receive(sock):
+    '''Yields every (data, address) waiting on a non-blocking socket.
+    '''
+    while True:
+        try:
+            yield sock.recvfrom(MAX_PACKET)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            # Windows reports ICMP port unreachable as a receive error
+            if e.args[0] == getattr(errno, 'WSAECONNRESET', None):
+                continue
+            raise
+
+class RemoteClient(object):
+    def __init__(self, client_id, address, player, player_id):
+        self.client_id = client_id
+        self.address = address
+        self.player = player
+        self.player_id = player_id
+        # Highest snapshot tick the client has acknowledged
+        self.acked = 0
+        # Highest input frame applied
+        self.input_frame = 0
+        # tick -> entity states sent on that tick, kept until acknowledged
+        self.sent = {}
+        self.bytes_sent = 0
+        self.packets_sent = 0
+
+class Server(object):
+    '''Hosts one simulation. Call step() once per tick, or serve_forever().
+    spawn_player is called with the simulation and a client id and must
+    return the actor that client controls.
+    '''
+    def __init__(self, simulation, spawn_player, address=('0.0.0.0', 27960),
+            interest_radius=800.0, snapshot_interval=1):
+        self.simulation = simulation
+        self.spawn_player = spawn_player
+        self.socket = _make_socket(address)
+        self.address = self.socket.getsockname()
+        self.interest_radius = interest_radius
+        self.snapshot_interval = snapshot_interval
+        self.clients = {}
+        self.addresses = {}
+        self.next_client_id = 1
+        # actor name -> net id
+        self.net_ids = {}
+        self.next_net_id = 1
+        self.tick_times = []
+
+    def net_id(self, actor):
+        net_id = self.net_ids.get(actor.name)
+        if net_id == None:
+            net_id = self.next_net_id
+            self.next_net_id += 1
+            self.net_ids[actor.name] = net_id
+        return net_id
+
+    def step(self):
+        start = time.time()
+        for data, address in _receive(self.socket):
+            try:
+                self.handle_packet(data, address)
+            except (struct.error, ValueError):
+                debug.msg('Dropped malformed packet from %s:%d' % address)
+
+        self.simulation.step()
+
+        if self.simulation.tick % self.snapshot_interval == 0:
+            self.send_snapshots()
+        self.tick_times.append(time.time() - start)
+
+    def serve_forever(self):
+        debug.msg('Serving %s on %s:%d' % ((self.simulation.map_filename,) +
+            self.address))
+        dt = self.simulation.dt
+        next_tick = time.time()
+        while True:
+            self.step()
+            next_tick += dt
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def handle_packet(self, data, address):
+        kind, = _type.unpack_from(data)
+        if kind == MSG_HELLO:
+            client = self.addresses.get(address)
+            if client == None:
+                client = self.connect(address)
+            self.send(client, _welcome.pack(MSG_WELCOME, client.client_id,
+                client.player_id))
+        elif kind == MSG_INPUT:
+            kind, client_id, acked, count = _input.unpack_from(data)
+            client = self.clients.get(client_id)
+            if client == None or client.address != address:
+                return
+
+            # All of it is read first, a malformed packet changes nothing
+            frames = []
+            offset = _input.size
+            for i in range(count):
+                frame, events, offset = controls.unpack_actions(data, offset)
+                frames.append((frame, events))
+
+            if acked > client.acked:
+                client.acked = acked
+                for tick in [t for t in client.sent if t < acked]:
+                    del client.sent[tick]
+
+            player_input = client.player.get_component('input')
+            for frame, events in frames:
+                # Frames are resent until acknowledged, skip old ones
+                if frame <= client.input_frame:
+                    continue
+                client.input_frame = frame
+                for action, pressed in events:
+                    player_input.on_action(action, pressed)
+        elif kind == MSG_BYE:
+            kind, client_id = _bye.unpack_from(data)
+            client = self.clients.get(client_id)
+            if client != None and client.address == address:
+                self.disconnect(client)
+
+    def connect(self, address):
+        client_id = self.next_client_id
+        self.next_client_id += 1
+        player = self.spawn_player(self.simulation, client_id)
+        client = RemoteClient(client_id, address, player, self.net_id(player))
+        self.clients[client_id] = client
+        self.addresses[address] = client
+        debug.msg('Client %d connected from %s:%d' % ((client_id,) + address))
+        return client
+
+    def disconnect(self, client):
+        del self.clients[client.client_id]
+        del self.addresses[client.address]
+        self.simulation.actors.remove_actor(client.player)
+        debug.msg('Client %d disconnected' % client.client_id)
+
+    def world_state(self):
+        '''Quantized transforms of every physics actor, with positions for
+        interest checks.
+        '''
+        states = []
+        for a in self.simulation.actors.get_actors():
+            if not a.has_component('physics'):
+                continue
+            body = a.get_component('physics').body
+            x, y = body.position
+            states.append((self.net_id(a), x, y, quantize(x, y, body.angle)))
+        return states
+
+    def send_snapshots(self):
+        states = self.world_state()
+        tick = self.simulation.tick
+        radius2 = self.interest_radius ** 2
+
+        for client in self.clients.values():
+            px, py = client.player.get_component('physics').body.position
+            current = {}
+            for net_id, x, y, state in states:
+                if net_id == client.player_id or \
+                        (x - px) ** 2 + (y - py) ** 2 <= radius2:
+                    current[net_id] = state
+
+            base_tick = client.acked if client.acked in client.sent else 0
+            base = client.sent.get(base_tick, {})
+            payload = encode_snapshot(base, current)
+            client.sent[tick] = current
+            # Don't pile up history for a client that stopped acknowledging
+            if len(client.sent) > Client.history:
+                for old in sorted(client.sent)[:-Client.history]:
+                    if old != client.acked:
+                        del client.sent[old]
+
+            self.send(client, _snapshot.pack(MSG_SNAPSHOT, tick, base_tick,
+                client.input_frame) + payload)
+
+    def send(self, client, data):
+        self.socket.sendto(data, client.address)
+        client.bytes_sent += len(data)
+        client.packets_sent += 1
+
+class Client(object):
+    '''Connects to a server, sends input and keeps an interpolation buffer
+    of the snapshots it receives.
+    '''
+    # Ticks of snapshots kept for decoding deltas and interpolating
+    history = 64
+
+    def __init__(self, server_address, address=('0.0.0.0', 0),
+            interpolation_delay=6):
+        self.server_address = server_address
+        self.socket = _make_socket(address)
+        self.interpolation_delay = interpolation_delay
+        self.client_id = None
+        self.player_id = None
+        self.snapshots = {}
+        self.latest = 0
+        self.input_frame = 0
+        # (frame, events) not yet acknowledged by the server
+        self.pending_input = []
+        self.bytes_received = 0
+
+    def connect(self):
+        self.socket.sendto(_type.pack(MSG_HELLO), self.server_address)
+
+    def disconnect(self):
+        if self.client_id != None:
+            self.socket.sendto(_bye.pack(MSG_BYE, self.client_id),
+                    self.server_address)
+        self.socket.close()
+
+    def send_input(self, events):
+        if self.client_id == None:
+            return
+
+        if events:
+            self.input_frame += 1
+            self.pending_input.append((self.input_frame, events))
+        # Stay well inside the frame count byte and the packet size
+        frames = self.pending_input[-32:]
+        data = [_input.pack(MSG_INPUT, self.client_id, self.latest, len(frames))]
+        for frame, frame_events in frames:
+            data.append(controls.pack_actions(frame, frame_events))
+        self.socket.sendto(''.join(data), self.server_address)
+
+    def poll(self):
+        for data, address in _receive(self.socket):
+            if address != self.server_address:
+                continue
+            self.bytes_received += len(data)
+            kind, = _type.unpack_from(data)
+            if kind == MSG_WELCOME:
+                kind, self.client_id, self.player_id = _welcome.unpack(data)
+            elif kind == MSG_SNAPSHOT:
+                self.handle_snapshot(data)
+
+    def handle_snapshot(self, data):
+        kind, tick, base_tick, input_ack = _snapshot.unpack_from(data)
+        if tick <= self.latest:
+            # Late or duplicate
+            return
+        if base_tick and base_tick not in self.snapshots:
+            # Can't decode without the base, the next snapshot will use an
+            # older acknowledged one
+            return
+
+        base = self.snapshots.get(base_tick, {}) if base_tick else {}
+        self.snapshots[tick] = decode_snapshot(base, data, _snapshot.size)
+        self.latest = tick
+        self.pending_input = [(f, e) for f, e in self.pending_input
+                if f > input_ack]
+
+        for old in [t for t in self.snapshots if t <= tick - self.history]:
+            del self.snapshots[old]
+
+    def sample(self, render_tick=None):
+        '''Interpolated transforms (net id -> (x, y, angle)) at the given
+        tick, by default interpolation_delay ticks behind the newest
+        snapshot.
+        '''
+        if not self.snapshots:
+            return {}
+        if render_tick == None:
+            render_tick = self.latest - self.interpolation_delay
+
+        ticks = sorted(self.snapshots)
+        before = ticks[0]
+        after = ticks[-1]
+        for t in ticks:
+            if t <= render_tick:
+                before = t
+            if t >= render_tick:
+                after = t
+                break
+
+        a = self.snapshots[before]
+        if after == before:
+            return dict((i, dequantize(*s)) for i, s in a.iteritems())
+
+        b = self.snapshots[after]
+        alpha = (render_tick - before) / float(after - before)
+        result = {}
+        for net_id, (ax, ay, aa) in a.iteritems():
+            state = b.get(net_id)
+            if state == None:
+                result[net_id] = dequantize(ax, ay, aa)
+                continue
+            bx, by, ba = state
+            # Shortest way around the circle
+            da = (ba - aa + ANGLE_STEPS / 2) % ANGLE_STEPS - ANGLE_STEPS / 2
+            result[net_id] = dequantize(ax + (bx - ax) * alpha,
+                    ay + (by - ay) * alpha, aa + da * alpha)
+        return result
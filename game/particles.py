@@ -0,0 +1,319 @@
+'''Particles for dust, impacts, debris and the like.
+Particles aren't actors. A ParticleSystem keeps all of them in NumPy arrays
+and updates them together once per tick, packed at the front:
+    position, velocity  (capacity, 2) float32, pixels and pixels per second
+    life, lifetime      seconds left and in total
+    color               (capacity, 4) uint8, faded out over the life on draw
+    frame               animation frame, from 0 to frames - 1 over the life
+    size, weight        quad size in pixels and how much gravity pulls
+With a collision grid set, particles bounce off the static geometry. The grid
+is coarse: cells only partly covered by a polygon count as solid, one-way
+platforms don't count.
+Dead particles stay in the arrays, invisible, until they're more than
+COMPACT of them or emitting needs the room.
+
+ParticleSystem never touches GL, so effects can be updated and benchmarked
+headless. ParticleLayer draws one from a single vertex list.
+
+NumPy is optional. Without it AVAILABLE is False and there are no particles.
+'''
+
+import ctypes
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import pyglet
+from pyglet.gl import *
+import cocos
+
+import kinematic
+
+AVAILABLE = numpy != None
+
+# Most particles alive at once, emitting more drops the extras
+CAPACITY = 100000
+# Fraction of the speed kept when bouncing off and when sliding along a wall
+BOUNCE = 0.4
+FRICTION = 0.8
+# Fraction of dead particles that gets them dropped
+COMPACT = 0.125
+# The vertex list grows and shrinks in steps of this many quads
+QUAD_STEP = 1024
+
+class ParticleSystem(object):
+    def __init__(self, capacity=CAPACITY, gravity=-900.0, drag=0.5, frames=1,
+            seed=0):
+        self.capacity = capacity
+        # Particles in the arrays, dead ones included
+        self.count = 0
+        self.dead = 0
+        self.position = numpy.zeros((capacity, 2), numpy.float32)
+        self.velocity = numpy.zeros((capacity, 2), numpy.float32)
+        self.life = numpy.zeros(capacity, numpy.float32)
+        self.lifetime = numpy.ones(capacity, numpy.float32)
+        self.color = numpy.zeros((capacity, 4), numpy.uint8)
+        self.frame = numpy.zeros(capacity, numpy.uint16)
+        self.size = numpy.zeros(capacity, numpy.float32)
+        self.weight = numpy.zeros(capacity, numpy.float32)
+        self.gravity = gravity
+        # Fraction of the velocity lost per second
+        self.drag = drag
+        self.frames = frames
+        # Effects look the same every run
+        self.random = numpy.random.RandomState(seed)
+        # Solid cells of grid as flat bool, with an empty border so lookups
+        # only need clamping. See set_collision.
+        self.grid = None
+        self.grid_version = None
+        self.solid = None
+        self.columns = 0
+        self.rows = 0
+        self.cell_width = 0
+        self.cell_height = 0
+        # Particles that didn't fit
+        self.dropped = 0
+
+    def arrays(self):
+        return (self.position, self.velocity, self.life, self.lifetime,
+                self.color, self.frame, self.size, self.weight)
+
+    def set_collision(self, grid):
+        '''Bounces particles off the solid cells of a kinematic.CollisionGrid,
+        following it when it's rebuilt. None turns collision off.
+        '''
+        self.grid = grid
+        self.grid_version = None
+        self.solid = None
+        if grid == None:
+            return
+        self.grid_version = grid.version
+        cells = numpy.array(grid.cells, numpy.uint8).reshape(grid.height,
+                grid.width)
+        solid = cells == kinematic.SOLID
+        for n in grid.cell_shapes:
+            solid.flat[n] = True
+        self.rows = grid.height
+        self.columns = grid.width
+        padded = numpy.zeros((self.rows + 2, self.columns + 2), bool)
+        padded[1:-1, 1:-1] = solid
+        self.solid = padded.ravel()
+        self.cell_width = float(grid.cell_width)
+        self.cell_height = float(grid.cell_height)
+
+    def emit(self, x, y, count, speed=100.0, angle=90.0, spread=360.0,
+            life=1.0, color=(255, 255, 255, 255), size=4.0, weight=1.0,
+            jitter=0.25):
+        '''Emits count particles from (x, y) at speed, in directions spread
+        degrees wide around angle. Speeds and lives vary by up to jitter.
+        Returns how many fit.
+        '''
+        if self.dead and self.count + count > self.capacity:
+            self.compact()
+        n = min(count, self.capacity - self.count)
+        self.dropped += count - n
+        if n <= 0:
+            return 0
+        start = self.count
+        end = start + n
+        random = self.random
+
+        directions = numpy.radians(angle + (random.random_sample(n) - 0.5) * spread)
+        speeds = speed * (1.0 - jitter * random.random_sample(n))
+        self.position[start:end] = (x, y)
+        self.velocity[start:end, 0] = numpy.cos(directions) * speeds
+        self.velocity[start:end, 1] = numpy.sin(directions) * speeds
+        lifetimes = life * (1.0 - jitter * random.random_sample(n))
+        self.life[start:end] = lifetimes
+        self.lifetime[start:end] = lifetimes
+        self.color[start:end] = color
+        self.frame[start:end] = 0
+        self.size[start:end] = size
+        self.weight[start:end] = weight
+        self.count = end
+        return n
+
+    def update(self, dt):
+        n = self.count
+        if n == 0:
+            return
+        position = self.position[:n]
+        velocity = self.velocity[:n]
+        life = self.life[:n]
+
+        if self.grid != None and self.grid.version != self.grid_version:
+            self.set_collision(self.grid)
+
+        velocity[:, 1] += self.gravity * dt * self.weight[:n]
+        if self.drag:
+            velocity *= max(0.0, 1.0 - self.drag * dt)
+        if self.solid is not None:
+            old = position.copy()
+            position += velocity * dt
+            self.collide(old, position, velocity)
+        else:
+            position += velocity * dt
+
+        life -= dt
+        if self.frames > 1:
+            self.frame[:n] = numpy.minimum(
+                    (1.0 - life / self.lifetime[:n]) * self.frames,
+                    self.frames - 1)
+        self.dead = n - numpy.count_nonzero(life > 0)
+        if self.dead > n * COMPACT:
+            self.compact()
+
+    def blocked(self, x, y):
+        '''Which of the points are in a solid cell.
+        '''
+        # Clamped into the border, which makes the truncation a floor
+        i = x * (1.0 / self.cell_width)
+        numpy.clip(i, -1, self.columns, out=i)
+        i += 1
+        j = y * (1.0 / self.cell_height)
+        numpy.clip(j, -1, self.rows, out=j)
+        j += 1
+        index = j.astype(numpy.intp)
+        index *= self.columns + 2
+        index += i.astype(numpy.intp)
+        return self.solid.take(index)
+
+    def collide(self, old, position, velocity):
+        '''Moves particles that ended up in a solid cell back along the axis
+        they came in on and bounces them.
+        '''
+        hit = numpy.flatnonzero(self.blocked(position[:, 0], position[:, 1]))
+        if not len(hit):
+            return
+        ox, oy = old[hit, 0], old[hit, 1]
+        nx, ny = position[hit, 0], position[hit, 1]
+        flip_x = self.blocked(nx, oy)
+        flip_y = self.blocked(ox, ny)
+        # Straight into a corner
+        corner = ~flip_x & ~flip_y
+        flip_x |= corner
+        flip_y |= corner
+
+        vx, vy = velocity[hit, 0], velocity[hit, 1]
+        position[hit, 0] = numpy.where(flip_x, ox, nx)
+        position[hit, 1] = numpy.where(flip_y, oy, ny)
+        velocity[hit, 0] = numpy.where(flip_x, -vx * BOUNCE, vx * FRICTION)
+        velocity[hit, 1] = numpy.where(flip_y, -vy * BOUNCE, vy * FRICTION)
+
+    def compact(self):
+        '''Drops dead particles, keeping the order of the rest.
+        '''
+        keep = numpy.flatnonzero(self.life[:self.count] > 0)
+        for a in self.arrays():
+            a[:len(keep)] = a[keep]
+        self.count = len(keep)
+        self.dead = 0
+
+    def clear(self):
+        self.count = 0
+        self.dead = 0
+
+def frame_coords(image, frames):
+    '''Texture coordinates of frames cut side by side out of an image, as
+    (frames, 12) float32.
+    '''
+    coords = image.get_texture().tex_coords
+    u1, v1, r = coords[0], coords[1], coords[2]
+    u2, v2 = coords[6], coords[7]
+    table = numpy.zeros((frames, 4, 3), numpy.float32)
+    width = (u2 - u1) / frames
+    for f in range(frames):
+        left = u1 + width * f
+        table[f] = ((left, v1, r), (left + width, v1, r), (left + width, v2, r),
+                (left, v2, r))
+    return table.reshape(frames, 12)
+
+class ParticleLayer(cocos.layer.ScrollableLayer):
+    '''Draws a ParticleSystem. Particles are colored squares, or quads
+    textured with their frame of image if there is one.
+    '''
+    def __init__(self, system, image=None):
+        super(ParticleLayer, self).__init__()
+        self.system = system
+        self.image = image
+        self.texture = image.get_texture() if image != None else None
+        self.frames = frame_coords(image, system.frames) if image != None else None
+        self.vertex_list = None
+        # Quads the vertex list holds
+        self.quads = 0
+        # Staging arrays the vertex list is copied from, as big as the
+        # biggest vertex list fill makes
+        capacity = (system.capacity + QUAD_STEP - 1) / QUAD_STEP * QUAD_STEP
+        self.vertices = numpy.zeros((capacity, 4, 2), numpy.float32)
+        self.colors = numpy.zeros((capacity, 4, 4), numpy.uint8)
+        self.tex_coords = numpy.zeros((capacity, 12), numpy.float32)
+
+    def on_exit(self):
+        super(ParticleLayer, self).on_exit()
+        if self.vertex_list != None:
+            self.vertex_list.delete()
+            self.vertex_list = None
+            self.quads = 0
+
+    def fill(self, n):
+        '''Writes the first n particles to the vertex list, growing or
+        shrinking it in steps of QUAD_STEP. Leftover quads are empty.
+        '''
+        quads = (n + QUAD_STEP - 1) / QUAD_STEP * QUAD_STEP
+        if quads != self.quads:
+            if self.vertex_list != None:
+                self.vertex_list.delete()
+            formats = ['v2f/stream', 'c4B/stream']
+            if self.texture != None:
+                formats.append('t3f/stream')
+            self.vertex_list = pyglet.graphics.vertex_list(quads * 4, *formats)
+            self.quads = quads
+
+        system = self.system
+        position = system.position[:n]
+        half = system.size[:n, numpy.newaxis] * 0.5
+        vertices = self.vertices
+        vertices[:n, 0] = position - half
+        vertices[:n, 1, 0] = position[:, 0] + half[:, 0]
+        vertices[:n, 1, 1] = position[:, 1] - half[:, 0]
+        vertices[:n, 2] = position + half
+        vertices[:n, 3, 0] = position[:, 0] - half[:, 0]
+        vertices[:n, 3, 1] = position[:, 1] + half[:, 0]
+        vertices[n:quads] = 0
+
+        colors = self.colors
+        colors[:n] = system.color[:n, numpy.newaxis]
+        # Dead ones too, until they're dropped
+        colors[:n, :, 3] = (system.color[:n, 3] * (numpy.maximum(system.life[:n],
+            0) / system.lifetime[:n]))[:, numpy.newaxis]
+
+        ctypes.memmove(self.vertex_list.vertices, vertices.ctypes.data,
+                quads * 4 * 2 * 4)
+        ctypes.memmove(self.vertex_list.colors, colors.ctypes.data,
+                quads * 4 * 4)
+        if self.texture != None:
+            self.tex_coords[:n] = self.frames[system.frame[:n]]
+            ctypes.memmove(self.vertex_list.tex_coords,
+                    self.tex_coords.ctypes.data, quads * 12 * 4)
+
+    def draw(self):
+        n = self.system.count
+        if n == 0:
+            return
+        self.fill(n)
+
+        glPushMatrix()
+        self.transform()
+        glPushAttrib(GL_ENABLE_BIT | GL_COLOR_BUFFER_BIT)
+        glEnable(GL_BLEND)
+        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+        if self.texture != None:
+            glEnable(self.texture.target)
+            glBindTexture(self.texture.target, self.texture.id)
+        else:
+            glDisable(GL_TEXTURE_2D)
+        self.vertex_list.draw(GL_QUADS)
+        glPopAttrib()
+        glPopMatrix()
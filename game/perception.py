@@ -0,0 +1,199 @@
+'''What AI actors can see, answered in batches.
+AI components don't query the space themselves. They ask the simulation's
+Perception for line of sight to a point, the nearest target or the targets
+within a radius, and get the answer on a later tick. Every tick the queued
+queries run together:
+    - at most budget of them, oldest first. The rest wait for the next
+      tick, so thousands of enemies cost the same per frame as a few
+      hundred, they just notice things less often.
+    - sorted by the grid cell they start in, so queries from the same part
+      of the level run together
+    - answers are cached for the tick. Line of sight from the same cell to
+      the same cell is only traced once.
+    - targets are hashed into cells once per tick for the radius and
+      nearest queries
+A requester has at most one query of each kind (and tag) waiting. Asking
+again before it ran only updates it.
+
+Layers work like chipmunk's: a query for LAYER_ENEMY finds whatever enemies
+collide with, e.g. the player. Sight is blocked by shapes in LAYER_SIGHT,
+which the static geometry is in by default.
+'''
+
+import collections
+
+from physics import LAYER_SIGHT
+
+# Queries answered per tick
+BUDGET = 256
+# Cell size for sorting, caching and the target hash
+CELL = 32.0
+HASH_CELL = 128.0
+
+LINE_OF_SIGHT = 0
+NEAREST = 1
+IN_RADIUS = 2
+
+class Query(object):
+    __slots__ = ('kind', 'requester', 'tag', 'origin', 'target', 'radius',
+            'layers', 'result', 'done')
+
+    def __init__(self, kind, requester, tag):
+        self.kind = kind
+        self.requester = requester
+        self.tag = tag
+        self.origin = None
+        self.target = None
+        self.radius = 0.0
+        self.layers = 0
+        self.result = None
+        self.done = False
+
+def cell(x, y, size=CELL):
+    return int(x // size), int(y // size)
+
+def layers_of(physics):
+    '''Layers an actor is found in: the layers attribute of its physics
+    component if it has one, otherwise those of its shapes.
+    '''
+    layers = getattr(physics, 'layers', None)
+    if layers != None:
+        return layers
+    layers = 0
+    for shape in physics.objs:
+        layers |= shape.layers
+    return layers
+
+class Perception(object):
+    def __init__(self, physics, budget=BUDGET):
+        self.physics = physics
+        self.budget = budget
+        # (requester, kind, tag) -> waiting Query, in the order asked
+        self.pending = collections.OrderedDict()
+        # Actor -> physics component of everything that can be found
+        self.targets = {}
+        # Counters of the last run
+        self.answered = 0
+        self.cached = 0
+        self.waiting = 0
+
+    def on_actor_add(self, actor):
+        if actor.has_component('physics'):
+            self.targets[actor] = actor.get_component('physics')
+        if actor.has_component('perception'):
+            actor.get_component('perception').service = self
+
+    def on_actor_remove(self, actor):
+        self.targets.pop(actor, None)
+        if actor.has_component('perception'):
+            requester = actor.get_component('perception')
+            requester.service = None
+            for key in [key for key in self.pending if key[0] is requester]:
+                del self.pending[key]
+
+    def ask(self, kind, requester, tag, origin, target=None, radius=0.0,
+            layers=0):
+        key = (requester, kind, tag)
+        query = self.pending.get(key)
+        if query == None:
+            query = self.pending[key] = Query(kind, requester, tag)
+        query.origin = origin
+        query.target = target
+        query.radius = radius
+        query.layers = layers
+        return query
+
+    def line_of_sight(self, requester, origin, target, layers=LAYER_SIGHT, tag=None):
+        '''Whether nothing in layers is between origin and target.
+        '''
+        return self.ask(LINE_OF_SIGHT, requester, tag, origin, target,
+                layers=layers)
+
+    def nearest(self, requester, origin, radius, layers, tag=None):
+        '''The closest actor in layers within radius, or None.
+        '''
+        return self.ask(NEAREST, requester, tag, origin, radius=radius,
+                layers=layers)
+
+    def in_radius(self, requester, origin, radius, layers, tag=None):
+        '''All actors in layers within radius, closest first.
+        '''
+        return self.ask(IN_RADIUS, requester, tag, origin, radius=radius,
+                layers=layers)
+
+    def run(self):
+        '''Answers up to budget waiting queries and hands the answers to
+        their requesters' on_perception. Call between steps, never while
+        the space is stepping.
+        '''
+        batch = []
+        while self.pending and len(batch) < self.budget:
+            batch.append(self.pending.popitem(last=False)[1])
+        self.waiting = len(self.pending)
+        self.answered = len(batch)
+        self.cached = 0
+        if not batch:
+            return
+
+        batch.sort(key=lambda query: (query.kind, cell(*query.origin)))
+        cache = {}
+        positions = None
+        for query in batch:
+            if query.kind == LINE_OF_SIGHT:
+                key = (cell(*query.origin), cell(*query.target), query.layers)
+                result = cache.get(key)
+                if result == None:
+                    result = cache[key] = self.trace(query.origin, query.target,
+                            query.layers)
+                else:
+                    self.cached += 1
+            else:
+                if positions == None:
+                    positions = self.hash_targets()
+                found = self.find(positions, query)
+                result = found[0][1] if query.kind == NEAREST and found else None
+                if query.kind == IN_RADIUS:
+                    result = [actor for distance, actor in found]
+
+            query.result = result
+            query.done = True
+
+        for query in batch:
+            query.requester.on_perception(query)
+
+    def trace(self, origin, target, layers):
+        return self.physics.space.segment_query_first(origin, target,
+                layers) == None
+
+    def hash_targets(self):
+        '''(x, y, layers, actor) of every target, by hash cell.
+        '''
+        cells = {}
+        for actor, physics in self.targets.iteritems():
+            x, y, angle = physics.transform()
+            cells.setdefault(cell(x, y, HASH_CELL), []).append(
+                    (x, y, layers_of(physics), actor))
+        return cells
+
+    def find(self, cells, query):
+        '''(distance, actor) of the targets in the query's layers and
+        radius, closest first. The requester's own actor is left out.
+        '''
+        ox, oy = query.origin
+        radius = query.radius
+        layers = query.layers
+        owner = query.requester.owner
+        ci, cj = cell(ox - radius, oy - radius, HASH_CELL)
+        ck, cl = cell(ox + radius, oy + radius, HASH_CELL)
+        found = []
+        for i in xrange(ci, ck + 1):
+            for j in xrange(cj, cl + 1):
+                for x, y, target_layers, actor in cells.get((i, j), ()):
+                    if not target_layers & layers or actor is owner:
+                        continue
+                    distance = ((x - ox) ** 2 + (y - oy) ** 2) ** 0.5
+                    if distance <= radius:
+                        found.append((distance, actor))
+        # Names break ties the same way every run
+        found.sort(key=lambda pair: (pair[0], pair[1].name))
+        return found
@@ -1,11 +1,10 @@
-try:
-    from xml.etree import ElementTree
-except ImportError:
-    import elementtree.ElementTree as ElementTree
-
 import pymunk
+import pyglet
 
 import debug
+import geometry
+import broadphase
+import kinematic
 import tiled.tiled
 
 COLLTYPE_STATIC = 0
@@ -21,47 +20,361 @@ LAYER_PLAYERBULLET = 32
 LAYER_ENEMYBULLET = 64 
 LAYER_OBJECTPLAYERBULLET = 128
 LAYER_OBJECTENEMYBULLET = 256
+# Blocks line of sight, see perception. Static shapes are in every layer.
+LAYER_SIGHT = 512
+
+# Retune the broadphase once the number of dynamic shapes moved this far from
+# the last tuning, in shapes and as a fraction
+RETUNE_MIN_SHAPES = 32
+RETUNE_FRACTION = 0.5
 
-class Physics(object):
+# Bodies slower than this (pixels per second) count as idle...
+IDLE_SPEED = 10.0
+# ...and a group of touching idle bodies falls asleep after this many seconds
+SLEEP_TIME = 0.5
+# Solver iterations and the overlap in pixels shapes are allowed. With
+# chipmunk's 10 and 0.1 a pile of blocks keeps jittering faster than
+# IDLE_SPEED and never falls asleep.
+ITERATIONS = 20
+COLLISION_SLOP = 1.0
+# Every sleeping actor is checked for wake-ups once in this many steps
+WAKE_SWEEP = 8
+
+class Physics(pyglet.event.EventDispatcher):
+    '''The level's pymunk space. Dispatches on_actor_sleep and on_actor_wake
+    when chipmunk puts the body of an actor to sleep or wakes it up again, so
+    the actor layer can stop updating piles of settled blocks. Static actors
+    are asleep as soon as they're added.
+    '''
     def __init__(self):
         debug.msg('Initializing physics')
+        # Shape ids decide the order chipmunk finds collisions in. Numbering
+        # every level's shapes from the start keeps replays of it identical.
+        pymunk.reset_shapeid_counter()
         self.space = pymunk.Space()
         self.space.gravity = pymunk.Vec2d(0.0, -900.0)
+        self.space.iterations = ITERATIONS
+        if hasattr(self.space, 'collision_slop'):
+            self.space.collision_slop = COLLISION_SLOP
         self.update_physics = True
 
+        # Body -> actor of the awake and the sleeping dynamic actors. Bodies
+        # in insomniacs are kept awake, see on_actor_add.
+        self.awake_bodies = {}
+        self.sleeping_bodies = {}
+        self.insomniacs = []
+        # Wake-up sweep order and position, see update_sleep
+        self.sleep_order = []
+        self.sweep_index = 0
+        self.sleeping = False
+        self.set_sleeping(True)
+        # Calls collision callbacks made during the step, see defer
+        self.deferred = None
+        # Static geometry for kinematic characters, built on first use. See
+        # collision_grid.
+        self.grid = None
+        self.tile_collision = (16, 16, None, None)
+
+        # See tune_broadphase
+        self.broadphase = None
+        self.auto_broadphase = True
+        self.dynamic_shapes = 0
+        self.tuned_shapes = 0
+        # Counts the actors added to the space. Chipmunk's results depend on
+        # the order things went in, recordings replay it.
+        self.added = 0
+
         # Register a bunch of collision callbacks
         self.space.add_collision_handler(COLLTYPE_STATIC, COLLTYPE_CHARACTER,
                 self.on_character_jump_land, None, None, None)
         self.space.add_collision_handler(COLLTYPE_OBJECT, COLLTYPE_CHARACTER,
                 self.on_character_jump_land, None, None, None)
+        # on_contact is the default handler while anything sleeps, see
+        # watch_contacts
+        self.watching_contacts = False
 
     def update(self, dt):
+        self.step(dt)
+        self.finish_step()
+
+    def step(self, dt):
+        '''The part of update that only touches the space. It can run on
+        another thread, see pipeline.
+        '''
         if self.update_physics:
+            if self.sleeping:
+                for body in self.insomniacs:
+                    body.activate()
             self.space.step(1.0/60.0)
-    
+
+    def finish_step(self):
+        '''The part of update that deals with actors.
+        '''
+        if self.deferred:
+            calls = self.deferred
+            self.deferred = []
+            for function, args in calls:
+                function(*args)
+        if self.update_physics and self.sleeping:
+            self.update_sleep()
+        self.watch_contacts()
+
+    def defer(self, function, *args):
+        '''Calls function from a collision callback. When the space steps on
+        a worker thread deferred is a list and the call waits for
+        finish_step, so actors are only touched from the main thread.
+        '''
+        if self.deferred == None:
+            function(*args)
+        else:
+            self.deferred.append((function, args))
+
+    def set_sleeping(self, enabled, idle_speed=IDLE_SPEED, sleep_time=SLEEP_TIME):
+        '''Turns sleeping bodies on or off. Only Chipmunk 6 has sleeping, on
+        Chipmunk 5 dynamic bodies stay awake whatever this says.
+        '''
+        if not hasattr(self.space, 'sleep_time_threshold'):
+            return
+        if enabled:
+            self.space.idle_speed_threshold = idle_speed
+            self.space.sleep_time_threshold = sleep_time
+        else:
+            self.space.sleep_time_threshold = float('inf')
+            self.wake_all()
+        self.sleeping = enabled
+
+    def update_sleep(self):
+        '''Finds the actors chipmunk put to sleep or woke up this step.
+        Chipmunk doesn't tell when it wakes a body, e.g. because something
+        landed on its pile, so a slice of the sleeping actors is checked
+        every step. Contacts wake actors straight away, see on_contact.
+        '''
+        asleep = [body for body in self.awake_bodies if body.is_sleeping]
+        for body in asleep:
+            actor = self.awake_bodies.pop(body)
+            self.sleeping_bodies[body] = actor
+            self.sleep_order.append(body)
+            self.dispatch_event('on_actor_sleep', actor)
+
+        if not self.sleep_order:
+            return
+        # Bodies that woke or left the space since they were queued are
+        # dropped on the way
+        count = len(self.sleep_order) / WAKE_SWEEP + 1
+        i = self.sweep_index
+        while count > 0 and self.sleep_order:
+            if i >= len(self.sleep_order):
+                i = 0
+            body = self.sleep_order[i]
+            if body not in self.sleeping_bodies:
+                self.sleep_order[i] = self.sleep_order[-1]
+                self.sleep_order.pop()
+            elif not body.is_sleeping:
+                self.wake_body(body)
+            else:
+                i += 1
+            count -= 1
+        self.sweep_index = i
+
+    def wake_body(self, body):
+        actor = self.sleeping_bodies.pop(body, None)
+        if actor != None:
+            self.awake_bodies[body] = actor
+            self.dispatch_event('on_actor_wake', actor)
+
+    def wake_all(self):
+        '''Wakes every sleeping actor, e.g. after their bodies were moved by
+        hand.
+        '''
+        for body in self.sleeping_bodies.keys():
+            if hasattr(body, 'activate'):
+                body.activate()
+            self.wake_body(body)
+
+    def watch_contacts(self):
+        '''Installs on_contact as the default collision handler while there
+        are sleeping actors and takes it out when there are none. Chipmunk
+        calls back into Python for every new contact it handles, and with
+        the space stepping on the worker thread each call has to take the
+        GIL back, for nothing when nobody sleeps.
+        '''
+        watching = bool(self.sleeping_bodies)
+        if watching != self.watching_contacts:
+            self.watching_contacts = watching
+            self.space.set_default_collision_handler(
+                    self.on_contact if watching else None, None, None, None)
+
+    def on_contact(self, space, arbiter):
+        '''Wakes the actors of sleeping shapes that something ran into.
+        '''
+        if self.sleeping_bodies:
+            for shape in arbiter.shapes:
+                if shape.body in self.sleeping_bodies:
+                    self.defer(self.wake_body, shape.body)
+        return True
+
     def on_actor_add(self, actor):
         if actor.has_component('physics'):
             physics = actor.get_component('physics')
+            if physics.kinematic:
+                # Moves itself, the space never sees it
+                physics.grid = self.collision_grid()
+                return
             if not physics.body.is_static:
                 self.space.add(physics.body)
+                self.dynamic_shapes += len(physics.objs)
             self.space.add(*physics.objs)
-    
+            physics.added = self.added
+            self.added += 1
+            self.check_broadphase()
+
+            if physics.body.is_static:
+                # Never moves, one update is all it needs
+                self.dispatch_event('on_actor_sleep', actor)
+            else:
+                self.awake_bodies[physics.body] = actor
+                if not physics.can_sleep and hasattr(physics.body, 'activate'):
+                    # Players shouldn't freeze while they stand still
+                    self.insomniacs.append(physics.body)
+
     def on_actor_remove(self, actor):
         if actor.has_component('physics'):
             physics = actor.get_component('physics')
+            if physics.kinematic:
+                return
             if not physics.body.is_static:
                 self.space.remove(physics.body)
-            self.space.remove(physics.body, *physics.objs)
+                self.dynamic_shapes -= len(physics.objs)
+            self.space.remove(*physics.objs)
+            self.check_broadphase()
+
+            self.awake_bodies.pop(physics.body, None)
+            self.sleeping_bodies.pop(physics.body, None)
+            if physics.body in self.insomniacs:
+                self.insomniacs.remove(physics.body)
+            self.watch_contacts()
+
+    def close(self):
+        '''Lets go of the space once the level is unloaded. Its collision
+        handlers are bound methods of this object and pymunk's Space has a
+        __del__, so the cycle would never be collected, Python 2 parks it in
+        gc.garbage with every body and shape still in the space.
+        '''
+        self.space.remove_collision_handler(COLLTYPE_STATIC, COLLTYPE_CHARACTER)
+        self.space.remove_collision_handler(COLLTYPE_OBJECT, COLLTYPE_CHARACTER)
+        self.space.set_default_collision_handler(None, None, None, None)
+        shapes = self.space.shapes
+        if shapes:
+            self.space.remove(*shapes)
+        self.space = None
+        self.grid = None
+
+    def set_tile_collision(self, cell_width, cell_height, solid=None, oneway=None):
+        '''Sets the grid cell size and the solid and one-way tile layers
+        (chunks.TileData) for kinematic characters.
+        '''
+        self.tile_collision = (cell_width, cell_height, solid, oneway)
+        if self.grid != None:
+            self.grid.cell_width = cell_width
+            self.grid.cell_height = cell_height
+            self.update_grid()
+
+    def set_map_collision(self, properties, tile_data, tile_width, tile_height):
+        '''set_tile_collision with the layers named by the solid_layer and
+        oneway_layer map properties, see kinematic.
+        '''
+        self.set_tile_collision(tile_width, tile_height,
+                tile_data.get(properties.get('solid_layer')),
+                tile_data.get(properties.get('oneway_layer')))
+
+    def collision_grid(self):
+        '''The kinematic.CollisionGrid of the static geometry.
+        '''
+        if self.grid == None:
+            cell_width, cell_height, solid, oneway = self.tile_collision
+            self.grid = kinematic.CollisionGrid(cell_width, cell_height)
+            self.update_grid()
+        return self.grid
+
+    def update_grid(self):
+        '''Rebakes the collision grid after the static geometry changed.
+        '''
+        if self.grid == None:
+            return
+        cell_width, cell_height, solid, oneway = self.tile_collision
+        polygons = [[(p.x, p.y) for p in polygon_points(shape)]
+                for shape in static_polygons(self.space).itervalues()]
+        self.grid.build(polygons, solid, oneway)
+
+    def shape_sizes(self):
+        '''Sizes of the static and the dynamic shapes in the space.
+        '''
+        static = []
+        dynamic = []
+        for shape in self.space.shapes:
+            if shape.body.is_static:
+                static.append(shape)
+            else:
+                dynamic.append(shape)
+        return broadphase.shape_sizes(static), broadphase.shape_sizes(dynamic)
+
+    def tune_broadphase(self):
+        '''Picks a broadphase for the shapes currently in the space.
+        '''
+        if not broadphase.configurable(self.space):
+            if self.broadphase == None:
+                debug.msg('Broadphase: this pymunk can\'t change it, keeping the default %s'
+                        % broadphase.default(self.space))
+                self.broadphase = broadphase.default(self.space)
+            # Nothing to retune either
+            self.auto_broadphase = False
+            return
+
+        static, dynamic = self.shape_sizes()
+        tree = broadphase.has_tree(self.space)
+        config = broadphase.choose(static, dynamic, tree)
+        if tree and config.kind == 'tree' and self.broadphase != None and \
+                self.broadphase.kind == 'hash':
+            # Chipmunk can't go back to the tree, keep hashing at the new size
+            config = broadphase.Broadphase('hash', broadphase.hash_dim(dynamic),
+                    broadphase.hash_count(len(dynamic) + len(static)))
+
+        self.tuned_shapes = len(dynamic)
+        if config != self.broadphase:
+            debug.msg('Broadphase: %s (%d static, %d dynamic shapes)' %
+                    (config, len(static), len(dynamic)))
+            self.set_broadphase(config)
+        self.auto_broadphase = True
+
+    def set_broadphase(self, config):
+        '''Configures the broadphase by hand. It won't be retuned after this
+        unless tune_broadphase is called.
+        '''
+        if not config.apply(self.space):
+            debug.msg('Broadphase: %s not applied, this pymunk can\'t change it'
+                    % config)
+            config = broadphase.default(self.space)
+        self.broadphase = config
+        self.auto_broadphase = False
+
+    def check_broadphase(self):
+        '''Retunes when the dynamic population changed a lot since the last
+        tuning.
+        '''
+        if self.auto_broadphase and abs(self.dynamic_shapes - self.tuned_shapes) >= \
+                max(RETUNE_MIN_SHAPES, self.tuned_shapes * RETUNE_FRACTION):
+            self.tune_broadphase()
 
     def on_character_jump_land(self, space, arbiter):
         '''Handles characters that jump and land on static geometry.
         '''
+        self.on_contact(space, arbiter)
         debug.msg("%s, %s" % (arbiter.contacts[0].normal, len(arbiter.contacts)))
 
         #if arbiter.contacts[0].normal.dot(arbiter.contacts[1].normal) > 0:
         actor = arbiter.shapes[1].actor()
         physics = actor.get_component('physics')
-        physics.on_jump_land()
+        self.defer(physics.on_jump_land)
         return True
 
 def make_static_polygon(vertices):
@@ -71,22 +384,59 @@ def make_static_polygon(vertices):
     polygon.friction = 1.0
     return polygon
 
-def from_xml(filename):
-    # Open xml file
-    tree = ElementTree.parse(filename)
-    root = tree.getroot()
+def is_level_geometry(shape):
+    '''Whether a shape is one of the level's static polygons. Static shapes
+    that belong to actors, like moving platforms, aren't.
+    '''
+    return shape.collision_type == COLLTYPE_STATIC and \
+            isinstance(shape, pymunk.Poly) and not hasattr(shape, 'actor')
+
+def polygon_points(shape):
+    '''World vertices of a Poly. pymunk 4 renamed get_points to
+    get_vertices.
+    '''
+    if hasattr(shape, 'get_points'):
+        return shape.get_points()
+    return shape.get_vertices()
 
-    # Root level tag is expected to be <geometry> so raise an exception if it's not
-    if root.tag != 'physics':
-        raise Exception('%s root level tag is %s rather than <physics>' % (filename, root.tag))
+def static_polygons(space):
+    '''Maps the geometry.polygon_key of every polygon of the level geometry
+    in the space to its shape.
+    '''
+    shapes = {}
+    for shape in space.shapes:
+        if is_level_geometry(shape):
+            shapes[geometry.polygon_key((p.x, p.y) for p in polygon_points(shape))] = shape
+    return shapes
 
+def update_static_polygons(space, polygons):
+    '''Makes the static geometry of the space match a list of vertex lists.
+    Polygons that are already in the space are left alone, so the cost is
+    proportional to the number of changed polygons. Returns the removed and
+    the added shapes.
+    '''
+    current = static_polygons(space)
+    wanted = {}
+    for vertices in polygons:
+        wanted[geometry.polygon_key(vertices)] = vertices
+
+    removed = [shape for key, shape in current.iteritems() if key not in wanted]
+    added = [make_static_polygon(vertices) for key, vertices in wanted.iteritems()
+            if key not in current]
+    if removed:
+        space.remove(*removed)
+    if added:
+        space.add(*added)
+    return removed, added
+
+def from_xml(filename):
     physics = Physics()
 
-    for p in root.findall('polygon'):
-        vertices = []
-        for v in p.findall('vertex'):
-            vertices.append((int(v.get('x')), int(v.get('y'))))
+    for vertices in geometry.load_polygons(filename):
         physics.space.add(make_static_polygon(vertices))
+    physics.tune_broadphase()
 
     return physics
 
+Physics.register_event_type('on_actor_sleep')
+Physics.register_event_type('on_actor_wake')
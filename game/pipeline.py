@@ -0,0 +1,161 @@
+'''Pipelined physics: the space steps on a worker thread while the main
+thread updates actors and draws the step before.
+A pipelined Simulation.step
+    1. waits for the step started last frame, swaps the transform buffers
+       and finishes the step on the main thread: deferred collision
+       callbacks, sleeping bodies, the recorder checkpoint
+    2. applies the buffered input and starts the next step on the worker
+    3. updates the actors from the front transform buffer
+and the scene draws while the worker steps. pymunk calls chipmunk through
+ctypes, which releases the GIL, so with more than one core a frame takes
+about max(physics, everything else) instead of the sum.
+
+Actors show the state one step later than without pipelining. Collision
+callbacks that touch actors run after the step instead of during it, so
+recordings made with and without pipelining don't replay the same.
+Nothing may touch the space while the worker steps, call Simulation.sync
+first. Adding and removing actors does that on its own.
+'''
+
+import sys
+import array
+import threading
+
+import snapshot
+
+class TransformBuffer(object):
+    '''x, y and angle of a set of bodies, double buffered. The worker
+    captures into back after every step, the main thread reads front.
+    Capturing runs Python on the worker, which has to hold the GIL while
+    the main thread wants it. Where the cpBody structs can be reached the
+    buffers hold every body's state in snapshot layout, copied in one join
+    like snapshot.Snapshotter.take does; otherwise x, y and angle are read
+    through the Body properties.
+    '''
+    def __init__(self):
+        self.bodies = []
+        self.views = None
+        # Doubles per body, and where the angle is among them
+        self.stride = 3
+        self.angle = 2
+        self.front = array.array('d')
+        self.back = array.array('d')
+
+    def bind(self, components):
+        '''Gives every physics component a slot and fills both buffers.
+        '''
+        self.bodies = [c.body for c in components]
+        self.views = snapshot.body_views(self.bodies)
+        if self.views != None:
+            self.stride = snapshot.BODY_DOUBLES
+            self.angle = 6
+        else:
+            self.stride = 3
+            self.angle = 2
+        for n, component in enumerate(components):
+            component.transforms = self
+            component.slot = n * self.stride
+        self.back = array.array('d', [0.0]) * (len(self.bodies) * self.stride)
+        self.capture()
+        self.front = array.array('d', self.back)
+
+    def unbind(self, components):
+        for component in components:
+            component.transforms = None
+            component.slot = None
+
+    def capture(self):
+        if self.views != None:
+            back = array.array('d')
+            back.fromstring(''.join([view.raw for view in self.views]))
+            self.back = back
+            return
+        back = self.back
+        i = 0
+        for body in self.bodies:
+            x, y = body.position
+            back[i] = x
+            back[i + 1] = y
+            back[i + 2] = body.angle
+            i += 3
+
+    def swap(self):
+        self.front, self.back = self.back, self.front
+
+class PhysicsWorker(object):
+    '''Thread that steps a Physics and captures the transforms, one step
+    per start.
+    '''
+    def __init__(self, physics, transforms):
+        self.physics = physics
+        self.transforms = transforms
+        self.condition = threading.Condition()
+        # Set by start, taken by the thread
+        self.dt = None
+        self.busy = False
+        self.running = True
+        self.error = None
+
+        self.thread = threading.Thread(target=self.run, name='physics')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def start(self, dt):
+        self.condition.acquire()
+        try:
+            self.dt = dt
+            self.busy = True
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    def wait(self):
+        '''Blocks until the started step is done. Exceptions raised on the
+        worker are raised again here.
+        '''
+        self.condition.acquire()
+        try:
+            while self.busy:
+                self.condition.wait()
+        finally:
+            self.condition.release()
+
+        if self.error != None:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+
+    def stop(self):
+        self.wait()
+        self.condition.acquire()
+        try:
+            self.running = False
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                while self.dt == None and self.running:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                dt = self.dt
+                self.dt = None
+            finally:
+                self.condition.release()
+
+            try:
+                self.physics.step(dt)
+                self.transforms.capture()
+            except Exception:
+                self.error = sys.exc_info()
+
+            self.condition.acquire()
+            try:
+                self.busy = False
+                self.condition.notify_all()
+            finally:
+                self.condition.release()
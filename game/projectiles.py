@@ -0,0 +1,341 @@
+'''Pooled projectiles. Bullets are slots in preallocated arrays, not bodies.
+Every step a live bullet moves by its velocity and the segment it swept is
+queried against the space with the bullet's layers, so fast bullets can't
+pass through thin walls and nothing is ever added to the space. Firing
+takes a free slot, hitting something or running out of life gives it back.
+
+Most bullets are in open air most of the time, and a query through pymunk
+costs more than the rest of a bullet's step. So before querying, the cells
+the swept segment touches are looked up in a coarse map of the cells that
+have anything in them: the level geometry, from the kinematic collision
+grid, and a circle around every body, moved along with it. Bullets in
+empty cells move without a query.
+
+Layers work like the rest of physics: a bullet hits shapes that share a
+layer with it, and static geometry is in every layer. Player bullets are
+fired in PLAYER_BULLET and enemy ones in ENEMY_BULLET: Player is in
+LAYER_ENEMYBULLET, so only enemy bullets hit it, blocks are in both object
+bullet layers. Kinematic characters have no shapes and are hit through the
+layers attribute of their physics.
+
+Hits are collected during the step and dispatched together afterwards as
+on_projectile_hits(hits), a list of (actor, shape, x, y, owner, damage).
+actor is None for the static geometry, shape is None for kinematic
+characters.
+'''
+
+import array
+import math
+
+import pyglet
+
+# Bullets alive at once, firing more fails. A bullet in open air costs about
+# 5 us a step, one next to blocks or walls about 20 us, so a full pool takes
+# 5 ms a step in open air and 25 ms when every bullet is in a pile
+CAPACITY = 1024
+# Seconds a bullet flies if it hits nothing
+LIFE = 2.0
+# Cell size of the coarse pass and of the kinematic target hash
+CELL = 64.0
+
+import kinematic
+from physics import LAYER_PLAYERBULLET, LAYER_ENEMYBULLET, \
+        LAYER_OBJECTPLAYERBULLET, LAYER_OBJECTENEMYBULLET
+
+PLAYER_BULLET = LAYER_PLAYERBULLET | LAYER_OBJECTPLAYERBULLET
+ENEMY_BULLET = LAYER_ENEMYBULLET | LAYER_OBJECTENEMYBULLET
+
+def segment_box(x, y, dx, dy, left, bottom, right, top):
+    '''Fraction of the segment from (x, y) by (dx, dy) where it enters the
+    box, or None if it misses.
+    '''
+    low = 0.0
+    high = 1.0
+    for start, delta, near, far in ((x, dx, left, right), (y, dy, bottom, top)):
+        if delta == 0:
+            if start < near or start > far:
+                return None
+            continue
+        a = (near - start) / delta
+        b = (far - start) / delta
+        if a > b:
+            a, b = b, a
+        if a > low:
+            low = a
+        if b < high:
+            high = b
+        if low > high:
+            return None
+    return low
+
+def bounding_radius(physics):
+    '''Distance from the body's position to the furthest corner of its
+    shapes' bounding boxes, plus a bit so a bullet's query sees everything
+    it touches. Whatever way the body turns, its shapes stay inside.
+    '''
+    x, y = physics.body.position
+    radius = 0.0
+    for shape in physics.objs:
+        if not hasattr(shape, 'cache_bb'):
+            continue
+        bb = shape.cache_bb()
+        for corner_x in (bb.left, bb.right):
+            for corner_y in (bb.bottom, bb.top):
+                radius = max(radius, math.hypot(corner_x - x, corner_y - y))
+    return radius + 1.0
+
+def body_span(body, radius):
+    '''(i0, j0, i1, j1), the cells a circle around the body overlaps.
+    '''
+    position = body.position
+    x = position.x
+    y = position.y
+    return (int((x - radius) // CELL), int((y - radius) // CELL),
+            int((x + radius) // CELL), int((y + radius) // CELL))
+
+def span_cells(span):
+    i0, j0, i1, j1 = span
+    return [(i, j) for i in xrange(i0, i1 + 1) for j in xrange(j0, j1 + 1)]
+
+class ProjectilePool(pyglet.event.EventDispatcher):
+    def __init__(self, physics, capacity=CAPACITY):
+        self.physics = physics
+        self.capacity = capacity
+        zeros = array.array('d', [0.0]) * capacity
+        self.x = array.array('d', zeros)
+        self.y = array.array('d', zeros)
+        self.vx = array.array('d', zeros)
+        self.vy = array.array('d', zeros)
+        self.life = array.array('d', zeros)
+        self.damage = array.array('d', zeros)
+        self.layers = array.array('i', [0]) * capacity
+        self.owners = [None] * capacity
+        # Slots of the live bullets are live[:count], the free ones are a
+        # stack
+        self.live = array.array('i', [0]) * capacity
+        self.count = 0
+        self.free = array.array('i', reversed(xrange(capacity)))
+        # Hits of the step being run
+        self.hits = []
+        # Shots that found the pool full
+        self.dropped = 0
+        # Actor -> physics component of the kinematic characters
+        self.targets = {}
+        # Cell -> how many things a bullet could hit are in it, apart from
+        # kinematic characters, see update_cells
+        self.occupied = {}
+        # Actor -> (body, bounding_radius) of the other physics actors that
+        # can move, and actor -> span of cells (i0, j0, i1, j1) of them all
+        self.bodies = {}
+        self.spans = {}
+        # Cells with level geometry in them, and the grid version they are of
+        self.static_cells = set()
+        self.static_version = None
+
+    def on_actor_add(self, actor):
+        if actor.has_component('physics'):
+            physics = actor.get_component('physics')
+            if physics.kinematic:
+                self.targets[actor] = physics
+                return
+            radius = bounding_radius(physics)
+            if not physics.body.is_static:
+                self.bodies[actor] = (physics.body, radius)
+            span = self.spans[actor] = body_span(physics.body, radius)
+            self.occupy(span_cells(span), 1)
+
+    def on_actor_remove(self, actor):
+        self.targets.pop(actor, None)
+        self.bodies.pop(actor, None)
+        span = self.spans.pop(actor, None)
+        if span != None:
+            self.occupy(span_cells(span), -1)
+        # Don't keep actors alive through their bullets
+        for n in xrange(self.count):
+            slot = self.live[n]
+            if self.owners[slot] is actor:
+                self.owners[slot] = None
+
+    def fire(self, x, y, vx, vy, layers, owner=None, damage=1.0, life=LIFE):
+        '''Fires a bullet from (x, y). Returns False if the pool is full.
+        '''
+        if not self.free:
+            self.dropped += 1
+            return False
+        slot = self.free.pop()
+        self.x[slot] = x
+        self.y[slot] = y
+        self.vx[slot] = vx
+        self.vy[slot] = vy
+        self.life[slot] = life
+        self.damage[slot] = damage
+        self.layers[slot] = layers
+        self.owners[slot] = owner
+        self.live[self.count] = slot
+        self.count += 1
+        return True
+
+    def clear(self):
+        for n in xrange(self.count):
+            self.release(self.live[n])
+        self.count = 0
+
+    def release(self, slot):
+        self.owners[slot] = None
+        self.free.append(slot)
+
+    def step(self, dt):
+        '''Moves every bullet, then dispatches the hits. Call between steps,
+        never while the space is stepping.
+        '''
+        if self.count == 0:
+            return
+        query = self.physics.space.segment_query_first
+        self.update_cells()
+        occupied = self.occupied
+        boxes = self.hash_targets() if self.targets else None
+        x, y, vx, vy = self.x, self.y, self.vx, self.vy
+        life, layers, live = self.life, self.layers, self.live
+        hits = self.hits
+
+        n = 0
+        while n < self.count:
+            slot = live[n]
+            x0 = x[slot]
+            y0 = y[slot]
+            dx = vx[slot] * dt
+            dy = vy[slot] * dt
+            life[slot] -= dt
+            i0 = int(x0 // CELL)
+            j0 = int(y0 // CELL)
+            i1 = int((x0 + dx) // CELL)
+            j1 = int((y0 + dy) // CELL)
+            if i0 == i1 and j0 == j1:
+                near = (i0, j0) in occupied
+                near_target = boxes != None and (i0, j0) in boxes
+            else:
+                near = self.any_cell(occupied, i0, j0, i1, j1)
+                near_target = boxes != None and self.any_cell(boxes, i0, j0, i1, j1)
+
+            hit = None
+            t = 1.0
+            if near:
+                info = query((x0, y0), (x0 + dx, y0 + dy), layers[slot])
+                if info != None:
+                    t = info.t
+                    shape = info.shape
+                    actor = getattr(shape, 'actor', None)
+                    hit = (actor() if actor != None else None, shape)
+            if near_target:
+                found = self.hit_target(boxes, x0, y0, dx, dy, layers[slot], t)
+                if found != None:
+                    t, actor = found
+                    hit = (actor, None)
+
+            if hit != None:
+                hits.append((hit[0], hit[1], x0 + dx * t, y0 + dy * t,
+                    self.owners[slot], self.damage[slot]))
+            if hit != None or life[slot] <= 0:
+                # The last live bullet takes this one's place
+                self.count -= 1
+                live[n] = live[self.count]
+                self.release(slot)
+                continue
+            x[slot] = x0 + dx
+            y[slot] = y0 + dy
+            n += 1
+
+        if hits:
+            self.hits = []
+            self.dispatch_event('on_projectile_hits', hits)
+
+    def any_cell(self, cells, i0, j0, i1, j1):
+        '''Whether any cell between (i0, j0) and (i1, j1), in any order, is
+        in cells.
+        '''
+        for i in xrange(min(i0, i1), max(i0, i1) + 1):
+            for j in xrange(min(j0, j1), max(j0, j1) + 1):
+                if (i, j) in cells:
+                    return True
+        return False
+
+    def update_cells(self):
+        '''Brings occupied up to date with the level geometry and with where
+        the bodies moved since the last step.
+        '''
+        grid = self.physics.collision_grid()
+        if self.static_version != grid.version:
+            self.occupy(self.static_cells, -1)
+            self.static_cells = self.grid_cells(grid)
+            self.static_version = grid.version
+            self.occupy(self.static_cells, 1)
+        spans = self.spans
+        for actor, (body, radius) in self.bodies.iteritems():
+            span = body_span(body, radius)
+            if span != spans[actor]:
+                self.occupy(span_cells(spans[actor]), -1)
+                self.occupy(span_cells(span), 1)
+                spans[actor] = span
+
+    def occupy(self, cells, count):
+        occupied = self.occupied
+        for cell in cells:
+            total = occupied.get(cell, 0) + count
+            if total:
+                occupied[cell] = total
+            else:
+                del occupied[cell]
+
+    def grid_cells(self, grid):
+        '''Cells with level geometry in them, from a kinematic.CollisionGrid.
+        '''
+        cells = set()
+        for n in xrange(grid.width * grid.height):
+            if grid.cells[n] == kinematic.EMPTY and n not in grid.cell_shapes:
+                continue
+            left = (n % grid.width) * grid.cell_width
+            bottom = (n / grid.width) * grid.cell_height
+            for i in xrange(int((left - 1.0) // CELL),
+                    int((left + grid.cell_width + 1.0) // CELL) + 1):
+                for j in xrange(int((bottom - 1.0) // CELL),
+                        int((bottom + grid.cell_height + 1.0) // CELL) + 1):
+                    cells.add((i, j))
+        return cells
+
+    def hash_targets(self):
+        '''(left, bottom, right, top, layers, actor) of every kinematic
+        character, by hash cell.
+        '''
+        cells = {}
+        for actor, physics in self.targets.iteritems():
+            if not physics.layers:
+                continue
+            x, y = physics.body.position
+            half = physics.width / 2.0
+            bottom = y + physics.offset_y - physics.height / 2.0
+            box = (x - half, bottom, x + half, bottom + physics.height,
+                    physics.layers, actor)
+            for i in xrange(int((x - half) // CELL), int((x + half) // CELL) + 1):
+                for j in xrange(int(bottom // CELL),
+                        int((bottom + physics.height) // CELL) + 1):
+                    cells.setdefault((i, j), []).append(box)
+        return cells
+
+    def hit_target(self, cells, x, y, dx, dy, layers, limit):
+        '''(t, actor) of the first kinematic character the segment hits
+        before limit, or None.
+        '''
+        found = None
+        for i in xrange(int(min(x, x + dx) // CELL), int(max(x, x + dx) // CELL) + 1):
+            for j in xrange(int(min(y, y + dy) // CELL),
+                    int(max(y, y + dy) // CELL) + 1):
+                for left, bottom, right, top, box_layers, actor in cells.get((i, j), ()):
+                    if not box_layers & layers:
+                        continue
+                    t = segment_box(x, y, dx, dy, left, bottom, right, top)
+                    if t != None and t < limit:
+                        limit = t
+                        found = (t, actor)
+        return found
+
+ProjectilePool.register_event_type('on_projectile_hits')
@@ -0,0 +1,274 @@
+'''Deterministic input recording and replay.
+A recording holds the map, the initial placement of every physics actor, a
+snapshot of the full state the recording started from (see snapshot), and
+the input actions drained on each tick, plus a checksum of all body states
+every few ticks. Replaying feeds the same actions into a fresh headless
+simulation at the same fixed timestep and compares the checksums, so a
+recording doubles as a regression test and as a frame time benchmark of
+real gameplay.
+
+File layout, all little endian:
+    header      magic 'PPRL', version (H), tick length (d), checksum interval (I)
+    strings     map filename, player name (H length prefixed)
+    actors      count (I), then class name, actor name and
+                x, y, angle, vx, vy (5d) for each
+    state       length (I), then snapshot.Snapshot.to_string of the first
+                tick
+    body        zlib compressed stream of records, each starting with a type
+                byte: actions (controls.pack_actions), checksum (tick, crc)
+                or end (last tick)
+'''
+
+import struct
+import time
+import zlib
+
+import debug
+import controls
+import actors
+import simulation
+import snapshot
+
+MAGIC = 'PPRL'
+VERSION = 3
+
+RECORD_ACTIONS = 0
+RECORD_CHECKSUM = 1
+RECORD_END = 2
+
+_header = struct.Struct('<4sHdI')
+_length = struct.Struct('<H')
+_count = struct.Struct('<I')
+_placement = struct.Struct('<5d')
+_record = struct.Struct('<B')
+_checksum = struct.Struct('<II')
+_end = struct.Struct('<I')
+
+class RecordingException(Exception):
+    pass
+
+def _pack_string(text):
+    return _length.pack(len(text)) + text
+
+def _unpack_string(data, offset):
+    length, = _length.unpack_from(data, offset)
+    offset += _length.size
+    return data[offset:offset + length], offset + length
+
+class Placement(object):
+    def __init__(self, class_name, name, x, y, angle, vx, vy):
+        self.class_name = class_name
+        self.name = name
+        self.x = x
+        self.y = y
+        self.angle = angle
+        self.vx = vx
+        self.vy = vy
+
+class Recorder(object):
+    '''Attach to a simulation with simulation.recorder = Recorder(simulation)
+    before its first recorded step. It can start mid-game: the full state of
+    the actors is snapshotted, not just where they are.
+    '''
+    def __init__(self, simulation, checksum_interval=60):
+        self.map_filename = simulation.map_filename
+        self.player_name = simulation.player.name if simulation.player else ''
+        self.dt = simulation.dt
+        self.checksum_interval = checksum_interval
+        self.first_tick = simulation.tick
+        self.last_tick = simulation.tick
+        self.records = []
+
+        # In the order they went in the space, the replay spawns them in it
+        self.placements = []
+        for a in sorted(simulation.physics_actors(),
+                key=lambda a: a.get_component('physics').added):
+            body = a.get_component('physics').body
+            x, y = body.position
+            vx, vy = body.velocity
+            self.placements.append(Placement(a.__class__.__name__, a.name,
+                x, y, body.angle, vx, vy))
+
+        # A replay starts with every body awake, so the recording does too
+        simulation.physics.wake_all()
+        self.state = snapshot.Snapshotter(simulation, anims=False).take()
+        # Ticks in a recording count from its start
+        self.state.tick = 0
+
+    def record(self, tick, events):
+        if events:
+            self.records.append(_record.pack(RECORD_ACTIONS) +
+                    controls.pack_actions(tick - self.first_tick, events))
+
+    def checkpoint(self, tick, simulation):
+        self.last_tick = tick
+        tick -= self.first_tick
+        if tick % self.checksum_interval == 0:
+            self.records.append(_record.pack(RECORD_CHECKSUM) +
+                    _checksum.pack(tick, simulation.checksum()))
+
+    def to_string(self):
+        data = [_header.pack(MAGIC, VERSION, self.dt, self.checksum_interval),
+                _pack_string(self.map_filename),
+                _pack_string(self.player_name),
+                _count.pack(len(self.placements))]
+        for p in self.placements:
+            data.append(_pack_string(p.class_name))
+            data.append(_pack_string(p.name))
+            data.append(_placement.pack(p.x, p.y, p.angle, p.vx, p.vy))
+        state = self.state.to_string()
+        data.append(_count.pack(len(state)) + state)
+
+        body = self.records + [_record.pack(RECORD_END) +
+                _end.pack(self.last_tick - self.first_tick)]
+        data.append(zlib.compress(''.join(body)))
+        return ''.join(data)
+
+    def save(self, filename):
+        debug.msg('Saving recording to %s' % filename)
+        f = open(filename, 'wb')
+        try:
+            f.write(self.to_string())
+        finally:
+            f.close()
+
+class Recording(object):
+    '''A recording read back from disk.
+    '''
+    def __init__(self, data):
+        magic, version, self.dt, self.checksum_interval = \
+                _header.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise RecordingException('Not a recording')
+        if version != VERSION:
+            raise RecordingException('Unsupported recording version %d' % version)
+
+        offset = _header.size
+        self.map_filename, offset = _unpack_string(data, offset)
+        self.player_name, offset = _unpack_string(data, offset)
+        count, = _count.unpack_from(data, offset)
+        offset += _count.size
+
+        self.placements = []
+        for i in range(count):
+            class_name, offset = _unpack_string(data, offset)
+            name, offset = _unpack_string(data, offset)
+            values = _placement.unpack_from(data, offset)
+            offset += _placement.size
+            self.placements.append(Placement(class_name, name, *values))
+
+        length, = _count.unpack_from(data, offset)
+        offset += _count.size
+        self.state = snapshot.Snapshot.from_string(data[offset:offset + length])
+        offset += length
+
+        # tick -> list of events, tick -> crc
+        self.actions = {}
+        self.checksums = {}
+        self.length = 0
+
+        body = zlib.decompress(data[offset:])
+        offset = 0
+        while offset < len(body):
+            kind, = _record.unpack_from(body, offset)
+            offset += _record.size
+            if kind == RECORD_ACTIONS:
+                tick, events, offset = controls.unpack_actions(body, offset)
+                self.actions[tick] = events
+            elif kind == RECORD_CHECKSUM:
+                tick, crc = _checksum.unpack_from(body, offset)
+                offset += _checksum.size
+                self.checksums[tick] = crc
+            elif kind == RECORD_END:
+                self.length, = _end.unpack_from(body, offset)
+                offset += _end.size
+            else:
+                raise RecordingException('Unknown record type %d' % kind)
+
+def load(filename):
+    f = open(filename, 'rb')
+    try:
+        return Recording(f.read())
+    finally:
+        f.close()
+
+class ReplayResult(object):
+    def __init__(self):
+        self.ticks = 0
+        self.step_times = []
+        # (tick, expected crc, actual crc) for every mismatching checkpoint
+        self.divergences = []
+
+    @property
+    def diverged(self):
+        return bool(self.divergences)
+
+    def percentile(self, fraction):
+        if not self.step_times:
+            return 0.0
+        times = sorted(self.step_times)
+        return times[min(len(times) - 1, int(len(times) * fraction))]
+
+    def __str__(self):
+        total = sum(self.step_times)
+        mean = total / len(self.step_times) if self.step_times else 0.0
+        lines = ['ticks: %d' % self.ticks,
+                'step time: mean %.3f ms, median %.3f ms, 99th %.3f ms, max %.3f ms'
+                % (mean * 1000, self.percentile(0.5) * 1000,
+                   self.percentile(0.99) * 1000, self.percentile(1.0) * 1000)]
+        if self.divergences:
+            lines.append('DIVERGED at tick %d (%d bad checkpoints)' %
+                    (self.divergences[0][0], len(self.divergences)))
+        else:
+            lines.append('no divergence')
+        return '\n'.join(lines)
+
+def build_simulation(recording):
+    '''Loads the recorded map, places the recorded actors in it and puts
+    them in the state the recording started from.
+    '''
+    sim = simulation.load_level(recording.map_filename)
+    for p in recording.placements:
+        actor_class = getattr(actors, p.class_name)
+        new_actor = simulation.spawn(sim, actor_class, p.name, (p.x, p.y))
+        body = new_actor.get_component('physics').body
+        body.angle = p.angle
+        body.velocity = (p.vx, p.vy)
+        if p.name == recording.player_name:
+            sim.player = new_actor
+    snapshot.Snapshotter(sim, anims=False).restore(recording.state)
+    return sim
+
+def replay(recording, realtime=False, stop_on_divergence=False):
+    '''Runs a recording through a fresh headless simulation. With realtime
+    set the replay is paced to the recorded tick length, otherwise it runs
+    as fast as possible.
+    '''
+    sim = build_simulation(recording)
+    result = ReplayResult()
+    clock = time.time
+    start = clock()
+
+    for tick in xrange(recording.length):
+        for action, pressed in recording.actions.get(tick, ()):
+            sim.input.push(action, pressed)
+
+        before = clock()
+        sim.step()
+        result.step_times.append(clock() - before)
+        result.ticks += 1
+
+        expected = recording.checksums.get(sim.tick)
+        if expected != None:
+            actual = sim.checksum()
+            if actual != expected:
+                result.divergences.append((sim.tick, expected, actual))
+                if stop_on_divergence:
+                    break
+
+        if realtime:
+            delay = start + sim.tick * recording.dt - clock()
+            if delay > 0:
+                time.sleep(delay)
+
+    return result
@@ -0,0 +1,252 @@
+'''The simulation of a level, separated from everything that draws it.
+A Simulation steps physics and actors at a fixed timestep and applies the
+input actions buffered since the previous step at the start of each one.
+GameScene drives one from its _step, headless tools build their own with
+load_level. See pipeline for stepping physics on a worker thread.
+'''
+
+import struct
+import zlib
+
+import debug
+import controls
+import physics
+import actors
+import pipeline
+import perception
+import projectiles
+import navigation
+import tiled.tiled
+import util.archive
+import util.resource
+import actor.actorlayer
+
+_body_state = struct.Struct('<6d')
+
+class Simulation(object):
+    # Seconds per tick. Physics always steps by this much.
+    dt = 1.0 / 60.0
+
+    def __init__(self, physics, actors, input=None):
+        self.physics = physics
+        self.actors = actors
+        # Settled bodies stop being updated
+        physics.push_handlers(on_actor_sleep=actors.sleep_actor,
+                on_actor_wake=actors.wake_actor)
+        # AI queries asked during a step are answered at the end of it
+        self.perception = perception.Perception(physics)
+        actors.push_handlers(on_actor_add=self.perception.on_actor_add,
+                on_actor_remove=self.perception.on_actor_remove)
+        # Bullets move after the bodies, hits are dispatched in one batch
+        self.projectiles = projectiles.ProjectilePool(physics)
+        actors.push_handlers(on_actor_add=self.projectiles.on_actor_add,
+                on_actor_remove=self.projectiles.on_actor_remove)
+        self.input = input if input != None else controls.ActionQueue({})
+        self.player = None
+        self.map_filename = None
+        self.tick = 0
+        # Optional recording.Recorder fed by every step
+        self.recorder = None
+        # See set_pipelined
+        self.worker = None
+        self.transforms = None
+        self.rebind = False
+        # A step was started on the worker and not finished yet
+        self.stepping = False
+        # navigation.Profile key -> NavGraph, see navigation_graph
+        self.navigation = {}
+
+    def step(self):
+        if self.worker != None:
+            self.sync()
+            if self.rebind:
+                self.transforms.bind(self.physics_components())
+                self.rebind = False
+            self.projectiles.step(self.dt)
+            # Asked during the last actor update, which ran beside the step
+            self.perception.run()
+            self.apply_input()
+            self.worker.start(self.dt)
+            self.stepping = True
+            self.actors._step(self.dt)
+            return
+
+        self.apply_input()
+        self.physics.update(self.dt)
+        self.projectiles.step(self.dt)
+        self.actors._step(self.dt)
+        self.perception.run()
+        self.end_tick()
+
+    def apply_input(self):
+        events = self.input.drain()
+        if self.recorder != None:
+            self.recorder.record(self.tick, events)
+
+        if events and self.player != None:
+            player_input = self.player.get_component('input')
+            for action, pressed in events:
+                player_input.on_action(action, pressed)
+
+    def end_tick(self):
+        self.tick += 1
+        if self.recorder != None:
+            self.recorder.checkpoint(self.tick, self)
+
+    def set_pipelined(self, enabled):
+        '''Steps physics on a worker thread while the caller draws, see
+        pipeline.
+        '''
+        if enabled == (self.worker != None):
+            return
+        if enabled:
+            self.transforms = pipeline.TransformBuffer()
+            self.transforms.bind(self.physics_components())
+            self.physics.deferred = []
+            self.worker = pipeline.PhysicsWorker(self.physics, self.transforms)
+            # Pushed after the physics' handlers, so these run first
+            self.actors.push_handlers(on_actor_add=self.on_actor_change,
+                    on_actor_remove=self.on_actor_change)
+        else:
+            self.sync()
+            self.worker.stop()
+            self.worker = None
+            self.actors.remove_handlers(on_actor_add=self.on_actor_change,
+                    on_actor_remove=self.on_actor_change)
+            self.physics.finish_step()
+            self.physics.deferred = None
+            self.transforms.unbind(self.physics_components())
+            self.transforms = None
+
+    def sync(self):
+        '''Waits for the step running on the worker thread and finishes it.
+        Call before touching the space while pipelined.
+        '''
+        if self.stepping:
+            self.stepping = False
+            self.worker.wait()
+            self.transforms.swap()
+            self.physics.finish_step()
+            self.end_tick()
+
+    def on_actor_change(self, actor):
+        self.sync()
+        if actor.has_component('physics'):
+            self.transforms.unbind([actor.get_component('physics')])
+        self.rebind = True
+
+    def navigation_graph(self, profile):
+        '''The navigation.NavGraph of the level for characters with a
+        navigation.Profile. Built on first use, or loaded from the on-disk
+        cache if the level didn't change since.
+        '''
+        graph = self.navigation.get(profile.key())
+        if graph == None:
+            graph = self.navigation[profile.key()] = navigation.load(
+                    self.physics.collision_grid(), profile,
+                    self.map_filename or '')
+        return graph
+
+    def static_geometry_changed(self, shapes):
+        '''Follows static shapes being added to or removed from the space:
+        rebakes the collision grid and rebuilds the navigation graphs around
+        them.
+        '''
+        self.physics.update_grid()
+        ranges = []
+        for shape in shapes:
+            bb = shape.cache_bb()
+            ranges.append((bb.left, bb.right))
+        self.navigation_changed(ranges)
+
+    def navigation_changed(self, ranges):
+        '''Rebuilds the navigation graphs between left and right, for every
+        (left, right) in ranges, after the collision grid was rebaked.
+        '''
+        for graph in self.navigation.itervalues():
+            graph.invalidate(ranges)
+
+    def physics_components(self):
+        return [a.get_component('physics') for a in self.physics_actors()]
+
+    def physics_actors(self):
+        '''Actors with a physics component, in a stable order.
+        '''
+        found = [a for a in self.actors.get_actors() if a.has_component('physics')]
+        found.sort(key=lambda a: a.name)
+        return found
+
+    def checksum(self):
+        '''CRC of every actor body's position, angle and velocities. Two runs
+        that haven't diverged produce the same value on the same tick.
+        '''
+        crc = 0
+        for a in self.physics_actors():
+            body = a.get_component('physics').body
+            x, y = body.position
+            vx, vy = body.velocity
+            crc = zlib.crc32(_body_state.pack(x, y, body.angle, vx, vy,
+                body.angular_velocity), crc)
+        return crc & 0xffffffff
+
+def load_level(map_filename):
+    '''Builds a simulation for a map with no actors in it. Only the map
+    properties and collision geometry are loaded, no textures. The actors go
+    in an ActorSet, so no window or director is needed.
+    '''
+    debug.msg('Loading level %s' % map_filename)
+    properties = tiled.tiled.load_properties(
+            util.archive.open_file(util.resource.path(map_filename)))
+    level_physics = physics.from_xml(util.resource.path(properties['physics']))
+    if 'solid_layer' in properties or 'oneway_layer' in properties:
+        map_path = util.resource.path(map_filename)
+        tile_width, tile_height = tiled.tiled.load_tile_size(
+                util.archive.open_file(map_path))
+        level_physics.set_map_collision(properties,
+                tiled.tiled.load_tile_layers(util.archive.open_file(map_path)),
+                tile_width, tile_height)
+
+    layer = actor.actorlayer.ActorSet()
+    layer.push_handlers(on_actor_add=level_physics.on_actor_add,
+            on_actor_remove=level_physics.on_actor_remove)
+
+    simulation = Simulation(level_physics, layer)
+    simulation.map_filename = map_filename
+    return simulation
+
+def unload_level(simulation):
+    '''Stops the physics worker, removes every actor and closes the physics,
+    so nothing outside the simulation holds on to what the level made. The
+    simulation can't be stepped after this.
+    '''
+    simulation.set_pipelined(False)
+    for name in sorted(simulation.actors.actors):
+        simulation.actors.remove_actor(simulation.actors.get_actor(name))
+    simulation.physics.close()
+
+def spawn(simulation, actor_class, name, position):
+    '''Creates an actor of the given class, places it and adds it to the
+    simulation.
+    '''
+    new_actor = actor_class()
+    new_actor.name = name
+    new_actor.get_component('physics').body.position = position
+    simulation.actors.add_actor(new_actor)
+    return new_actor
+
+def spawn_blocks(simulation, count, columns=30):
+    '''Fills the level with a grid of blocks, bottom row first.
+    '''
+    for i in range(count):
+        spawn(simulation, actors.Block, 'Pile block %d' % i,
+                (80 + 50 * (i % columns), 150 + 50 * (i / columns)))
+
+def spawn_test_actors(simulation, player_class=actors.Player):
+    '''The player, a column of blocks and a platform.
+    '''
+    simulation.player = spawn(simulation, player_class, 'Player', (100, 100))
+
+    for y in range(350, 600, 50):
+        spawn(simulation, actors.Block, 'Block %d' % y, (350, y))
+
+    spawn(simulation, actors.MovingPlatform, 'Platform', (900, 144))
@@ -0,0 +1,249 @@
+'''Binary snapshots of a running simulation, for quick-save, rollback and
+fast test setup.
+A snapshot holds three flat arrays:
+    bodies      position, velocity, force, angle, angular velocity, torque
+                and rotation vector of every actor body (11 doubles each)
+    flags       move flags, jump state and, for kinematic characters,
+                ground contact of character actors (4 bytes each)
+    anims       direction, walking, frame and frame time of animated
+                actors (4 doubles each)
+Actors are laid out in name order. A Snapshotter works the layout out once
+and keeps a ctypes view of the state fields of every cpBody struct. Taking a
+snapshot joins the views into one string and restoring assigns slices of it
+back, neither makes a foreign call per body: about 0.2 us per body each way,
+against 2 us for a memmove per body. If the pymunk build doesn't expose the
+structs it falls back to the regular Body properties.
+Deltas only store the bodies that changed since a base snapshot.
+
+Restoring is not deterministic. Chipmunk keeps the contacts of the last
+step to warm start the solver and tracks how long bodies have been idle,
+and neither is in a snapshot: restore wakes every body and the solver
+starts from whatever contacts the space has cached. Steps after a restore
+come close to the original ones but aren't bit for bit the same.
+'''
+
+import array
+import ctypes
+import math
+
+from components import AnimComponent, CharacterPhysicsComponent
+
+BODY_DOUBLES = 11
+BODY_BYTES = BODY_DOUBLES * 8
+FLAG_BYTES = 4
+ANIM_DOUBLES = 4
+
+_body_view = ctypes.c_char * BODY_BYTES
+
+DIRECTIONS = ('north', 'south', 'east', 'west')
+
+class SnapshotException(Exception):
+    pass
+
+def raw_body_state(body):
+    '''Address of the contiguous p, v, f, a, w, t, rot fields of the body's
+    cpBody struct, or None if they can't be reached.
+    '''
+    try:
+        contents = body._body.contents
+        fields = type(contents)
+        start = fields.p.offset
+        end = fields.rot.offset + fields.rot.size
+    except AttributeError:
+        return None
+
+    if end - start != BODY_BYTES:
+        return None
+    return ctypes.addressof(contents) + start
+
+def body_views(bodies):
+    '''ctypes views of the state fields of the bodies' cpBody structs, in
+    snapshot layout, or None if they can't be reached. The bodies keep the
+    views valid.
+    '''
+    addresses = [raw_body_state(body) for body in bodies]
+    if None in addresses:
+        return None
+    return [_body_view.from_address(a) for a in addresses]
+
+def read_body(body):
+    '''Body state through the pymunk API, in snapshot layout.
+    '''
+    x, y = body.position
+    vx, vy = body.velocity
+    fx, fy = body.force
+    angle = body.angle
+    return (x, y, vx, vy, fx, fy, angle, body.angular_velocity, body.torque,
+            math.cos(angle), math.sin(angle))
+
+def write_body(body, state):
+    body.position = state[0:2]
+    body.velocity = state[2:4]
+    body.force = state[4:6]
+    body.angle = state[6]
+    body.angular_velocity = state[7]
+    body.torque = state[8]
+
+class Snapshot(object):
+    def __init__(self, tick, bodies, flags, anims):
+        self.tick = tick
+        self.bodies = bodies
+        self.flags = flags
+        self.anims = anims
+
+    def to_string(self):
+        header = array.array('I', (self.tick, len(self.bodies),
+            len(self.flags), len(self.anims)))
+        return ''.join((header.tostring(), self.bodies.tostring(),
+            self.flags.tostring(), self.anims.tostring()))
+
+    @classmethod
+    def from_string(cls, data):
+        header = array.array('I')
+        header.fromstring(data[:16])
+        tick, body_count, flag_count, anim_count = header
+        offset = 16
+
+        bodies = array.array('d')
+        bodies.fromstring(data[offset:offset + body_count * 8])
+        offset += body_count * 8
+        flags = array.array('B')
+        flags.fromstring(data[offset:offset + flag_count])
+        offset += flag_count
+        anims = array.array('d')
+        anims.fromstring(data[offset:offset + anim_count * 8])
+        return cls(tick, bodies, flags, anims)
+
+class Delta(object):
+    '''Changes from the snapshot at base_tick. Only changed bodies are kept,
+    flags and animation state are small enough to store whole.
+    '''
+    def __init__(self, tick, base_tick, indices, bodies, flags, anims):
+        self.tick = tick
+        self.base_tick = base_tick
+        self.indices = indices
+        self.bodies = bodies
+        self.flags = flags
+        self.anims = anims
+
+def delta(base, current):
+    indices = array.array('I')
+    bodies = array.array('d')
+    old = base.bodies
+    new = current.bodies
+    if len(old) != len(new):
+        raise SnapshotException('Snapshots have different layouts')
+
+    for i in xrange(0, len(new), BODY_DOUBLES):
+        state = new[i:i + BODY_DOUBLES]
+        if state != old[i:i + BODY_DOUBLES]:
+            indices.append(i / BODY_DOUBLES)
+            bodies.extend(state)
+    return Delta(current.tick, base.tick, indices, bodies,
+            array.array('B', current.flags), array.array('d', current.anims))
+
+def apply_delta(base, change):
+    '''Rebuilds the full snapshot a delta was taken from.
+    '''
+    if change.base_tick != base.tick:
+        raise SnapshotException('Delta is based on tick %d, not %d' %
+                (change.base_tick, base.tick))
+
+    bodies = array.array('d', base.bodies)
+    for n, index in enumerate(change.indices):
+        start = index * BODY_DOUBLES
+        bodies[start:start + BODY_DOUBLES] = \
+                change.bodies[n * BODY_DOUBLES:(n + 1) * BODY_DOUBLES]
+    return Snapshot(change.tick, bodies, array.array('B', change.flags),
+            array.array('d', change.anims))
+
+class Snapshotter(object):
+    '''Takes and restores snapshots of one simulation. Call rebind after
+    actors were added or removed. Without anims set animation state is left
+    out, it doesn't change the simulation and headless runs have none.
+    '''
+    def __init__(self, simulation, anims=True):
+        self.simulation = simulation
+        self.anims = anims
+        self.rebind()
+
+    def rebind(self):
+        actors = self.simulation.physics_actors()
+        self.actors = actors
+        self.bodies = [a.get_component('physics').body for a in actors]
+        self.characters = [a.get_component('physics') for a in actors
+                if isinstance(a.get_component('physics'), CharacterPhysicsComponent)]
+        self.animated = []
+        if self.anims:
+            self.animated = [a.get_component('sprite') for a in actors
+                    if a.has_component('sprite', AnimComponent)]
+
+        self.views = body_views(self.bodies)
+        self._empty = array.array('d', [0.0]) * (len(self.bodies) * BODY_DOUBLES)
+
+    def take(self):
+        if self.views != None:
+            bodies = array.array('d')
+            bodies.fromstring(''.join([view.raw for view in self.views]))
+        else:
+            bodies = array.array('d', self._empty)
+            i = 0
+            for body in self.bodies:
+                bodies[i:i + BODY_DOUBLES] = array.array('d', read_body(body))
+                i += BODY_DOUBLES
+
+        flags = array.array('B')
+        for physics in self.characters:
+            flags.extend((physics.move_flags[0], physics.move_flags[1],
+                physics.jumping, physics.kinematic and physics.grounded))
+
+        anims = array.array('d')
+        for anim in self.animated:
+            frame, elapsed = 0, 0.0
+            if anim.clock != None:
+                frame, elapsed = anim.clock.state(anim.sprite)
+            anims.extend((DIRECTIONS.index(anim.direction), anim.walking,
+                frame, elapsed))
+
+        return Snapshot(self.simulation.tick, bodies, flags, anims)
+
+    def restore(self, snapshot):
+        if len(snapshot.bodies) != len(self._empty) or \
+                len(snapshot.flags) != len(self.characters) * FLAG_BYTES or \
+                len(snapshot.anims) != len(self.animated) * ANIM_DOUBLES:
+            raise SnapshotException('Snapshot does not match the simulation')
+
+        bodies = snapshot.bodies
+        if self.views != None:
+            data = bodies.tostring()
+            i = 0
+            for view in self.views:
+                view.raw = data[i:i + BODY_BYTES]
+                i += BODY_BYTES
+        else:
+            for n, body in enumerate(self.bodies):
+                write_body(body, bodies[n * BODY_DOUBLES:(n + 1) * BODY_DOUBLES])
+
+        flags = snapshot.flags
+        for n, physics in enumerate(self.characters):
+            i = n * FLAG_BYTES
+            physics.move_flags[0] = bool(flags[i])
+            physics.move_flags[1] = bool(flags[i + 1])
+            physics.jumping = bool(flags[i + 2])
+            if physics.kinematic:
+                physics.grounded = bool(flags[i + 3])
+            # Brings surface velocity back in line with the move flags
+            physics.update_forces()
+
+        anims = snapshot.anims
+        for n, anim in enumerate(self.animated):
+            i = n * ANIM_DOUBLES
+            anim.direction = DIRECTIONS[int(anims[i])]
+            anim.walking = bool(anims[i + 1])
+            anim.update_animation()
+            if anim.clock != None:
+                anim.clock.seek(anim.sprite, int(anims[i + 2]), anims[i + 3])
+
+        self.simulation.tick = snapshot.tick
+        # Sleeping bodies don't notice they were moved
+        self.simulation.physics.wake_all()
@@ -0,0 +1,185 @@
+'''Static vertex buffer rendering for tile layers.
+A layer is cut into square chunks of tiles and each chunk is baked once into
+one vertex list per tileset texture. Drawing a frame only has to pick the
+chunks that overlap the view, nothing is rebuilt while scrolling.
+Only fixed function GL 1.1 features are used (client side arrays, GL_QUADS),
+so this also works on software renderers.
+'''
+
+import pyglet
+from pyglet.gl import *
+import cocos
+
+CHUNK_SIZE = 16
+
+class TileData(object):
+    '''Raw global tile ids of a Tiled layer, in Tiled's row order (top row
+    first). A gid of 0 is an empty cell.
+    '''
+    def __init__(self, name, width, height, data):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.data = data
+
+    def get(self, i, j):
+        '''Gid at column i, row j where row 0 is the bottom of the map.
+        '''
+        return self.data[(self.height - j - 1) * self.width + i]
+
+    def set(self, i, j, gid):
+        self.data[(self.height - j - 1) * self.width + i] = gid
+
+def diff_tiles(old, new):
+    '''Cells that differ between two TileData of the same size, as a list
+    of (i, j, gid) with the gid taken from new.
+    '''
+    changes = []
+    width, height = new.width, new.height
+    old_data, new_data = old.data, new.data
+    for n in xrange(len(new_data)):
+        if old_data[n] != new_data[n]:
+            changes.append((n % width, height - n / width - 1, new_data[n]))
+    return changes
+
+def tile_coords(tileset):
+    '''Returns (texture, tex_coords) for every tile in a tileset, indexed by
+    gid - 1.
+    '''
+    return [(tile.image.texture, tile.image.tex_coords) for tile in tileset]
+
+def build_chunk(tiledata, tiles, tile_width, tile_height, chunk_x, chunk_y,
+        chunk_size=CHUNK_SIZE):
+    '''Generates the quads for one chunk of a layer. tiles maps gid - 1 to a
+    (texture, tex_coords) pair as returned by tile_coords. Returns a dict
+    mapping each texture used in the chunk to a (vertices, tex_coords) pair
+    of flat lists ready for a GL_QUADS vertex list.
+    '''
+    geometry = {}
+    first_i = chunk_x * chunk_size
+    first_j = chunk_y * chunk_size
+
+    for j in range(first_j, min(first_j + chunk_size, tiledata.height)):
+        y1 = j * tile_height
+        y2 = y1 + tile_height
+        for i in range(first_i, min(first_i + chunk_size, tiledata.width)):
+            gid = tiledata.get(i, j)
+            if gid == 0:
+                continue
+
+            texture, tex_coords = tiles[gid - 1]
+            if texture not in geometry:
+                geometry[texture] = ([], [])
+            vertices, texcoords = geometry[texture]
+
+            x1 = i * tile_width
+            x2 = x1 + tile_width
+            vertices.extend((x1, y1, x2, y1, x2, y2, x1, y2))
+            texcoords.extend(tex_coords)
+    return geometry
+
+def chunk_range(x, y, width, height, chunk_width, chunk_height, chunks_x,
+        chunks_y):
+    '''Returns the chunk columns and rows that overlap the given pixel
+    rectangle, clamped to the layer.
+    '''
+    first_x = max(0, int(x // chunk_width))
+    first_y = max(0, int(y // chunk_height))
+    last_x = min(chunks_x - 1, int((x + width) // chunk_width))
+    last_y = min(chunks_y - 1, int((y + height) // chunk_height))
+    return range(first_x, last_x + 1), range(first_y, last_y + 1)
+
+class ChunkedTileLayer(cocos.layer.ScrollableLayer):
+    '''Scrollable tile layer drawn from static per-chunk vertex lists.
+    '''
+    def __init__(self, tiledata, tiles, tile_width, tile_height,
+            chunk_size=CHUNK_SIZE):
+        super(ChunkedTileLayer, self).__init__()
+        self.id = tiledata.name
+        self.tiledata = tiledata
+        self.tiles = tiles
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.chunk_size = chunk_size
+
+        # The scrolling manager reads these to clamp the focus
+        self.px_width = tiledata.width * tile_width
+        self.px_height = tiledata.height * tile_height
+
+        self.chunks_x = (tiledata.width + chunk_size - 1) / chunk_size
+        self.chunks_y = (tiledata.height + chunk_size - 1) / chunk_size
+        # (chunk_x, chunk_y) -> list of (texture, vertex list)
+        self.chunks = {}
+        for cy in range(self.chunks_y):
+            for cx in range(self.chunks_x):
+                self.build_chunk(cx, cy)
+
+    def build_chunk(self, cx, cy):
+        '''(Re)bakes the vertex lists of one chunk.
+        '''
+        self.delete_chunk(cx, cy)
+
+        geometry = build_chunk(self.tiledata, self.tiles, self.tile_width,
+                self.tile_height, cx, cy, self.chunk_size)
+        if not geometry:
+            return
+
+        vertex_lists = []
+        for texture, (vertices, tex_coords) in geometry.items():
+            vertex_list = pyglet.graphics.vertex_list(len(vertices) / 2,
+                    ('v2i/static', vertices), ('t3f/static', tex_coords))
+            vertex_lists.append((texture, vertex_list))
+        # Keep draws of the same texture together
+        vertex_lists.sort(key=lambda item: item[0].id)
+        self.chunks[(cx, cy)] = vertex_lists
+
+    def set_cells(self, changes):
+        '''Applies a list of (i, j, gid) changes and rebakes only the chunks
+        they fall in.
+        '''
+        dirty = set()
+        for i, j, gid in changes:
+            self.tiledata.set(i, j, gid)
+            dirty.add((i / self.chunk_size, j / self.chunk_size))
+        for cx, cy in dirty:
+            self.build_chunk(cx, cy)
+        return len(dirty)
+
+    def delete(self):
+        '''Frees the vertex lists of every chunk.
+        '''
+        for cx, cy in self.chunks.keys():
+            self.delete_chunk(cx, cy)
+
+    def delete_chunk(self, cx, cy):
+        for texture, vertex_list in self.chunks.pop((cx, cy), ()):
+            vertex_list.delete()
+
+    def visible_chunks(self):
+        '''Keys of the baked chunks overlapping the current view.
+        '''
+        chunk_width = self.chunk_size * self.tile_width
+        chunk_height = self.chunk_size * self.tile_height
+        columns, rows = chunk_range(self.view_x, self.view_y, self.view_w,
+                self.view_h, chunk_width, chunk_height, self.chunks_x,
+                self.chunks_y)
+        return [(cx, cy) for cy in rows for cx in columns
+                if (cx, cy) in self.chunks]
+
+    def draw(self):
+        glPushMatrix()
+        self.transform()
+
+        bound = None
+        for key in self.visible_chunks():
+            for texture, vertex_list in self.chunks[key]:
+                if texture is not bound:
+                    if bound == None:
+                        glEnable(texture.target)
+                    glBindTexture(texture.target, texture.id)
+                    bound = texture
+                vertex_list.draw(GL_QUADS)
+
+        if bound != None:
+            glDisable(bound.target)
+        glPopMatrix()
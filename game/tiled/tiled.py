@@ -1,6 +1,7 @@
 '''Tiled is a 2D tile-based map editor. Tiled uses a highly customizable XML
 format for storing created maps.
-Tile layers are translated into Cocos2D RectMapLayer objects. Object layers are
+Tile layers are translated into Cocos2D RectMapLayer objects, or into chunked
+static vertex buffer layers (see the chunks module). Object layers are
 loaded into a simple data type, but the objects themselves are loaded by
 factory methods are that registered by the user. See register_object_factory
 for details.
@@ -21,6 +22,8 @@ import pyglet
 from pyglet.gl import *
 import cocos
 
+import chunks
+
 class TileSet(list):
     pass
 
@@ -41,18 +44,24 @@ class TiledMap(object):
         self.tile_height = 0
         self.tileset = TileSet()
         self.layers = {}
+        # Raw tile ids of every tile layer, see chunks.TileData
+        self.tile_data = {}
         self.object_groups = {}
         self.properties = {}
 
 class MapException(Exception):
     pass
 
+# Loads tileset images by resource name. Replace it to load them some other
+# way, e.g. from a cache.
+image_loader = pyglet.resource.image
+
 def load_image(tag):
     # Get image properties
     source = tag.get('source')
     width = int(tag.get('width'))
     height = int(tag.get('height'))
-    return pyglet.resource.image(source), width, height
+    return image_loader(source), width, height
 
 def load_tileset(tag):
     # Get tileset properties
@@ -92,7 +101,48 @@ def register_object_factory(name):
         return func
     return decorate
 
-def load_map(filename):
+def load_properties(filename):
+    '''Reads only the map properties, without loading any tilesets. Useful
+    when there is no GL context to load textures into.
+    '''
+    root = ElementTree.parse(filename).getroot()
+    if root.tag != 'map':
+        raise MapException('%s root level tag is %s rather than <map>' % (filename, root.tag))
+
+    properties = {}
+    tag = root.find('properties')
+    if tag != None:
+        for p in tag.findall('property'):
+            properties[p.get('name')] = p.get('value')
+    return properties
+
+def load_tile_size(filename):
+    '''Reads only the tile width and height of a map.
+    '''
+    root = ElementTree.parse(filename).getroot()
+    if root.tag != 'map':
+        raise MapException('%s root level tag is %s rather than <map>' % (filename, root.tag))
+    return int(root.get('tilewidth')), int(root.get('tileheight'))
+
+def load_tile_layers(filename):
+    '''Reads only the raw tile data of every layer, mapped by layer name.
+    No tilesets or textures are loaded.
+    '''
+    root = ElementTree.parse(filename).getroot()
+    if root.tag != 'map':
+        raise MapException('%s root level tag is %s rather than <map>' % (filename, root.tag))
+
+    layers = {}
+    for tag in root.findall('layer'):
+        tiledata = load_tile_data(tag)
+        layers[tiledata.name] = tiledata
+    return layers
+
+def load_map(filename, chunked=False):
+    '''Loads a Tiled map from a filename or a file object. With chunked set,
+    tile layers are built as chunks.ChunkedTileLayer instead of cocos
+    RectMapLayer.
+    '''
     # Open xml file
     tree = ElementTree.parse(filename)
     root = tree.getroot()
@@ -123,8 +173,15 @@ def load_map(filename):
         tiledmap.tileset += load_tileset(tag)
 
     # Load layers
+    tiles = chunks.tile_coords(tiledmap.tileset) if chunked else None
     for tag in root.findall('layer'):
-        layer = load_layer(tag, tiledmap)
+        tiledata = load_tile_data(tag)
+        tiledmap.tile_data[tiledata.name] = tiledata
+        if chunked:
+            layer = chunks.ChunkedTileLayer(tiledata, tiles,
+                    tiledmap.tile_width, tiledmap.tile_height)
+        else:
+            layer = make_layer(tiledata, tiledmap)
         tiledmap.layers[layer.id] = layer
 
     # Load object layers
@@ -134,7 +191,7 @@ def load_map(filename):
 
     return tiledmap
     
-def load_layer(tag, tiledmap):
+def load_tile_data(tag):
     # Get layer properties
     name = tag.get('name')
     width = int(tag.get('width'))
@@ -146,7 +203,16 @@ def load_layer(tag, tiledmap):
         raise MapException('No <data> tag in layer')
 
     # Load layer data
-    data = load_data(child)
+    return chunks.TileData(name, width, height, load_data(child))
+
+def load_layer(tag, tiledmap):
+    return make_layer(load_tile_data(tag), tiledmap)
+
+def make_layer(tiledata, tiledmap):
+    width = tiledata.width
+    height = tiledata.height
+    data = tiledata.data
+
     # Construct layer
     columns = []
     for i in range(0, width):
@@ -160,7 +226,7 @@ def load_layer(tag, tiledmap):
             row.insert(0, cocos.tiles.RectCell(i, height - j - 1,
                 tiledmap.tile_width, tiledmap.tile_height, None, tile))
 
-    return cocos.tiles.RectMapLayer(name, tiledmap.tile_width, 
+    return cocos.tiles.RectMapLayer(tiledata.name, tiledmap.tile_width, 
                                     tiledmap.tile_height, columns, (0,0,0),
                                     None)
 
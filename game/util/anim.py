@@ -3,36 +3,266 @@ try:
 except ImportError:
     import elementtree.ElementTree as ElementTree
 
+import array
+import marshal
 import pyglet
 
-# Just a typedef, move along folks
-class AnimSet(dict):
+import atlas
+import archive
+
+# Compiled animsets written by the asset build start with this
+COMPILED_MAGIC = 'PANM'
+
+class AnimException(Exception):
     pass
 
-def load_animset(filename):
+class AnimSet(dict):
+    '''Animation name to pyglet.image.Animation. Also remembers the file and
+    definition it was built from, so it can be rebuilt in place.
+    '''
+    def __init__(self, filename=None, definition=None):
+        super(AnimSet, self).__init__()
+        self.filename = filename
+        self.definition = definition
+
+class AnimSetDef(object):
+    '''Parsed animset XML, before any images are loaded. anims maps
+    animation names to (duration, frame indices).
+    '''
+    def __init__(self, image, tile_width, tile_height, anims):
+        self.image = image
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.anims = anims
+
+    def to_string(self):
+        '''Compiled form, loads without any XML parsing.
+        '''
+        return COMPILED_MAGIC + marshal.dumps((self.image, self.tile_width,
+            self.tile_height, self.anims))
+
+    @classmethod
+    def from_string(cls, data):
+        return cls(*marshal.loads(str(data[len(COMPILED_MAGIC):])))
+
+    def same_sheet(self, other):
+        return (self.image, self.tile_width, self.tile_height) == \
+                (other.image, other.tile_width, other.tile_height)
+
+def parse_animset(filename):
+    return parse_animset_data(archive.read(filename))
+
+def parse_animset_data(data):
+    '''AnimSetDef out of the contents of an animset file, XML or compiled.
+    '''
+    if data[:len(COMPILED_MAGIC)] == COMPILED_MAGIC:
+        return AnimSetDef.from_string(data)
+
     # Open xml file
-    root = ElementTree.parse(filename).getroot()
+    root = ElementTree.fromstring(data)
     if root.tag != 'animset':
-        raise MapException('Expected <animset> tag, found <%s> tag' % root.tag)
+        raise AnimException('Expected <animset> tag, found <%s> tag' % root.tag)
 
-    # Get animset properties
-    image = pyglet.resource.image('anims/' + root.get('image'))
-    tile_width = int(root.get('tilewidth'))
-    tile_height = int(root.get('tileheight'))
+    anims = {}
+    for child in root.findall('anim'):
+        duration = float(child.get('duration'))
+        frames = tuple(int(x) for x in child.text.split(','))
+        anims[child.get('name')] = (duration, frames)
 
-    # Create image sequence of tiles
-    grid = pyglet.image.ImageGrid(image, image.width / tile_width, image.height / tile_height)
-    sequence = grid.get_texture_sequence()
-    anims = AnimSet()
+    return AnimSetDef('anims/' + root.get('image'), int(root.get('tilewidth')),
+            int(root.get('tileheight')), anims)
 
-    # Loop through all animations
-    for child in root.findall('anim'):
-        anim_name = child.get('name')
-        anim_duration = float(child.get('duration'))
-        frame_indices = [int(x) for x in child.text.split(',')]
-        frames = list()
-        for f in frame_indices:
-            frames.append(sequence[f])
-        anims[anim_name] = pyglet.image.Animation.from_image_sequence(frames, anim_duration, loop=True)
+def animset_image(filename):
+    '''Resource name of the sprite sheet used by an animset.
+    '''
+    return parse_animset(filename).image
+
+def load_animset(filename):
+    definition = parse_animset(filename)
+    anims = AnimSet(filename, definition)
+    build_anims(anims, definition.anims.keys())
     return anims
 
+def build_anims(anims, names):
+    '''(Re)builds the named animations of an animset from its definition.
+    '''
+    definition = anims.definition
+    image = atlas.image(definition.image)
+
+    # Create image sequence of tiles. ImageGrid takes rows, then columns.
+    grid = pyglet.image.ImageGrid(image, image.height / definition.tile_height,
+            image.width / definition.tile_width)
+    sequence = grid.get_texture_sequence()
+
+    for name in names:
+        duration, frame_indices = definition.anims[name]
+        frames = [sequence[f] for f in frame_indices]
+        anims[name] = pyglet.image.Animation.from_image_sequence(frames,
+                duration, loop=True)
+
+def reload_animset(anims, new=None):
+    '''Rebuilds only the animations whose definition changed, or all of them
+    if the sprite sheet changed. The file is re-read unless a new definition
+    is passed in. Returns the names of the animations that were rebuilt or
+    removed.
+    '''
+    old = anims.definition
+    if new == None:
+        new = parse_animset(anims.filename)
+    anims.definition = new
+
+    if not new.same_sheet(old):
+        changed = set(new.anims)
+    else:
+        changed = set(name for name, anim in new.anims.iteritems()
+                if old.anims.get(name) != anim)
+    removed = set(old.anims) - set(new.anims)
+
+    for name in removed:
+        del anims[name]
+    build_anims(anims, changed)
+    return changed | removed
+
+class AnimationClock(object):
+    '''Drives the animations of many sprites from a single tick instead of a
+    pyglet clock callback per sprite. Frame state lives in flat arrays indexed
+    by slot. Frames of an animset share one texture, so advancing a frame only
+    rewrites the sprite's texture coordinates.
+    Sprites registered here must be given static images, not
+    pyglet.image.Animation objects, or pyglet will schedule them on its own.
+    '''
+    def __init__(self):
+        self.slots = {}
+        self.sprites = []
+        self.animations = []
+        self.frames = []
+        self.frame_index = array.array('i')
+        self.elapsed = array.array('d')
+        # Compiled frame tuples, keyed by animation
+        self._compiled = {}
+
+    def __len__(self):
+        return len(self.sprites)
+
+    def __contains__(self, sprite):
+        return sprite in self.slots
+
+    def compile(self, animation):
+        '''Turns an animation into a tuple of (image, duration) pairs.
+        Frames of no duration are never seen and are left out, if that's all
+        of them the first one is shown for good.
+        '''
+        frames = self._compiled.get(animation)
+        if frames == None:
+            frames = tuple((f.image, f.duration) for f in animation.frames
+                    if f.duration != 0)
+            if not frames:
+                frames = ((animation.frames[0].image, None),)
+            self._compiled[animation] = frames
+        return frames
+
+    def add(self, sprite, animation):
+        if sprite in self.slots:
+            self.play(sprite, animation)
+            return
+
+        self.slots[sprite] = len(self.sprites)
+        self.sprites.append(sprite)
+        self.animations.append(animation)
+        self.frames.append(self.compile(animation))
+        self.frame_index.append(0)
+        self.elapsed.append(0.0)
+        self._show(sprite, self.frames[-1][0][0])
+
+    def remove(self, sprite):
+        '''Unregisters a sprite by moving the last slot into its place.
+        '''
+        slot = self.slots.pop(sprite)
+        last = len(self.sprites) - 1
+        if slot != last:
+            moved = self.sprites[last]
+            self.sprites[slot] = moved
+            self.animations[slot] = self.animations[last]
+            self.frames[slot] = self.frames[last]
+            self.frame_index[slot] = self.frame_index[last]
+            self.elapsed[slot] = self.elapsed[last]
+            self.slots[moved] = slot
+
+        self.sprites.pop()
+        self.animations.pop()
+        self.frames.pop()
+        self.frame_index.pop()
+        self.elapsed.pop()
+
+    def play(self, sprite, animation):
+        '''Switches a sprite to another animation. Switching to the animation
+        that is already playing does nothing.
+        '''
+        slot = self.slots[sprite]
+        if self.animations[slot] is animation:
+            return
+
+        self.animations[slot] = animation
+        self.frames[slot] = self.compile(animation)
+        self.frame_index[slot] = 0
+        self.elapsed[slot] = 0.0
+        self._show(sprite, self.frames[slot][0][0])
+
+    def tick(self, dt):
+        frames = self.frames
+        frame_index = self.frame_index
+        elapsed = self.elapsed
+        changed = []
+
+        for slot in xrange(len(frames)):
+            anim_frames = frames[slot]
+            index = frame_index[slot]
+            duration = anim_frames[index][1]
+            # None marks the last frame of a non-looping animation
+            if duration == None or len(anim_frames) == 1:
+                continue
+
+            time = elapsed[slot] + dt
+            if time < duration:
+                elapsed[slot] = time
+                continue
+
+            while duration != None and time >= duration:
+                time -= duration
+                index = (index + 1) % len(anim_frames)
+                duration = anim_frames[index][1]
+            elapsed[slot] = time
+            frame_index[slot] = index
+            changed.append(slot)
+
+        # Write all the new frames out in one go
+        sprites = self.sprites
+        for slot in changed:
+            self._show(sprites[slot], frames[slot][frame_index[slot]][0])
+
+    def state(self, sprite):
+        '''Returns (frame index, elapsed time) of a registered sprite.
+        '''
+        slot = self.slots[sprite]
+        return self.frame_index[slot], self.elapsed[slot]
+
+    def seek(self, sprite, index, elapsed):
+        '''Jumps a registered sprite to the given frame of its animation.
+        '''
+        slot = self.slots[sprite]
+        frames = self.frames[slot]
+        index = index % len(frames)
+        self.frame_index[slot] = index
+        self.elapsed[slot] = elapsed
+        self._show(sprite, frames[index][0])
+
+    def _show(self, sprite, image):
+        vertex_list = getattr(sprite, '_vertex_list', None)
+        texture = getattr(sprite, '_texture', None)
+        if vertex_list != None and texture != None and \
+                image.get_texture().id == texture.id:
+            # Same texture, only the texture coordinates change
+            sprite._texture = image.get_texture()
+            vertex_list.tex_coords[:] = image.tex_coords
+        else:
+            sprite.image = image
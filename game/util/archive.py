@@ -0,0 +1,175 @@
+'''Packed asset archives.
+An archive is one file holding every asset, read through mmap so opening an
+asset is a dictionary lookup instead of a filesystem open and seek. Members
+are named by their path relative to the game directory, e.g.
+'data/maps/test.tmx'.
+
+File layout, all little endian:
+    header      magic 'PPAK', version (H), member count (I), index offset (Q)
+    data        member contents, each starting on an ALIGN byte boundary
+    index       for each member: offset (Q), size (Q), sha1 digest (20s),
+                name length (H) and the utf-8 name
+
+Mounted archives are addressed through virtual filenames, the archive's
+filename joined with the member name. util.resource.path hands those out
+for archived resources, and read and open_file below accept them as well as
+regular filenames. Nothing can write to them or watch them, see
+util.resource.file_path.
+'''
+
+import os
+import mmap
+import struct
+import hashlib
+import cStringIO
+
+import savefile
+
+MAGIC = 'PPAK'
+VERSION = 1
+ALIGN = 16
+
+_header = struct.Struct('<4sHIQ')
+_entry = struct.Struct('<QQ20sH')
+
+class ArchiveException(Exception):
+    pass
+
+def pack(filename, members):
+    '''Writes an archive. members is a list of (name, source filename).
+    '''
+    data = [None]
+    offset = _header.size
+    index = []
+    for name, source in sorted(members):
+        f = open(source, 'rb')
+        try:
+            contents = f.read()
+        finally:
+            f.close()
+
+        padding = -offset % ALIGN
+        data.append('\0' * padding + contents)
+        offset += padding
+        index.append(_entry.pack(offset, len(contents),
+            hashlib.sha1(contents).digest(), len(name.encode('utf-8'))) +
+            name.encode('utf-8'))
+        offset += len(contents)
+
+    data[0] = _header.pack(MAGIC, VERSION, len(index), offset)
+    data.extend(index)
+    savefile.atomic_write(filename, ''.join(data))
+    return len(index)
+
+class Archive(object):
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        f = open(filename, 'rb')
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            # The mapping keeps its own handle
+            f.close()
+
+        magic, version, count, offset = _header.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ArchiveException('%s is not an archive' % filename)
+        if version != VERSION:
+            raise ArchiveException('Unsupported archive version %d' % version)
+
+        # name -> (offset, size, digest)
+        self.members = {}
+        for i in xrange(count):
+            start, size, digest, length = _entry.unpack_from(self.map, offset)
+            offset += _entry.size
+            name = self.map[offset:offset + length].decode('utf-8')
+            offset += length
+            self.members[name] = (start, size, digest)
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def __len__(self):
+        return len(self.members)
+
+    def names(self):
+        return self.members.keys()
+
+    def get(self, name):
+        '''Contents of a member as a buffer over the mapping, nothing is
+        copied. XML parsers, zlib and struct all take buffers directly.
+        '''
+        try:
+            offset, size, digest = self.members[name]
+        except KeyError:
+            raise ArchiveException('%s is not in %s' % (name, self.filename))
+        return buffer(self.map, offset, size)
+
+    def open(self, name):
+        '''File-like object over a member. Backed by the mapping, but each
+        read returns a copy like a real file does.
+        '''
+        return cStringIO.StringIO(self.get(name))
+
+    def verify(self, name):
+        return hashlib.sha1(self.get(name)).digest() == self.members[name][2]
+
+    def close(self):
+        '''Unmaps the archive. Buffers handed out by get must not be used
+        after this.
+        '''
+        self.map.close()
+
+# Mounted archives, see mount
+_mounted = []
+
+def mount(filename):
+    for archive in _mounted:
+        if archive.filename == os.path.abspath(filename):
+            return archive
+    archive = Archive(filename)
+    _mounted.append(archive)
+    return archive
+
+def unmount(archive):
+    _mounted.remove(archive)
+    archive.close()
+
+def lookup(filename):
+    '''Returns the mounted archive and member name a virtual filename refers
+    to, or (None, None) for a regular file.
+    '''
+    for archive in _mounted:
+        prefix = archive.filename + os.sep
+        if filename.startswith(prefix):
+            name = filename[len(prefix):].replace(os.sep, '/')
+            if name in archive:
+                return archive, name
+    return None, None
+
+def read(filename):
+    '''Whole contents of a file, as a zero-copy buffer if it is archived.
+    '''
+    archive, name = lookup(filename)
+    if archive != None:
+        return archive.get(name)
+
+    f = open(filename, 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def digest(filename):
+    '''sha1 digest of a file. Free for archived files, the index has it.
+    '''
+    archive, name = lookup(filename)
+    if archive != None:
+        return archive.members[name][2]
+    return hashlib.sha1(read(filename)).digest()
+
+def open_file(filename):
+    archive, name = lookup(filename)
+    if archive != None:
+        return archive.open(name)
+    return open(filename, 'rb')
@@ -0,0 +1,109 @@
+'''Runtime texture atlas for sprite images.
+Sprites that share a texture can be drawn by one batch in a single call.
+Every actor type loading its own image breaks a batch into a call per
+texture, so images are packed into shared atlas pages when assets load and
+sprites are handed regions of those pages instead.
+Packing is a plain shelf packer with a fixed sort order, so the same set of
+images always ends up in the same place.
+'''
+
+import pyglet
+from pyglet.gl import *
+
+import texcache
+
+class AtlasException(Exception):
+    pass
+
+def pack(sizes, page_width, page_height, padding=1):
+    '''Packs rectangles onto as few pages as possible. sizes is a list of
+    (name, width, height). Returns a dict mapping name to (page, x, y) and
+    the number of pages used.
+    Rectangles are placed tallest first, ties broken by width and then name,
+    on shelves that are filled left to right.
+    '''
+    order = sorted(sizes, key=lambda s: (-s[2], -s[1], s[0]))
+    placements = {}
+    page = 0
+    x = y = shelf_height = 0
+    used = False
+
+    for name, width, height in order:
+        if width + padding * 2 > page_width or height + padding * 2 > page_height:
+            raise AtlasException('%s (%dx%d) does not fit on a %dx%d atlas page'
+                    % (name, width, height, page_width, page_height))
+
+        if x + width + padding * 2 > page_width:
+            # Start a new shelf
+            x = 0
+            y += shelf_height
+            shelf_height = 0
+        if y + height + padding * 2 > page_height:
+            # Start a new page
+            page += 1
+            x = y = shelf_height = 0
+
+        placements[name] = (page, x + padding, y + padding)
+        x += width + padding * 2
+        shelf_height = max(shelf_height, height + padding * 2)
+        used = True
+
+    return placements, page + 1 if used else 0
+
+def draw_calls(sprites):
+    '''Estimates the draw calls a batch of sprites takes: one per distinct
+    texture.
+    '''
+    return len(set(sprite.image.get_texture().id for sprite in sprites))
+
+class Atlas(object):
+    def __init__(self, page_width=1024, page_height=1024, padding=1):
+        self.page_width = page_width
+        self.page_height = page_height
+        self.padding = padding
+        self.pages = []
+        self.regions = {}
+
+    def build(self, names, loader=None):
+        '''Decodes the named resources and packs them into fresh atlas pages.
+        loader maps a resource name to an ImageData and defaults to the
+        decoded image cache.
+        '''
+        if loader == None:
+            loader = texcache.load
+
+        names = sorted(set(names))
+        images = dict((name, loader(name)) for name in names)
+        placements, count = pack(
+                [(name, images[name].width, images[name].height) for name in names],
+                self.page_width, self.page_height, self.padding)
+
+        self.pages = []
+        for i in range(count):
+            page = pyglet.image.Texture.create(self.page_width, self.page_height)
+            glBindTexture(page.target, page.id)
+            glTexParameteri(page.target, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+            glTexParameteri(page.target, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+            self.pages.append(page)
+
+        self.regions = {}
+        for name in names:
+            image = images[name]
+            page, x, y = placements[name]
+            self.pages[page].blit_into(image, x, y, 0)
+            self.regions[name] = self.pages[page].get_region(x, y,
+                    image.width, image.height)
+
+    def image(self, name):
+        '''Returns the atlas region for a resource, or the plain
+        pyglet.resource image if it was not packed.
+        '''
+        region = self.regions.get(name)
+        if region == None:
+            return pyglet.resource.image(name)
+        return region
+
+# Shared atlas used by actors and animsets
+default = Atlas()
+build = default.build
+image = default.image
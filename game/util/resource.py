@@ -1,6 +1,204 @@
+'''Resource lookup.
+pyglet.resource normally walks every resource directory to build its index
+on startup. Instead the index is read from a manifest written by a previous
+run. The manifest remembers the modification time of every directory it
+covers, and a directory's mtime changes whenever a file is added, removed or
+renamed in it, so a handful of stats tell whether the manifest is stale.
+The tree is only walked again when it is.
+When a packed archive (see util.archive) is present, resources are served
+from it instead. During development loose files win over the archive, so
+edited files are picked up without repacking.
+Paths into the archive are virtual. Anything that writes or watches a
+resource takes its filename from file_path, never from path.
+'''
+
 import os
 import pyglet
 
+import archive
+
+# Resource directories, relative to the script
+PATHS = ['data/', 'data/maps/']
+# Written next to the script
+MANIFEST = 'resources.idx'
+MANIFEST_VERSION = 1
+# Packed resources, next to the script. Built by pack.py.
+ARCHIVE = 'data.pak'
+
+# Resource name -> filename, filled in by path
+_paths = {}
+
 def path(filename):
-    return os.path.join(pyglet.resource.location(filename).path, filename)
+    '''Full filename of a resource. Lookups are cached, so this is cheap
+    enough to call every time.
+    '''
+    full = _paths.get(filename)
+    if full == None:
+        full = os.path.join(pyglet.resource.location(filename).path, filename)
+        _paths[filename] = full
+    return full
+
+def file_path(filename):
+    '''Filename of a resource on disk, for whatever writes it or watches it
+    for changes. A resource served from the archive maps to where its loose
+    file goes, whether that exists yet or not.
+    '''
+    location = pyglet.resource.location(filename)
+    if isinstance(location, ArchiveLocation):
+        return os.path.join(pyglet.resource.get_script_home(),
+                os.path.normpath(location.prefix + filename))
+    return path(filename)
+
+class ResourceException(Exception):
+    pass
+
+class ArchiveLocation(pyglet.resource.Location):
+    '''pyglet.resource location for the members of an archive under one
+    prefix. path is a virtual directory that util.archive understands.
+    '''
+    def __init__(self, archive, prefix):
+        self.archive = archive
+        self.prefix = prefix
+        self.path = os.path.join(archive.filename, prefix)
+
+    def open(self, filename, mode='rb'):
+        return self.archive.open(self.prefix + filename)
+
+def archive_index(packed, roots):
+    '''pyglet.resource index of an archive's members. Members are named
+    relative to the script, so each resource directory is a prefix.
+    '''
+    index = {}
+    for root in roots:
+        prefix = '/'.join(filter(None, root.split('/'))) + '/'
+        location = ArchiveLocation(packed, prefix)
+        for name in packed.names():
+            if name.startswith(prefix):
+                index.setdefault(name[len(prefix):], location)
+    return index
+
+def _mtime(dirname):
+    try:
+        return repr(os.stat(dirname).st_mtime)
+    except OSError:
+        return '-1'
+
+def scan(roots):
+    '''Walks the resource directories the way pyglet.resource.reindex does.
+    Returns the directory mtimes and a dict mapping resource names to the
+    root they were found under. The first root wins for duplicate names.
+    '''
+    dirs = []
+    index = {}
+    for root in roots:
+        dirs.append((_mtime(root), root))
+        if not os.path.isdir(root):
+            continue
+
+        for dirpath, dirnames, filenames in os.walk(root):
+            if dirpath != root:
+                dirs.append((_mtime(dirpath), dirpath))
+            prefix = '/'.join(filter(None, dirpath[len(root):].split(os.sep)))
+            for filename in filenames:
+                if prefix:
+                    name = prefix + '/' + filename
+                else:
+                    name = filename
+                index.setdefault(name, root)
+    return dirs, index
+
+def read_manifest(filename, roots):
+    '''Returns the index stored in a manifest, or None if the manifest is
+    missing, was written for other roots or is out of date.
+    '''
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return None
+
+    try:
+        lines = f.read().split('\n')
+    finally:
+        f.close()
+
+    if lines[0] != 'version\t%d' % MANIFEST_VERSION:
+        return None
+
+    manifest_roots = []
+    index = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        kind, a, b = line.split('\t')
+        if kind == 'root':
+            manifest_roots.append(a)
+        elif kind == 'dir':
+            if _mtime(b) != a:
+                return None
+        elif kind == 'file':
+            index[b] = manifest_roots[int(a)]
+
+    if manifest_roots != roots:
+        return None
+    return index
+
+def write_manifest(filename, roots, dirs, index):
+    lines = ['version\t%d' % MANIFEST_VERSION]
+    for root in roots:
+        lines.append('root\t%s\t' % root)
+    for mtime, dirname in dirs:
+        lines.append('dir\t%s\t%s' % (mtime, dirname))
+    root_ids = dict((root, i) for i, root in enumerate(roots))
+    for name in sorted(index):
+        lines.append('file\t%d\t%s' % (root_ids[index[name]], name))
+
+    try:
+        f = open(filename, 'wb')
+        try:
+            f.write('\n'.join(lines) + '\n')
+        finally:
+            f.close()
+    except IOError:
+        # Read-only installs just scan every time
+        pass
+
+def init(paths=PATHS, manifest=MANIFEST, archive_name=ARCHIVE, loose=True):
+    '''Adds the resource directories to pyglet.resource and installs its
+    index. If the archive exists its members are served from it. With loose
+    set the files in the resource directories are indexed too, through the
+    manifest (rebuilt first if it is stale), and win over the archive.
+    Without loose the archive is required.
+    '''
+    home = pyglet.resource.get_script_home()
+    for p in paths:
+        if p not in pyglet.resource.path:
+            pyglet.resource.path.append(p)
+
+    loader = pyglet.resource._default_loader
+    if not hasattr(loader, '_index'):
+        # Not a pyglet we know the insides of
+        pyglet.resource.reindex()
+        return
+
+    index = {}
+    archive_name = os.path.join(home, archive_name)
+    if os.path.exists(archive_name):
+        packed = archive.mount(archive_name)
+        index = archive_index(packed, pyglet.resource.path)
+    elif not loose:
+        raise ResourceException('Resource archive %s is missing' % archive_name)
+
+    if loose:
+        roots = [os.path.join(home, p).rstrip(os.sep) for p in pyglet.resource.path]
+        manifest = os.path.join(home, manifest)
+        files = read_manifest(manifest, roots)
+        if files == None:
+            dirs, files = scan(roots)
+            write_manifest(manifest, roots, dirs, files)
+
+        locations = dict((root, pyglet.resource.FileLocation(root)) for root in roots)
+        for name, root in files.iteritems():
+            index[name] = locations[root]
 
+    loader._index = index
+    _paths.clear()
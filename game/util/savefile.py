@@ -0,0 +1,78 @@
+'''Helpers for writing files without stalling the game and without leaving a
+half written file behind if something goes wrong in the middle of a save.
+'''
+
+import os
+import tempfile
+import threading
+import traceback
+import Queue
+
+def atomic_write(filename, data):
+    '''Writes data to a temporary file next to filename and renames it over
+    the original once everything is on disk. Readers see either the old file
+    or the new one, never a mix of both.
+    '''
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp = tempfile.mkstemp(dir=directory,
+            prefix='.' + os.path.basename(filename), suffix='.tmp')
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+        # Windows won't rename over an existing file
+        if os.name == 'nt' and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(temp, filename)
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+def append_durable(filename, data):
+    '''Appends data to filename and waits for it to hit the disk.
+    '''
+    f = open(filename, 'ab')
+    try:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+
+class BackgroundWriter(object):
+    '''Runs submitted jobs one after another on a worker thread. Jobs run in
+    submission order, so a full save followed by a journal append can't be
+    reordered.
+    '''
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.thread = None
+
+    def submit(self, func, *args):
+        if self.thread == None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, name='writer')
+            self.thread.daemon = True
+            self.thread.start()
+
+        self.queue.put((func, args))
+
+    def flush(self):
+        '''Blocks until every submitted job has finished.
+        '''
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            func, args = self.queue.get()
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,131 @@
+'''On-disk cache of decoded images.
+Decoding big JPEGs and PNGs is a good part of load time, and it gives the
+same pixels every launch. The first load of an image decodes it as usual and
+writes the raw RGBA rows to the cache. Later loads map the cache entry and
+upload straight from the mapping.
+
+Entries are named after a hash of the resource name and the sha1 of the
+source file, so editing an image gives it a new entry and the old one is
+deleted when the new one is written.
+
+Entry layout, little endian:
+    header      magic 'PRGB', version (H), reserved (H), width (I), height (I)
+    pixels      width * height RGBA pixels, bottom row first, no padding
+'''
+
+import os
+import mmap
+import ctypes
+import struct
+import hashlib
+
+import pyglet
+
+import archive
+import resource
+import savefile
+
+MAGIC = 'PRGB'
+VERSION = 1
+# Relative to the script
+CACHE_DIR = 'cache/textures'
+
+_header = struct.Struct('<4sHHII')
+
+class TextureCache(object):
+    def __init__(self, directory=None):
+        self.directory = directory
+        # Resource name -> texture, see image
+        self.textures = {}
+
+    def get_directory(self):
+        if self.directory == None:
+            self.directory = os.path.join(pyglet.resource.get_script_home(),
+                    CACHE_DIR)
+        return self.directory
+
+    def entry_prefix(self, name):
+        return hashlib.sha1(name).hexdigest()[:16] + '-'
+
+    def entry_filename(self, name, key):
+        return os.path.join(self.get_directory(),
+                self.entry_prefix(name) + key.encode('hex') + '.rgba')
+
+    def load(self, name):
+        '''ImageData of a resource, from the cache if the source hasn't
+        changed since it was cached.
+        '''
+        filename = self.entry_filename(name,
+                archive.digest(resource.path(name)))
+
+        image = self.read_entry(filename)
+        if image == None:
+            image = self.decode(name)
+            self.write_entry(name, filename, image)
+        return image
+
+    def image(self, name):
+        '''Texture of a resource, only uploaded once.
+        '''
+        texture = self.textures.get(name)
+        if texture == None:
+            texture = self.load(name).get_texture()
+            self.textures[name] = texture
+        return texture
+
+    def decode(self, name):
+        f = pyglet.resource.file(name)
+        try:
+            return pyglet.image.load(name, file=f).get_image_data()
+        finally:
+            f.close()
+
+    def read_entry(self, filename):
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            return None
+
+        try:
+            # Copy on write, so ctypes can point into it. Nothing writes to
+            # it, so the pages stay shared with the file.
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            magic, version, reserved, width, height = _header.unpack_from(data, 0)
+        except (ValueError, struct.error):
+            # Empty or truncated
+            return None
+        finally:
+            f.close()
+
+        size = width * height * 4
+        if magic != MAGIC or version != VERSION or \
+                len(data) != _header.size + size:
+            return None
+
+        try:
+            pixels = (ctypes.c_ubyte * size).from_buffer(data, _header.size)
+        except TypeError:
+            pixels = data[_header.size:]
+        return pyglet.image.ImageData(width, height, 'RGBA', pixels, width * 4)
+
+    def write_entry(self, name, filename, image):
+        pixels = image.get_data('RGBA', image.width * 4)
+        directory = self.get_directory()
+        prefix = self.entry_prefix(name)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Entries for older versions of the source
+            for old in os.listdir(directory):
+                if old.startswith(prefix):
+                    os.remove(os.path.join(directory, old))
+            savefile.atomic_write(filename, _header.pack(MAGIC, VERSION, 0,
+                image.width, image.height) + pixels)
+        except (IOError, OSError):
+            # Read-only installs just decode every time
+            pass
+
+# Shared cache
+default = TextureCache()
+load = default.load
+image = default.image
@@ -1,3 +1,6 @@
+# Imported first so the startup timeline starts before anything heavy
+from game import debug
+
 # That is a lot of games
 from game.game import game
 
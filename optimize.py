@@ -0,0 +1,41 @@
+'''Optimizes the static collision geometry in a physics XML file.
+
+Usage: python optimize.py [options] data/maps/physics/test.xml
+'''
+
+import sys
+import optparse
+
+from game import geometry
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] physics.xml')
+    parser.add_option('-o', '--output', help='write to OUTPUT instead of '
+            'overwriting the input file')
+    parser.add_option('-w', '--weld', type='int', default=3,
+            help='weld vertices closer than WELD pixels [default: %default]')
+    parser.add_option('-g', '--grid', type='int', default=0,
+            help='snap vertices to a GRID pixel grid, 0 disables snapping')
+    parser.add_option('-a', '--min-area', type='float', default=16.0,
+            help='drop polygons smaller than MIN_AREA square pixels '
+            '[default: %default]')
+    parser.add_option('-n', '--dry-run', action='store_true', default=False,
+            help='only print the report')
+    options, args = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error('expected exactly one physics file')
+
+    filename = args[0]
+    polygons = geometry.load_polygons(filename)
+    optimized, report = geometry.optimize(polygons,
+            weld_tolerance=options.weld, grid=options.grid,
+            min_area=options.min_area)
+
+    print '%s: %s' % (filename, report)
+
+    if not options.dry_run:
+        geometry.save_polygons(options.output or filename, optimized)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,51 @@
+'''Packs every resource into one archive that the game mounts on startup.
+
+Usage: python pack.py [options]
+'''
+
+import os
+import sys
+import optparse
+
+from game.util import archive
+from game.util import resource
+
+def collect(home, paths):
+    '''(member name, filename) of every file under the resource
+    directories. Nested directories are only packed once.
+    '''
+    members = {}
+    for p in paths:
+        root = os.path.join(home, p)
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                full = os.path.join(dirpath, filename)
+                name = os.path.relpath(full, home).replace(os.sep, '/')
+                members[name] = full
+    return members.items()
+
+def main():
+    home = os.path.dirname(os.path.abspath(__file__))
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-o', '--output', default=os.path.join(home, resource.ARCHIVE),
+            help='archive to write [default: %default]')
+    parser.add_option('-v', '--verify', action='store_true', default=False,
+            help='read the archive back and check every member')
+    options, args = parser.parse_args()
+
+    members = collect(home, resource.PATHS)
+    count = archive.pack(options.output, members)
+    print 'Packed %d files into %s (%d bytes)' % (count, options.output,
+            os.path.getsize(options.output))
+
+    if options.verify:
+        packed = archive.Archive(options.output)
+        bad = [name for name in sorted(packed.names()) if not packed.verify(name)]
+        for name in bad:
+            print 'Corrupt: %s' % name
+        packed.close()
+        if bad:
+            return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,32 @@
+'''Replays an input recording headlessly, checks it for divergence and
+reports step times.
+
+Usage: python replay.py [options] recording.rpl
+'''
+
+import sys
+import optparse
+
+# Must come before any other game module
+import game.headless
+from game import recording
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] recording.rpl')
+    parser.add_option('-r', '--realtime', action='store_true', default=False,
+            help='pace the replay to the recorded tick length')
+    parser.add_option('-x', '--stop', action='store_true', default=False,
+            help='stop at the first divergence')
+    options, args = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error('expected exactly one recording')
+
+    result = recording.replay(recording.load(args[0]),
+            realtime=options.realtime, stop_on_divergence=options.stop)
+    print result
+
+    return 1 if result.diverged else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
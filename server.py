@@ -0,0 +1,156 @@
+'''Runs a level as a headless authoritative server, or benchmarks the
+server against simulated clients over UDP loopback.
+
+Usage: python server.py [options]
+       python server.py --bench
+       python server.py --check
+'''
+
+import sys
+import struct
+import random
+import optparse
+
+# Must come before any other game module
+import game.headless
+from game import net
+from game import controls
+from game import actors
+from game import simulation
+
+# Actions the simulated benchmark clients press at random
+BENCH_ACTIONS = ('move_up', 'move_left', 'move_right')
+
+def spawn_player(sim, client_id):
+    return simulation.spawn(sim, actors.Player, 'Player %d' % client_id,
+            (100 + 40 * (client_id % 32), 100))
+
+def bench(map_filename, client_counts, actor_counts, ticks):
+    print '%8s %8s %14s %14s %14s' % ('clients', 'actors', 'tick ms',
+            'bytes/s/client', 'kbit/s/client')
+    for actor_count in actor_counts:
+        for client_count in client_counts:
+            sim = simulation.load_level(map_filename)
+            simulation.spawn_blocks(sim, actor_count)
+            server = net.Server(sim, spawn_player, ('127.0.0.1', 0))
+            clients = [net.Client(server.address, ('127.0.0.1', 0))
+                    for i in range(client_count)]
+
+            for client in clients:
+                client.connect()
+            server.step()
+            for client in clients:
+                client.poll()
+
+            # Only count the steady state
+            server.tick_times = []
+            for client in server.clients.values():
+                client.bytes_sent = 0
+
+            rng = random.Random(0)
+            for tick in range(ticks):
+                for client in clients:
+                    events = []
+                    if rng.random() < 0.05:
+                        events.append((rng.choice(BENCH_ACTIONS),
+                            rng.random() < 0.5))
+                    client.send_input(events)
+                server.step()
+                for client in clients:
+                    client.poll()
+                    client.sample()
+
+            seconds = ticks * sim.dt
+            total = sum(c.bytes_sent for c in server.clients.values())
+            per_client = total / float(client_count) / seconds
+            tick_ms = sum(server.tick_times) / len(server.tick_times) * 1000
+            print '%8d %8d %14.3f %14.0f %14.1f' % (client_count, actor_count,
+                    tick_ms, per_client, per_client * 8 / 1000)
+
+            for client in clients:
+                client.disconnect()
+            server.socket.close()
+
+def check(map_filename):
+    '''Sends the server malformed input packets over loopback and checks it
+    drops them and keeps serving. Returns the failures.
+    '''
+    sim = simulation.load_level(map_filename)
+    server = net.Server(sim, spawn_player, ('127.0.0.1', 0))
+    client = net.Client(server.address, ('127.0.0.1', 0))
+    client.connect()
+    server.step()
+    client.poll()
+    player = server.clients[client.client_id].player
+
+    def input_packet(frames):
+        return struct.pack('<BHIB', net.MSG_INPUT, client.client_id, 0,
+                len(frames)) + ''.join(frames)
+
+    def unknown_action(frame):
+        # An action id past the end of ACTIONS in place of the last event
+        return controls.pack_actions(frame, [('move_up', True)])[:-2] + \
+                struct.pack('<BB', len(controls.ACTIONS), 1)
+
+    valid = controls.pack_actions(1, [('move_left', True)])
+    packets = (
+        ('unknown action', input_packet([unknown_action(1)])),
+        ('valid frame before an unknown action',
+            input_packet([valid, unknown_action(2)])),
+        ('truncated frame', input_packet([valid[:-1]])),
+        ('missing frames', input_packet([])[:-1] + chr(3)),
+        ('empty', ''),
+    )
+
+    failures = []
+    for name, data in packets:
+        client.socket.sendto(data, server.address)
+        try:
+            server.step()
+        except Exception, e:
+            failures.append('%s: %r' % (name, e))
+        if server.clients[client.client_id].input_frame != 0:
+            failures.append('%s: input applied' % name)
+
+    client.send_input([('move_left', True)])
+    server.step()
+    if server.clients[client.client_id].input_frame != 1:
+        failures.append('valid input after the malformed packets was lost')
+    client.disconnect()
+    server.socket.close()
+    return failures
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-m', '--map', default='maps/test.tmx',
+            help='map to host [default: %default]')
+    parser.add_option('-p', '--port', type='int', default=27960,
+            help='UDP port [default: %default]')
+    parser.add_option('-r', '--radius', type='float', default=800.0,
+            help='interest radius in pixels [default: %default]')
+    parser.add_option('--bench', action='store_true', default=False,
+            help='run the loopback benchmark instead of serving')
+    parser.add_option('--check', action='store_true', default=False,
+            help='check that malformed packets are dropped, then exit')
+    parser.add_option('--ticks', type='int', default=300,
+            help='ticks per benchmark run [default: %default]')
+    options, args = parser.parse_args()
+
+    if options.check:
+        failures = check(options.map)
+        for failure in failures:
+            print 'FAIL %s' % failure
+        print '%d failures' % len(failures)
+        return 1 if failures else 0
+
+    if options.bench:
+        bench(options.map, (1, 2, 4, 8, 16), (10, 100, 500), options.ticks)
+        return 0
+
+    sim = simulation.load_level(options.map)
+    server = net.Server(sim, spawn_player, ('0.0.0.0', options.port),
+            interest_radius=options.radius)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    sys.exit(main())